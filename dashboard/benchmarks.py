@@ -0,0 +1,548 @@
+"""Micro-benchmarks for the dashboard data path.
+
+python benchmarks.py store --rows 10000000 --batch 1000
+python benchmarks.py snapshot --rows 5000000
+python benchmarks.py fetch --rows 100000 1000000 10000000
+python benchmarks.py sessions --url http://127.0.0.1:8050 --sessions 50 --node-ids 1 2
+python benchmarks.py layout --nodes 50 500 5000
+python benchmarks.py e2e --nodes 10 100 1000 --duration 3600
+python benchmarks.py frames --frames 100000
+"""
+
+import argparse
+import base64
+import gc
+import random
+import struct
+import threading
+import tracemalloc
+from copy import deepcopy
+from datetime import datetime, timedelta
+from statistics import quantiles
+from time import perf_counter, sleep
+from typing import Dict, List
+
+from dotenv import dotenv_values
+import numpy as np
+import pandas as pd
+import psycopg
+import requests
+
+from binary_copy import copy_measurements
+from chicken_udp import ChickenUDP
+from fake_broker import FakeBroker
+from measurement_store import MeasurementStore
+from mesh_controller import MeshController
+from mesh_graph import MeshGraph
+from mesh_simulator import MeshSimulator
+from mqtt_client import MqttClient
+from mqtt_logger import MqttLogger
+from topology_history import TopologyHistory
+
+
+def synthetic_records(first_id: int, rows: int, nodes: int = 100) -> List[tuple]:
+    start = datetime(2023, 1, 1) + timedelta(seconds=first_id)
+    return [
+        (
+            first_id + i,
+            1000 + i % nodes,
+            f"node-{i % nodes}",
+            20 + i % 10,
+            60.0,
+            0.5,
+            0.0,
+            start + timedelta(seconds=i),
+        )
+        for i in range(rows)
+    ]
+
+
+def bench_store(args):
+    batch = synthetic_records(1, args.batch)
+    store = MeasurementStore()
+    baseline = pd.DataFrame() if args.baseline else None
+    append_times = []
+
+    tracemalloc.start()
+    for first_id in range(1, args.rows + 1, args.batch):
+        records = [(first_id + row[0] - 1, *row[1:]) for row in batch]
+        start = perf_counter()
+        if baseline is None:
+            store.append_records(records)
+        else:
+            baseline = pd.concat([baseline, pd.DataFrame(records)], ignore_index=True)
+        append_times.append(perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stored = len(baseline) if baseline is not None else len(store)
+    p50, p99 = [quantiles(append_times, n=100)[i] for i in (49, 98)]
+    print(f"rows:             {stored:,}")
+    print(f"appends:          {len(append_times):,} x {args.batch} rows")
+    print(
+        f"append time (ms): p50={p50 * 1000:.3f} p99={p99 * 1000:.3f} total={sum(append_times):.2f} s"
+    )
+    print(f"last 100 appends: {sum(append_times[-100:]) / 100 * 1000:.3f} ms avg")
+    if baseline is None:
+        print(
+            f"store size:       {store.nbytes / 2**20:.1f} MiB (capacity {store.capacity:,})"
+        )
+    print(f"peak traced mem:  {peak / 2**20:.1f} MiB")
+
+
+def bench_snapshot(args):
+    """Startup cost: memory-mapping a snapshot vs. rebuilding it from rows."""
+    store = MeasurementStore()
+    for first_id in range(1, args.rows + 1, args.batch):
+        ids = np.arange(first_id, min(first_id + args.batch, args.rows + 1))
+        store.append_columns(
+            ids=ids,
+            node_ids=1000 + ids % args.nodes,
+            node_names=[f"node-{node}" for node in ids % args.nodes],
+            measurements={
+                meas: np.random.rand(len(ids)) for meas in store.MEASUREMENTS
+            },
+            timestamps=np.datetime64("2023-01-01") + ids.astype("timedelta64[s]"),
+        )
+
+    start = perf_counter()
+    store.save(args.directory)
+    print(f"rows:              {len(store):,}")
+    print(f"save:              {perf_counter() - start:.2f} s")
+
+    start = perf_counter()
+    loaded = MeasurementStore.load(args.directory)
+    print(f"load (mmap):       {perf_counter() - start:.3f} s")
+    start = perf_counter()
+    rows = loaded.select([1000, 1001])
+    loaded.column("temperature")[rows].sum()
+    print(f"first 2-node read: {perf_counter() - start:.3f} s ({len(rows):,} rows)")
+
+
+def bench_fetch(args):
+    """fetchall() + append_records vs. binary COPY into the store (needs a
+    database with at least max(--rows) measurements, read from credentials.env)."""
+    db_credentials = dotenv_values("credentials.env")
+    conn = psycopg.connect(
+        host=db_credentials["DB_HOST"],
+        port=db_credentials["DB_PORT"],
+        user=db_credentials["DB_USER"],
+        password=db_credentials["DB_PASSWORD"],
+        dbname=db_credentials["DB_NAME"],
+        sslmode="require",
+    )
+    first_id = conn.execute("SELECT min(id) - 1 FROM measurements").fetchone()[0]
+    for rows in args.rows:
+        until_id = first_id + rows
+
+        tracemalloc.start()
+        start = perf_counter()
+        store = MeasurementStore()
+        records = conn.execute(
+            "SELECT * FROM measurements WHERE id > %s AND id <= %s",
+            (first_id, until_id),
+        ).fetchall()
+        store.append_records(records)
+        fetchall_time = perf_counter() - start
+        _, fetchall_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del records, store
+
+        tracemalloc.start()
+        start = perf_counter()
+        store = MeasurementStore()
+        copy_measurements(conn, store, first_id, until_id)
+        copy_time = perf_counter() - start
+        _, copy_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        conn.commit()
+
+        print(
+            f"{len(store):>11,} rows: "
+            f"fetchall {fetchall_time:7.2f} s / {fetchall_peak / 2**20:7.1f} MiB peak, "
+            f"binary COPY {copy_time:7.2f} s / {copy_peak / 2**20:7.1f} MiB peak"
+        )
+
+
+GRAPHS = [("temp", "temp"), ("hum", "hum"), ("lum", "lum"), ("gas", "gas")]
+
+
+def graph_callback_request(graph: str, selector: str, node_ids, n, state) -> Dict:
+    """Body Dash's renderer posts to run one graph callback."""
+    return {
+        "output": f"..{graph}-readings.figure...{graph}-readings-state.data..",
+        "outputs": [
+            {"id": f"{graph}-readings", "property": "figure"},
+            {"id": f"{graph}-readings-state", "property": "data"},
+        ],
+        "inputs": [
+            {"id": f"selector-{selector}", "property": "value", "value": node_ids},
+            {"id": f"{graph}-readings", "property": "relayoutData", "value": None},
+            {"id": "interval-component", "property": "n_intervals", "value": n},
+        ],
+        "state": [
+            {"id": f"{graph}-readings-state", "property": "data", "value": state}
+        ],
+        "changedPropIds": ["interval-component.n_intervals"],
+    }
+
+
+def dashboard_session(args, node_ids: List[int], latencies: List[float], errors: List):
+    http = requests.Session()
+    states = {graph: None for graph, _ in GRAPHS}
+    for n in range(args.ticks):
+        tick_start = perf_counter()
+        for graph, selector in GRAPHS:
+            body = graph_callback_request(graph, selector, node_ids, n, states[graph])
+            start = perf_counter()
+            try:
+                response = http.post(f"{args.url}/_dash-update-component", json=body)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                errors.append(e)
+                continue
+            latencies.append(perf_counter() - start)
+            # Outputs left as no_update are omitted from the response
+            output = response.json()["response"] if response.content else {}
+            if f"{graph}-readings-state" in output:
+                states[graph] = output[f"{graph}-readings-state"]["data"]
+        sleep(max(0.0, args.interval - (perf_counter() - tick_start)))
+
+
+def bench_sessions(args):
+    """Many dashboards polling a running `iop.py` at once, as browsers would."""
+    node_ids = args.node_ids
+    latencies, errors = [], []
+    sessions = [
+        threading.Thread(
+            target=dashboard_session, args=(args, node_ids, latencies, errors)
+        )
+        for _ in range(args.sessions)
+    ]
+    start = perf_counter()
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+    elapsed = perf_counter() - start
+
+    p50, p90, p99 = [quantiles(latencies, n=100)[i] for i in (49, 89, 98)]
+    print(f"sessions:          {args.sessions} x {args.ticks} ticks")
+    print(f"callbacks:         {len(latencies):,} ok, {len(errors):,} failed")
+    print(f"throughput:        {len(latencies) / elapsed:,.1f} callbacks/s")
+    print(
+        f"latency (ms):      p50={p50 * 1000:.1f} p90={p90 * 1000:.1f} p99={p99 * 1000:.1f}"
+    )
+
+
+def synthetic_tree(nodes: int, seed: int = 0) -> Dict:
+    """Random mesh tree report of `nodes` nodes, at most 6 children each."""
+    rng = random.Random(seed)
+    tree_nodes = [{"nodeId": 1, "root": True}]
+    for node_id in range(2, nodes + 1):
+        parent = rng.choice(tree_nodes[-64:])
+        while len(parent.get("subs", [])) >= 6:
+            parent = rng.choice(tree_nodes)
+        child = {"nodeId": node_id}
+        parent.setdefault("subs", []).append(child)
+        tree_nodes.append(child)
+    return tree_nodes[0]
+
+
+def grow_tree(tree: Dict, first_id: int, nodes: int, seed: int = 1) -> Dict:
+    """Copy of `tree` with `nodes` new leaves under random existing nodes."""
+    rng = random.Random(seed)
+    tree = deepcopy(tree)
+    tree_nodes, stack = [], [tree]
+    while stack:
+        node = stack.pop()
+        tree_nodes.append(node)
+        stack.extend(node.get("subs", []))
+    for node_id in range(first_id, first_id + nodes):
+        rng.choice(tree_nodes).setdefault("subs", []).append({"nodeId": node_id})
+    return tree
+
+
+def bench_layout(args):
+    """Layout alone, then a whole `update_graph` (parse, diff, layout)."""
+    print(
+        f"{'nodes':>6} {'full layout':>12} {'+1% layout':>11}"
+        f" {'+1% update':>11} {'cached update':>14}   (ms)"
+    )
+    for nodes in args.nodes:
+        tree = synthetic_tree(nodes)
+        grown = grow_tree(tree, nodes + 1, max(nodes // 100, 1))
+        graph = MeshGraph()
+        graph.update_graph(tree, {})
+        root_id = graph.cytoscape_root.split('"')[1]
+        positions = graph._positions
+        gc.collect()
+
+        start = perf_counter()
+        graph._full_layout(root_id)
+        full = perf_counter() - start
+
+        start = perf_counter()
+        graph.update_graph(grown, {})
+        update = perf_counter() - start
+
+        graph._positions = positions
+        start = perf_counter()
+        graph._place_new_nodes(root_id)
+        incremental = perf_counter() - start
+
+        # Flapping back to a topology seen before hits the layout cache
+        start = perf_counter()
+        graph.update_graph(tree, {})
+        cached = perf_counter() - start
+        print(
+            f"{nodes:>6} {full * 1000:>12.2f} {incremental * 1000:>11.2f}"
+            f" {update * 1000:>11.2f} {cached * 1000:>14.2f}"
+        )
+
+
+def dashboard_poller(
+    graph: MeshGraph,
+    logger: MqttLogger,
+    controller: MeshController,
+    interval: float,
+    latencies: List[float],
+    stop: threading.Event,
+):
+    """What the topology, log and status callbacks do on every interval."""
+    version, cursor = None, None
+    while not stop.wait(interval):
+        start = perf_counter()
+        _, version = graph.get_cytoscape_update(version)
+        cursor = logger.query(after=cursor).cursor
+        controller.get_mesh_status()
+        controller.stale_nodes()
+        latencies.append(perf_counter() - start)
+
+
+def bench_e2e(args):
+    """Simulated mesh -> in-process broker -> MqttClient -> dashboard state,
+    while a poller reads that state as the Dash callbacks do."""
+    print(
+        f"{'nodes':>6} {'messages':>9} {'msg/s':>9} {'dropped':>8}"
+        f" {'poll p50':>9} {'poll p99':>9} {'peak MiB':>9}   handler mean/max (ms)"
+    )
+    for nodes in args.nodes:
+        broker = FakeBroker()
+        graph = MeshGraph(history=TopologyHistory())
+        logger = MqttLogger()
+        controller = MeshController()
+        client = MqttClient(
+            logger=logger,
+            controller=controller,
+            graph=graph,
+            dispatch_workers=args.workers,
+            transport=broker.transport,
+        )
+        client.connect()
+        simulator = MeshSimulator(
+            broker.transport(client_id="iop-bridge"),
+            nodes=nodes,
+            fanout=args.fanout,
+            depth=args.depth,
+            topology_interval_s=args.topology_interval,
+            hello_interval_s=args.hello_interval,
+            churn=args.churn,
+            binary=args.binary,
+        )
+        simulator.connect()
+        gc.collect()
+
+        latencies = []
+        stop = threading.Event()
+        poller = threading.Thread(
+            target=dashboard_poller,
+            args=(graph, logger, controller, args.poll_interval, latencies, stop),
+        )
+        if args.memory:
+            tracemalloc.start()
+        poller.start()
+        start = perf_counter()
+        published = simulator.run(args.duration, speedup=args.speedup)
+        broker.join()
+        client._dispatcher.join()
+        elapsed = perf_counter() - start
+        stop.set()
+        poller.join()
+        if args.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        metrics = client.dispatch_metrics
+        p50, p99 = (
+            [quantiles(latencies, n=100)[i] * 1000 for i in (49, 98)]
+            if len(latencies) > 1
+            else [float("nan")] * 2
+        )
+        handlers = ", ".join(
+            f"{name} {stats['mean_ms']:.3f}/{stats['max_ms']:.1f}"
+            for name, stats in metrics["handler_latency"].items()
+        )
+        print(
+            f"{nodes:>6} {published:>9,} {published / elapsed:>9,.0f}"
+            f" {metrics['dropped']:>8,} {p50:>9.2f} {p99:>9.2f}"
+            f" {peak / 2**20 if args.memory else float('nan'):>9.1f}   {handlers}"
+        )
+
+
+def synthetic_measurements(frames: int, seed: int = 0) -> List[Dict]:
+    """Messages as the bridge forwards them, with float32 readings as the
+    sensors take them."""
+    rng = random.Random(seed)
+
+    def reading(value: float) -> float:
+        return struct.unpack("<f", struct.pack("<f", value))[0]
+
+    return [
+        {
+            "data": {
+                "temperature": reading(rng.gauss(27, 3)),
+                "humidity": reading(rng.uniform(40, 80)),
+                "luminosity": reading(rng.random()),
+                "hazardous_gas_warning": reading(rng.random() < 0.05),
+            },
+            "node_id": rng.randrange(2**32),
+            "node_name": f"sensor-{i % 100}",
+        }
+        for i in range(frames)
+    ]
+
+
+def bench_frames(args):
+    """JSON vs. binary ChickenUDP frames: bytes on the mesh and on MQTT,
+    and the Python pack and unpack cost."""
+    cudp = ChickenUDP()
+    messages = synthetic_measurements(args.frames)
+    sensor_messages = [
+        {"data": message["data"], "msg_type": 0} for message in messages[:1000]
+    ]
+    formats = {
+        "json": (cudp.package_data, lambda message: cudp.package_data(message)),
+        "binary": (
+            cudp.package_binary,
+            # Base64, as the sensors send it over the mesh
+            lambda message: base64.b64encode(cudp.package_binary(message)),
+        ),
+    }
+    print(
+        f"{'format':>7} {'mesh B':>7} {'MQTT B':>7}"
+        f" {'pack us':>8} {'unpack us':>10} {'batch us':>9}"
+    )
+    for name, (pack, pack_for_mesh) in formats.items():
+        mesh_bytes = sum(map(len, map(pack_for_mesh, sensor_messages)))
+        gc.collect()
+        start = perf_counter()
+        frames = [pack(message) for message in messages]
+        pack_time = perf_counter() - start
+
+        start = perf_counter()
+        for frame in frames:
+            cudp.unpack_data(frame)
+        unpack_time = perf_counter() - start
+
+        start = perf_counter()
+        unpacked = cudp.unpack_batch(frames)
+        batch_time = perf_counter() - start
+        assert unpacked == messages
+
+        print(
+            f"{name:>7} {mesh_bytes / len(sensor_messages):>7.1f}"
+            f" {sum(map(len, frames)) / len(frames):>7.1f}"
+            f" {pack_time / len(frames) * 1e6:>8.2f}"
+            f" {unpack_time / len(frames) * 1e6:>10.2f}"
+            f" {batch_time / len(frames) * 1e6:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    store_parser = subparsers.add_parser("store", help="MeasurementStore append cost")
+    store_parser.add_argument("--rows", type=int, default=10_000_000)
+    store_parser.add_argument("--batch", type=int, default=1000)
+    store_parser.add_argument(
+        "--baseline", action="store_true", help="measure the old pd.concat path instead"
+    )
+    store_parser.set_defaults(func=bench_store)
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="on-disk snapshot save/load time"
+    )
+    snapshot_parser.add_argument("--rows", type=int, default=5_000_000)
+    snapshot_parser.add_argument("--batch", type=int, default=100_000)
+    snapshot_parser.add_argument("--nodes", type=int, default=100)
+    snapshot_parser.add_argument("--directory", default="snapshot-benchmark")
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    fetch_parser = subparsers.add_parser(
+        "fetch", help="fetchall vs. binary COPY against the real database"
+    )
+    fetch_parser.add_argument(
+        "--rows", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000]
+    )
+    fetch_parser.set_defaults(func=bench_fetch)
+
+    sessions_parser = subparsers.add_parser(
+        "sessions", help="concurrent dashboard sessions against a running app"
+    )
+    sessions_parser.add_argument("--url", default="http://127.0.0.1:8050")
+    sessions_parser.add_argument("--sessions", type=int, default=50)
+    sessions_parser.add_argument("--ticks", type=int, default=20)
+    sessions_parser.add_argument("--interval", type=float, default=3.0)
+    sessions_parser.add_argument(
+        "--node-ids", type=int, nargs="+", required=True, help="nodes to plot"
+    )
+    sessions_parser.set_defaults(func=bench_sessions)
+
+    layout_parser = subparsers.add_parser(
+        "layout", help="MeshGraph tree layout time per topology size"
+    )
+    layout_parser.add_argument("--nodes", type=int, nargs="+", default=[50, 500, 5000])
+    layout_parser.set_defaults(func=bench_layout)
+
+    e2e_parser = subparsers.add_parser(
+        "e2e", help="simulated mesh through MqttClient into the dashboard state"
+    )
+    e2e_parser.add_argument("--nodes", type=int, nargs="+", default=[10, 100, 1000])
+    e2e_parser.add_argument(
+        "--duration", type=float, default=3600, help="simulated seconds"
+    )
+    e2e_parser.add_argument(
+        "--speedup",
+        type=float,
+        default=None,
+        help="simulated seconds per second (default: as fast as possible)",
+    )
+    e2e_parser.add_argument("--fanout", type=int, default=4)
+    e2e_parser.add_argument("--depth", type=int, default=None)
+    e2e_parser.add_argument("--topology-interval", type=float, default=60)
+    e2e_parser.add_argument("--hello-interval", type=float, default=60)
+    e2e_parser.add_argument(
+        "--churn", type=float, default=0.05, help="leaves moved per topology report"
+    )
+    e2e_parser.add_argument("--workers", type=int, default=1)
+    e2e_parser.add_argument("--poll-interval", type=float, default=0.05)
+    e2e_parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="trace peak memory too (slows everything down)",
+    )
+    e2e_parser.add_argument(
+        "--binary", action="store_true", help="nodes send binary ChickenUDP frames"
+    )
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    frames_parser = subparsers.add_parser(
+        "frames", help="JSON vs. binary ChickenUDP frame size and codec cost"
+    )
+    frames_parser.add_argument("--frames", type=int, default=100_000)
+    frames_parser.set_defaults(func=bench_frames)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,169 @@
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import psycopg
+from psycopg import sql
+
+from measurement_store import MeasurementStore
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_HEADER_SIZE = len(COPY_SIGNATURE) + 8
+POSTGRES_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+# Node names are sent as this many UTF-8 bytes, zero-padded, next to their
+# length. The rare longer name is looked up once the COPY is done
+NAME_BYTES = 32
+
+# Every field is cast to a fixed-width type and NULLs are replaced or
+# filtered out, so each tuple has the same size and a whole chunk decodes
+# with one np.frombuffer
+_fields = [
+    ("id", ">i8"),
+    ("node id", ">i8"),
+    ("name length", ">i4"),
+    ("name", f"S{NAME_BYTES}"),
+    ("temperature", ">f8"),
+    ("humidity", ">f8"),
+    ("luminosity", ">f8"),
+    ("hazardous gas warning", ">f8"),
+    ("timestamp", ">i8"),
+]
+_tuple_dtype = np.dtype(
+    [("field count", ">i2")]
+    + [
+        field
+        for position, (name, dtype) in enumerate(_fields)
+        for field in ((f"length {position}", ">i4"), (name, dtype))
+    ]
+)
+
+_copy_query = sql.SQL("""
+    COPY (
+        SELECT
+            id::int8,
+            node_id::int8,
+            coalesce(octet_length(convert_to(node_name, 'UTF8')), 0)::int4,
+            substring(
+                coalesce(convert_to(node_name, 'UTF8'), '') || {padding}
+                FROM 1 FOR {name_bytes}
+            ),
+            coalesce(temperature::float8, 'NaN'),
+            coalesce(humidity::float8, 'NaN'),
+            coalesce(luminosity::float8, 'NaN'),
+            coalesce(hazardous_gas_warning::float8, 'NaN'),
+            timestamp::timestamp
+        FROM measurements
+        WHERE id > {after_id} AND id <= {until_id}
+            AND node_id IS NOT NULL AND timestamp IS NOT NULL
+        ORDER BY id
+    ) TO STDOUT (FORMAT BINARY)
+    """)
+
+
+def _node_names(tuples: np.ndarray) -> np.ndarray:
+    """Names of `tuples`, None for NULL (or empty) names. Names longer than
+    NAME_BYTES come truncated and are left to the caller."""
+    codes, names = pd.factorize(tuples["name"])
+    names = np.array(
+        [name.decode("utf-8", errors="replace") for name in names],
+        dtype=object,
+    )
+    node_names = names[codes]
+    node_names[tuples["name length"] == 0] = None
+    return node_names
+
+
+def _append_tuples(store: MeasurementStore, tuples: np.ndarray, node_names):
+    store.append_columns(
+        ids=tuples["id"],
+        node_ids=tuples["node id"],
+        node_names=node_names,
+        measurements={
+            meas: tuples[meas].astype(np.float64) for meas in store.MEASUREMENTS
+        },
+        timestamps=(
+            POSTGRES_EPOCH + tuples["timestamp"].astype("timedelta64[us]")
+        ).astype("datetime64[ns]"),
+    )
+
+
+def copy_measurements(
+    conn: psycopg.Connection,
+    store: MeasurementStore,
+    after_id: int,
+    until_id: Optional[int] = None,
+    chunk_rows: int = 100_000,
+) -> int:
+    """Stream rows with `after_id < id <= until_id` into `store` through
+    `COPY ... (FORMAT BINARY)`, decoding `chunk_rows` tuples at a time straight
+    into the store's columns. Returns the number of rows appended.
+
+    Rows without a node id or timestamp are skipped. If the COPY fails, the
+    chunks appended before the failure stay in the store, in id order, so
+    the next call should start from `store.latest_id`.
+    """
+    if until_id is None:
+        until_id = conn.execute("SELECT coalesce(max(id), 0) FROM measurements")
+        until_id = until_id.fetchone()[0]
+    if until_id <= after_id:
+        return 0
+
+    query = _copy_query.format(
+        padding=sql.Literal(bytes(NAME_BYTES)),
+        name_bytes=sql.Literal(NAME_BYTES),
+        after_id=sql.Literal(after_id),
+        until_id=sql.Literal(until_id),
+    )
+    chunk_bytes = chunk_rows * _tuple_dtype.itemsize
+    pending = bytearray()
+    header_read = False
+    rows = 0
+    # Chunks from the first one with a name too long to be sent on are held
+    # until the COPY is done and their names can be looked up
+    held: List[np.ndarray] = []
+
+    def append(buffer: bytes):
+        nonlocal rows
+        tuples = np.frombuffer(buffer, dtype=_tuple_dtype)
+        if held or (tuples["name length"] > NAME_BYTES).any():
+            held.append(tuples)
+            return
+        _append_tuples(store, tuples, _node_names(tuples))
+        rows += len(tuples)
+
+    with conn.cursor() as cur:
+        with cur.copy(query) as copy:
+            for data in copy:
+                pending += data
+                if not header_read and len(pending) >= COPY_HEADER_SIZE:
+                    if not pending.startswith(COPY_SIGNATURE):
+                        raise ValueError("Unexpected COPY BINARY signature")
+                    extension = int.from_bytes(pending[15:19], "big")
+                    del pending[: COPY_HEADER_SIZE + extension]
+                    header_read = True
+                while header_read and len(pending) >= chunk_bytes:
+                    append(bytes(pending[:chunk_bytes]))
+                    del pending[:chunk_bytes]
+
+    # What is left are the last tuples and the 2-byte -1 trailer
+    complete = (len(pending) // _tuple_dtype.itemsize) * _tuple_dtype.itemsize
+    if complete:
+        append(bytes(pending[:complete]))
+
+    if held:
+        unnamed = np.concatenate(
+            [tuples["id"][tuples["name length"] > NAME_BYTES] for tuples in held]
+        )
+        long_names = dict(
+            conn.execute(
+                "SELECT id, node_name FROM measurements WHERE id = ANY(%s)",
+                (unnamed.tolist(),),
+            ).fetchall()
+        )
+        for tuples in held:
+            node_names = _node_names(tuples)
+            for row in np.flatnonzero(tuples["name length"] > NAME_BYTES):
+                node_names[row] = long_names[int(tuples["id"][row])]
+            _append_tuples(store, tuples, node_names)
+            rows += len(tuples)
+    return rows
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The dashboard imports its modules by name, as iop.py runs from this directory
+sys.path.insert(0, os.path.dirname(__file__))
@@ -5,7 +5,9 @@ CHECK_CONN_TOPIC = 'internet-of-poultry/dash/hello'
 ACK_CONN_TOPIC = 'internet-of-poultry/mesh/hello'
 TOPOLOGY_REQUEST_TOPIC = 'internet-of-poultry/dash/topology-request'
 TOPOLOGY_RESPONSE_TOPIC = 'internet-of-poultry/mesh/topology-response'
-MEASUREMENTS_TOPIC = '"internet-of-poultry/mesh/measurements"'
+MEASUREMENTS_TOPIC = 'internet-of-poultry/mesh/measurements'
+
+PLOT_WIDTH_PX = 1600
 
 class ConnStatuses(StrEnum):
     CONNECTED = "CONECTADO"
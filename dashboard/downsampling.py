@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def min_max_indices(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the min and max of `n_out // 2` equal-count buckets.
+
+    Every extreme survives, so short spikes (e.g. a gas warning) stay visible.
+    """
+    n = len(y)
+    if n <= n_out or n_out < 4:
+        return np.arange(n)
+
+    n_buckets = n_out // 2
+    bucket_size = -(-n // n_buckets)
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:n] = y
+    buckets = padded.reshape(n_buckets, bucket_size)
+    missing = np.isnan(buckets)
+    offsets = np.arange(n_buckets) * bucket_size
+
+    mins = np.where(missing, np.inf, buckets).argmin(axis=1) + offsets
+    maxs = np.where(missing, -np.inf, buckets).argmax(axis=1) + offsets
+    indices = np.unique(np.concatenate(([0, n - 1], mins, maxs)))
+    return indices[indices < n]
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets selection of `n_out` indices.
+
+    Bucket averages are computed in one pass with `np.add.reduceat`; only the
+    choice of the point inside each bucket, which depends on the previously
+    selected point, loops over buckets.
+    """
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    x = (x - x[0]).astype(np.float64)
+    y = np.nan_to_num(y.astype(np.float64))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:-1], edges[:-1])[: n_out - 2] / counts
+    avg_y = np.add.reduceat(y[:-1], edges[:-1])[: n_out - 2] / counts
+    # The bucket after the last one is the final point itself
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    selected = 0
+    for bucket in range(n_out - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        area = np.abs(
+            (x[selected] - next_x[bucket]) * (y[lo:hi] - y[selected])
+            - (x[selected] - x[lo:hi]) * (next_y[bucket] - y[selected])
+        )
+        selected = lo + int(area.argmax())
+        indices[bucket + 1] = selected
+    return indices
+
+
+def downsample_indices(
+    x: np.ndarray, y: np.ndarray, n_out: int, method: str = "minmax"
+) -> np.ndarray:
+    match method:
+        case "minmax":
+            return min_max_indices(y, n_out)
+        case "lttb":
+            return lttb_indices(x, y, n_out)
+    raise ValueError(f"Unknown downsampling method: {method}")
@@ -0,0 +1,172 @@
+from typing import Callable, List, Optional, Tuple, Union
+from concurrent.futures import Future
+from itertools import count
+from queue import Queue
+from threading import Lock, Thread
+
+from awscrt import mqtt
+
+# Called like the CRT calls subscription callbacks
+Callback = Callable[..., None]
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """MQTT filter matching, with `+` for one level and `#` for the rest."""
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _done(result=None) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class FakeBroker:
+    """In-process MQTT broker for running the dashboard offline.
+
+    Messages are routed to every matching subscription and delivered from a
+    single thread, in publish order, the way the CRT event-loop thread
+    delivers them. Only the parts of `awscrt.mqtt.Connection` the dashboard
+    and the mesh simulator use are implemented; QoS and retain are ignored.
+    """
+
+    _subscriptions: List[Tuple[str, "FakeConnection", Callback]]
+    _lock: Lock
+    _deliveries: Queue
+    _thread: Optional[Thread]
+    _delivered: int
+
+    def __init__(self):
+        self._subscriptions = []
+        self._lock = Lock()
+        self._deliveries = Queue()
+        self._thread = None
+        self._delivered = 0
+
+    def transport(self, client_id: str, **kwargs) -> "FakeConnection":
+        """`MqttClient` transport connecting to this broker."""
+        return FakeConnection(self, client_id, **kwargs)
+
+    def _subscribe(self, conn: "FakeConnection", topic_filter: str, callback: Callback):
+        with self._lock:
+            self._subscriptions.append((topic_filter, conn, callback))
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._deliver, name="fake-broker", daemon=True
+                )
+                self._thread.start()
+
+    def _publish(self, topic: str, payload: bytes):
+        with self._lock:
+            callbacks = [
+                callback
+                for topic_filter, conn, callback in self._subscriptions
+                if conn.connected and topic_matches(topic_filter, topic)
+            ]
+        for callback in callbacks:
+            self._deliveries.put((callback, topic, payload))
+
+    def _deliver(self):
+        while True:
+            callback, topic, payload = self._deliveries.get()
+            try:
+                callback(
+                    topic=topic,
+                    payload=payload,
+                    dup=False,
+                    qos=mqtt.QoS.AT_MOST_ONCE,
+                    retain=False,
+                )
+            except Exception as e:
+                print(f"Subscriber callback failed on {topic} ({e!r})")
+            finally:
+                self._delivered += 1
+                self._deliveries.task_done()
+
+    def join(self):
+        """Wait until every published message has been delivered."""
+        self._deliveries.join()
+
+    @property
+    def delivered(self) -> int:
+        return self._delivered
+
+
+class FakeConnection:
+    """Connection to a `FakeBroker`, with the `awscrt.mqtt.Connection` calls
+    returning already completed futures."""
+
+    client_id: str
+    connected: bool
+    _broker: FakeBroker
+    _packet_ids: count
+    _on_connection_interrupted: Optional[Callable]
+    _on_connection_resumed: Optional[Callable]
+
+    def __init__(
+        self,
+        broker: FakeBroker,
+        client_id: str,
+        on_connection_interrupted: Optional[Callable] = None,
+        on_connection_resumed: Optional[Callable] = None,
+        **kwargs,
+    ):
+        self.client_id = client_id
+        self.connected = False
+        self._broker = broker
+        self._packet_ids = count(1)
+        self._on_connection_interrupted = on_connection_interrupted
+        self._on_connection_resumed = on_connection_resumed
+
+    def connect(self) -> Future:
+        self.connected = True
+        return _done({"return_code": 0, "session_present": False})
+
+    def disconnect(self) -> Future:
+        self.connected = False
+        return _done({})
+
+    def subscribe(
+        self, topic: str, qos: mqtt.QoS, callback: Optional[Callback] = None
+    ) -> Tuple[Future, int]:
+        if callback is not None:
+            self._broker._subscribe(self, topic, callback)
+        return _done({"topic": topic, "qos": qos}), next(self._packet_ids)
+
+    def publish(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        qos: mqtt.QoS,
+        retain: bool = False,
+    ) -> Tuple[Future, int]:
+        if not self.connected:
+            future = Future()
+            future.set_exception(ConnectionError(f"{self.client_id} is not connected"))
+            return future, 0
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._broker._publish(topic, payload)
+        return _done({"packet_id": 0}), next(self._packet_ids)
+
+    def interrupt(self):
+        """Drop the connection the way a network failure would."""
+        self.connected = False
+        if self._on_connection_interrupted:
+            self._on_connection_interrupted(connection=self, error=ConnectionError())
+
+    def resume(self):
+        self.connected = True
+        if self._on_connection_resumed:
+            self._on_connection_resumed(
+                connection=self, return_code=0, session_present=True
+            )
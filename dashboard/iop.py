@@ -1,6 +1,11 @@
-from typing import List
+import os
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+from threading import Thread
+from time import time
+import pandas as pd
 import plotly.express as px
-from dash import dcc, html, Dash, callback, Input, Output, State
+from dash import dcc, html, Dash, Patch, callback, ctx, Input, Output, State, no_update
 import dash_cytoscape as cyto
 import dash_bootstrap_components as dbc
 
@@ -9,8 +14,11 @@ from mesh_graph import MeshGraph
 from mqtt_logger import MqttLogger
 from mesh_controller import MeshController
 from sensor_reader import SensorReader
-from mqtt_client import MqttClient
+from mqtt_client import MqttClient, local_broker
+from fake_broker import FakeBroker
+from mesh_simulator import MeshSimulator
 from styles import stylesheet
+from topology_history import TopologyHistory
 
 
 def line_graph(title: str, graph_id: str, dropdown_id: str):
@@ -24,6 +32,7 @@ def line_graph(title: str, graph_id: str, dropdown_id: str):
                     className="w-100 mt-4",
                     style={"height": "55vh"},
                 ),
+                dcc.Store(id=graph_id + "-state"),
                 html.Div(
                     [
                         dcc.Dropdown(
@@ -43,11 +52,54 @@ def line_graph(title: str, graph_id: str, dropdown_id: str):
     )
 
 
-mesh_graph = MeshGraph()
+def zoom_range(
+    relayout_data: Optional[Dict],
+) -> Tuple[Optional[datetime], Optional[datetime]]:
+    if not relayout_data or "xaxis.range[0]" not in relayout_data:
+        return None, None
+    return (
+        pd.Timestamp(relayout_data["xaxis.range[0]"]).to_pydatetime(),
+        pd.Timestamp(relayout_data["xaxis.range[1]"]).to_pydatetime(),
+    )
+
+
+def measurement_figure(
+    node_id_list: List, meas: str, relayout_data: Optional[Dict], client_state: Dict
+):
+    node_id_list = [int(node_id) for node_id in node_id_list]
+    start, end = zoom_range(relayout_data)
+    return sensors.get_figure_update(
+        node_id_list,
+        meas,
+        start,
+        end,
+        plot_width=consts.PLOT_WIDTH_PX,
+        client_state=client_state,
+    )
+
+
+mesh_graph = MeshGraph(history=TopologyHistory(spill_dir="topology-history"))
 mesh_control = MeshController()
 mqtt_logger = MqttLogger()
 sensors = SensorReader()
-client = MqttClient(logger=mqtt_logger, controller=mesh_control, graph=mesh_graph)
+# IOP_SIMULATED_NODES runs against a simulated mesh and MQTT_HOST against a
+# local broker instead of AWS IoT
+simulated_nodes = int(os.environ.get("IOP_SIMULATED_NODES", 0))
+broker = FakeBroker() if simulated_nodes else None
+if broker:
+    transport = broker.transport
+elif os.environ.get("MQTT_HOST"):
+    transport = local_broker(
+        os.environ["MQTT_HOST"], int(os.environ.get("MQTT_PORT", 1883))
+    )
+else:
+    transport = None
+client = MqttClient(
+    logger=mqtt_logger,
+    controller=mesh_control,
+    graph=mesh_graph,
+    transport=transport,
+)
 
 app = Dash(
     __name__, external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.FONT_AWESOME]
@@ -66,6 +118,30 @@ app.layout = dbc.Container(
                                 elements=[],
                                 className="w-100",
                             ),
+                            dcc.Store(id="mesh-topology-state"),
+                            html.Div(
+                                [
+                                    dcc.Slider(
+                                        id="topology-time",
+                                        min=-1440,
+                                        max=0,
+                                        step=5,
+                                        value=0,
+                                        marks={
+                                            -1440: "-24 h",
+                                            -720: "-12 h",
+                                            -360: "-6 h",
+                                            -60: "-1 h",
+                                            0: "agora",
+                                        },
+                                        updatemode="mouseup",
+                                    ),
+                                    html.P(id="topology-flaps", className="mb-0"),
+                                    html.P(id="stale-nodes", className="mb-0"),
+                                    dcc.Store(id="stale-nodes-state"),
+                                ],
+                                className="w-100 px-3 pt-2",
+                            ),
                             dbc.Button(
                                 html.I(className="fa-solid fa-lg fa-arrows-rotate"),
                                 id="topology-btn",
@@ -170,10 +246,67 @@ app.layout = dbc.Container(
                         style={"background-color": "rgba(187, 187, 187, 0.8)"},
                     ),
                     html.Div(
-                        id="logs-stack",
-                        style={"overflowY": "auto", "flex-grow": 1},
+                        [
+                            html.Div(
+                                [
+                                    dcc.Dropdown(
+                                        id="logs-origin",
+                                        options=["dash", "mesh"],
+                                        placeholder="Origem",
+                                        style={"width": "10rem"},
+                                    ),
+                                    dcc.Dropdown(
+                                        id="logs-endpoint",
+                                        options=[],
+                                        placeholder="Endpoint",
+                                        style={"width": "16rem"},
+                                    ),
+                                    dcc.Input(
+                                        id="logs-node-id",
+                                        type="number",
+                                        placeholder="ID do nó",
+                                        debounce=True,
+                                    ),
+                                    dcc.Dropdown(
+                                        id="logs-window",
+                                        options=[
+                                            {"label": "Últimos 5 min", "value": 5},
+                                            {"label": "Última hora", "value": 60},
+                                            {"label": "Último dia", "value": 1440},
+                                        ],
+                                        placeholder="Período",
+                                        style={"width": "12rem"},
+                                    ),
+                                    dcc.Input(
+                                        id="logs-search",
+                                        type="text",
+                                        placeholder="Buscar",
+                                        debounce=True,
+                                        style={"flex-grow": 1},
+                                    ),
+                                ],
+                                className="d-flex gap-2 px-3 py-2",
+                            ),
+                            html.Div(
+                                id="logs-stack",
+                                style={"overflowY": "auto", "flex-grow": 1},
+                            ),
+                            dbc.Pagination(
+                                id="logs-pagination",
+                                active_page=1,
+                                max_value=1,
+                                fully_expanded=False,
+                                first_last=True,
+                                previous_next=True,
+                                className="px-3 pt-2 mb-0",
+                            ),
+                        ],
+                        id="logs-panel",
+                        className="d-flex flex-column",
+                        style={"flex-grow": 1, "min-height": 0},
                         hidden=True,
                     ),
+                    dcc.Store(id="logs-cursor"),
                 ],
                 width=12,
                 className="mx-0 px-0 d-flex flex-column",
@@ -238,67 +371,177 @@ def update_node_checklist(
 
 @callback(
     Output("temp-readings", "figure"),
+    Output("temp-readings-state", "data"),
+    State("temp-readings-state", "data"),
     Input("selector-temp", "value"),
+    Input("temp-readings", "relayoutData"),
     Input("interval-component", "n_intervals"),
 )
-def update_temp_graph(node_id_list, n_intervals):
-    node_id_list = [int(node_id) for node_id in node_id_list]
-    return sensors.get_figure(node_id_list, "temperature")
+def update_temp_graph(client_state, node_id_list, relayout_data, n_intervals):
+    return measurement_figure(node_id_list, "temperature", relayout_data, client_state)
 
 
 @callback(
     Output("hum-readings", "figure"),
+    Output("hum-readings-state", "data"),
+    State("hum-readings-state", "data"),
     Input("selector-hum", "value"),
+    Input("hum-readings", "relayoutData"),
     Input("interval-component", "n_intervals"),
 )
-def update_hum_graph(node_id_list, n_intervals):
-    node_id_list = [int(node_id) for node_id in node_id_list]
-    return sensors.get_figure(node_id_list, "humidity")
+def update_hum_graph(client_state, node_id_list, relayout_data, n_intervals):
+    return measurement_figure(node_id_list, "humidity", relayout_data, client_state)
 
 
 @callback(
     Output("lum-readings", "figure"),
+    Output("lum-readings-state", "data"),
+    State("lum-readings-state", "data"),
     Input("selector-lum", "value"),
+    Input("lum-readings", "relayoutData"),
     Input("interval-component", "n_intervals"),
 )
-def update_lum_graph(node_id_list, n_intervals):
-    node_id_list = [int(node_id) for node_id in node_id_list]
-    return sensors.get_figure(node_id_list, "luminosity")
+def update_lum_graph(client_state, node_id_list, relayout_data, n_intervals):
+    return measurement_figure(node_id_list, "luminosity", relayout_data, client_state)
 
 
 @callback(
     Output("gas-readings", "figure"),
+    Output("gas-readings-state", "data"),
+    State("gas-readings-state", "data"),
     Input("selector-gas", "value"),
+    Input("gas-readings", "relayoutData"),
     Input("interval-component", "n_intervals"),
 )
-def update_gas_graph(node_id_list, n_intervals):
-    node_id_list = [int(node_id) for node_id in node_id_list]
-    return sensors.get_figure(node_id_list, "hazardous gas warning")
+def update_gas_graph(client_state, node_id_list, relayout_data, n_intervals):
+    return measurement_figure(
+        node_id_list, "hazardous gas warning", relayout_data, client_state
+    )
 
 
 @callback(
     Output("mesh-topology-graph", "elements"),
     Output("mesh-topology-graph", "layout"),
     Output("mesh-topology-graph", "stylesheet"),
-    State("mesh-topology-graph", "elements"),
-    State("mesh-topology-graph", "layout"),
+    Output("mesh-topology-state", "data"),
+    State("mesh-topology-state", "data"),
+    Input("topology-time", "value"),
+    Input("interval-component", "n_intervals"),
+)
+def update_cytoscape(client_version, minutes_ago, n_intervals):
+    # Positions are computed by MeshGraph and travel with the elements
+    layout = {"name": "preset", "fit": True}
+    if minutes_ago:
+        # Replaying the recorded history, which only changes with the slider;
+        # no version, so going back to live sends the whole graph again
+        if ctx.triggered_id != "topology-time":
+            return no_update, no_update, no_update, no_update
+        elements = mesh_graph.elements_at(time() + minutes_ago * 60)
+        return elements, layout, stylesheet["cytoscape_params"], None
+
+    elements, version = mesh_graph.get_cytoscape_update(client_version)
+    if version == client_version:
+        return no_update, no_update, no_update, no_update
+    if not isinstance(elements, list):
+        # Only the changed elements: new nodes come with their position and
+        # the ones already shown keep theirs
+        return elements, no_update, no_update, version
+    return elements, layout, stylesheet["cytoscape_params"], version
+
+
+@callback(
+    Output("topology-flaps", "children"), Input("interval-component", "n_intervals")
+)
+def update_topology_flaps(n_intervals):
+    flaps = mesh_graph.history.flap_counts()
+    if not flaps:
+        return no_update
+    unstable = sorted(flaps.items(), key=lambda item: item[1], reverse=True)[:5]
+    return "Nós instáveis: " + ", ".join(
+        f"{mesh_graph.node_label(node_id)} ({count})" for node_id, count in unstable
+    )
+
+
+@callback(
+    Output("stale-nodes", "children"),
+    Output("stale-nodes-state", "data"),
     Input("interval-component", "n_intervals"),
+    State("stale-nodes-state", "data"),
 )
-def update_cytoscape(elements, layout, n_intervals):
-    if mesh_graph.has_been_updated or not n_intervals:
-        elements, cytoscape_root = mesh_graph.get_cytospace_params()
-        layout = {"name": "circle", "animate": True, "roots": cytoscape_root}
-    return elements, layout, stylesheet["cytoscape_params"]
+def update_stale_nodes(n_intervals, client_version):
+    # Only rendered when a node went stale or came back since the last time
+    version = mesh_control.liveness_version
+    if version == client_version:
+        return no_update, no_update
+    stale = mesh_control.stale_nodes()
+    if not stale:
+        return "", version
+    oldest = sorted(stale.items(), key=lambda item: item[1])
+    return (
+        "Nós sem resposta: "
+        + ", ".join(
+            f"{mesh_graph.node_label(node_id)}"
+            f" (visto às {datetime.fromtimestamp(last_seen):%H:%M})"
+            for node_id, last_seen in oldest
+        ),
+        version,
+    )
 
 
 @callback(
     Output("logs-stack", "children"),
-    State("logs-stack", "children"),
+    Output("logs-cursor", "data"),
+    Output("logs-pagination", "max_value"),
+    Output("logs-endpoint", "options"),
+    State("logs-cursor", "data"),
+    Input("logs-panel", "hidden"),
+    Input("logs-origin", "value"),
+    Input("logs-endpoint", "value"),
+    Input("logs-node-id", "value"),
+    Input("logs-window", "value"),
+    Input("logs-search", "value"),
+    Input("logs-pagination", "active_page"),
     Input("interval-component", "n_intervals"),
 )
-def update_logger(children, n_intervals):
-    children = mqtt_logger.get_logs() if n_intervals else None
-    return children
+def update_logger(
+    cursor, hidden, origin, endpoint, node_id, window_min, text, page, n_intervals
+):
+    # Nothing is sent while the panel is hidden, showing it catches up
+    if hidden:
+        return no_update, no_update, no_update, no_update
+    page = page or 1
+    filters = dict(
+        origin=origin,
+        endpoint=endpoint,
+        node_id=int(node_id) if node_id is not None else None,
+        text=text or None,
+    )
+    query = {**filters, "window": window_min, "page": page}
+    cursor = cursor if cursor and cursor["query"] == query else {}
+    result = mqtt_logger.query(
+        **filters,
+        start=time() - window_min * 60 if window_min else None,
+        page=page,
+        after=cursor.get("seq"),
+    )
+    page_size = mqtt_logger.PAGE_SIZE
+    pages = max(-(-result.total // page_size), 1)
+    endpoints = mqtt_logger.endpoints()
+    if not result.incremental:
+        cursor = {"seq": result.cursor, "shown": len(result.logs), "query": query}
+        return result.logs, cursor, pages, endpoints
+    # Older pages stay as first read, only the newest one follows new messages
+    if page > 1 or not result.logs:
+        return no_update, {**cursor, "seq": result.cursor}, pages, endpoints
+
+    patch = Patch()
+    patch.extend(result.logs)
+    # Drop the oldest entries so the page keeps no more than `page_size`
+    shown = cursor["shown"] + len(result.logs)
+    for _ in range(shown - page_size):
+        del patch[0]
+    cursor = {"seq": result.cursor, "shown": min(shown, page_size), "query": query}
+    return patch, cursor, pages, endpoints
 
 
 @callback(Output("hidden-output-dump", "hidden"), Input("topology-btn", "n_clicks"))
@@ -313,12 +556,15 @@ def force_topology_update(n_clicks):
     Output("hidden-output-dump", "children"), Input("interval-component", "n_intervals")
 )
 def update_measurements(n_intervals):
+    # Polling fallback for when the background refresh thread is not running
+    if sensors.background_refresh_running:
+        return
     if not (n_intervals and (n_intervals % 20)):
         sensors.update_measurements()
 
 
 @callback(
-    Output("logs-stack", "hidden"),
+    Output("logs-panel", "hidden"),
     Output("logs-container", "style"),
     Output("log-btn", "children"),
     State("logs-container", "style"),
@@ -344,7 +590,6 @@ def toggle_logs_display(style, n_clicks):
     Input("interval-component", "n_intervals"),
 )
 def update_mesh_params(n_intervals):
-    mesh_control.check_conn and client.publish(consts.CHECK_CONN_TOPIC)
     mesh_name, network_name, conn_status = mesh_control.get_mesh_status()
     color_str = "success" if conn_status == consts.ConnStatuses.CONNECTED else "danger"
     return mesh_name, network_name, conn_status, color_str
@@ -352,4 +597,21 @@ def update_mesh_params(n_intervals):
 
 if __name__ == "__main__":
     client.connect()
-    app.run(debug=False)
+    mesh_control.start()
+    if broker:
+        simulator = MeshSimulator(
+            broker.transport(client_id="iop-simulated-bridge"), nodes=simulated_nodes
+        )
+        simulator.connect()
+        Thread(
+            target=simulator.run,
+            args=(float("inf"),),
+            name="mesh-simulator",
+            daemon=True,
+        ).start()
+    sensors.start_background_refresh()
+    sensors.start_background_compaction()
+    try:
+        app.run(debug=False)
+    finally:
+        mesh_graph.history.close()
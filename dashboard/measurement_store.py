@@ -0,0 +1,401 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class _NodeIndex:
+    """Row numbers of one node's readings, kept sorted by timestamp.
+
+    Readers only go through `published`, a (rows, timestamps) pair of views
+    swapped in one assignment once an extend is complete. The writer never
+    mutates rows already published: appends go past the published end and
+    late readings are merged into fresh arrays.
+    """
+
+    rows: np.ndarray
+    timestamps: np.ndarray
+    size: int
+    published: Tuple[np.ndarray, np.ndarray]
+    # One past the last row of the latest merged extend: rows from there on
+    # were only appended, so they form a tail of the index
+    merged_until: int
+
+    def __init__(self):
+        self.rows = np.empty(64, dtype=np.int64)
+        self.timestamps = np.empty(64, dtype="datetime64[ns]")
+        self.size = 0
+        self.published = (self.rows[:0], self.timestamps[:0])
+        self.merged_until = 0
+
+    def extend(self, rows: np.ndarray, timestamps: np.ndarray):
+        order = np.argsort(timestamps, kind="stable")
+        rows, timestamps = rows[order], timestamps[order]
+        required = self.size + len(rows)
+
+        if self.size and timestamps[0] < self.timestamps[self.size - 1]:
+            # Late reading: merge the two sorted runs instead of appending
+            merged_ts = np.concatenate((self.timestamps[: self.size], timestamps))
+            merged_rows = np.concatenate((self.rows[: self.size], rows))
+            order = np.argsort(merged_ts, kind="stable")
+            self.timestamps = merged_ts[order]
+            self.rows = merged_rows[order]
+            self.merged_until = int(rows.max()) + 1
+        else:
+            if required > len(self.rows):
+                capacity = max(required, 2 * len(self.rows))
+                self.rows = np.resize(self.rows, capacity)
+                self.timestamps = np.resize(self.timestamps, capacity)
+            self.timestamps[self.size : required] = timestamps
+            self.rows[self.size : required] = rows
+        self.size = required
+        self.published = (self.rows[:required], self.timestamps[:required])
+
+    def select(self, start=None, end=None) -> np.ndarray:
+        rows, timestamps = self.published
+        lo = np.searchsorted(timestamps, start, "left") if start is not None else 0
+        hi = np.searchsorted(timestamps, end, "right") if end is not None else len(rows)
+        return rows[lo:hi]
+
+    def tail_since(self, first_row: int, start=None, end=None) -> Optional[np.ndarray]:
+        """Rows appended at or after `first_row`, or None if any of them was
+        merged before older readings (i.e. they are not a pure tail)."""
+        # Published after `merged_until` is set, so read first
+        rows, timestamps = self.published
+        if first_row < self.merged_until:
+            return None
+        # Rows before `first_row` are all ahead of the tail: bisect for it
+        # instead of scanning the node's history
+        lo, hi = 0, len(rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rows[mid] < first_row:
+                lo = mid + 1
+            else:
+                hi = mid
+        tail = slice(lo, len(rows))
+        keep = np.ones(len(rows) - lo, dtype=bool)
+        if start is not None:
+            keep &= timestamps[tail] >= start
+        if end is not None:
+            keep &= timestamps[tail] <= end
+        return rows[tail][keep]
+
+
+class MeasurementStore:
+    """Append-optimized columnar store for the `measurements` table.
+
+    Every column lives in a preallocated NumPy array that grows geometrically,
+    so appends are amortized O(1) and readers get `[:size]` views instead of
+    copies. Node names are dictionary-encoded into `_name_codes`, and each
+    node keeps a timestamp-sorted `_NodeIndex` so selections never scan or
+    sort the whole history.
+    """
+
+    INITIAL_CAPACITY: int = 4096
+    GROWTH_FACTOR: int = 2
+
+    MEASUREMENTS = ("temperature", "humidity", "luminosity", "hazardous gas warning")
+    _dtypes = {
+        "id": np.int64,
+        "node id": np.int64,
+        "name code": np.int32,
+        "temperature": np.float64,
+        "humidity": np.float64,
+        "luminosity": np.float64,
+        "hazardous gas warning": np.float64,
+        "timestamp": "datetime64[ns]",
+    }
+
+    _columns: Dict[str, np.ndarray]
+    _size: int
+    _names: List[Optional[str]]
+    _name_codes: Dict[Optional[str], int]
+    _name_first_node_id: List[int]
+    _node_index: Dict[int, _NodeIndex]
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self._columns = {
+            name: np.empty(capacity, dtype=dtype)
+            for name, dtype in self._dtypes.items()
+        }
+        self._size = 0
+        self._names = []
+        self._name_codes = {}
+        self._name_first_node_id = []
+        self._node_index = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._columns["id"])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self._columns.values())
+
+    @property
+    def latest_id(self) -> int:
+        return int(self._columns["id"][self._size - 1]) if self._size else 0
+
+    def _reserve(self, extra_rows: int):
+        required = self._size + extra_rows
+        if required <= self.capacity:
+            return
+        new_capacity = max(self.capacity, 1)
+        while new_capacity < required:
+            new_capacity *= self.GROWTH_FACTOR
+        for name, column in self._columns.items():
+            grown = np.empty(new_capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            self._columns[name] = grown
+
+    def _encode_names(self, node_names: Sequence, node_ids: np.ndarray) -> np.ndarray:
+        batch_codes, batch_names = pd.factorize(
+            pd.Series(node_names, dtype=object), use_na_sentinel=False
+        )
+        _, first_rows = np.unique(batch_codes, return_index=True)
+        mapping = np.empty(len(batch_names), dtype=np.int32)
+        for batch_code, name in enumerate(batch_names):
+            name = None if pd.isna(name) else name
+            code = self._name_codes.get(name)
+            if code is None:
+                code = self._name_codes[name] = len(self._names)
+                self._names.append(name)
+                self._name_first_node_id.append(int(node_ids[first_rows[batch_code]]))
+            mapping[batch_code] = code
+        return mapping[batch_codes]
+
+    def append_columns(
+        self,
+        ids: np.ndarray,
+        node_ids: np.ndarray,
+        node_names: Sequence,
+        measurements: Dict[str, np.ndarray],
+        timestamps: np.ndarray,
+    ):
+        rows = len(ids)
+        if not rows:
+            return
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        self._reserve(rows)
+        new_rows = slice(self._size, self._size + rows)
+
+        self._columns["id"][new_rows] = ids
+        self._columns["node id"][new_rows] = node_ids
+        self._columns["name code"][new_rows] = self._encode_names(node_names, node_ids)
+        for meas in self.MEASUREMENTS:
+            self._columns[meas][new_rows] = measurements[meas]
+        self._columns["timestamp"][new_rows] = timestamps
+
+        self._index_nodes(new_rows)
+        self._size += rows
+
+    def _index_nodes(self, new_rows: slice):
+        node_ids = self._columns["node id"][new_rows]
+        timestamps = self._columns["timestamp"][new_rows]
+        rows = np.arange(new_rows.start, new_rows.stop, dtype=np.int64)
+
+        order = np.argsort(node_ids, kind="stable")
+        unique_ids, starts = np.unique(node_ids[order], return_index=True)
+        # Keep first-seen order so node listings stay stable
+        for node_id, group in sorted(
+            zip(unique_ids.tolist(), np.split(order, starts[1:])),
+            key=lambda item: item[1][0],
+        ):
+            node_index = self._node_index.get(node_id)
+            if node_index is None:
+                node_index = self._node_index[node_id] = _NodeIndex()
+            node_index.extend(rows[group], timestamps[group])
+
+    def append_records(self, records: Sequence[tuple]):
+        """Append rows in `SELECT * FROM measurements` column order."""
+        if not records:
+            return
+        ids, node_ids, node_names, temp, hum, lum, gas, timestamps = zip(*records)
+        self.append_columns(
+            ids=np.array(ids, dtype=np.int64),
+            node_ids=np.array(node_ids, dtype=np.int64),
+            node_names=node_names,
+            measurements=dict(zip(self.MEASUREMENTS, (temp, hum, lum, gas))),
+            timestamps=pd.to_datetime(timestamps).values,
+        )
+
+    @staticmethod
+    def _column_path(directory: str, name: str) -> str:
+        return os.path.join(directory, name.replace(" ", "_") + ".npy")
+
+    def save(self, directory: str, size: Optional[int] = None):
+        """Write the first `size` rows to `directory` as memory-mappable .npy files.
+
+        The snapshot is written next to `directory` and swapped in with
+        renames, so a concurrent `load` sees either the old or the new one.
+        Columns get headroom past `size` (left as file holes) so a loaded
+        store can take appends without copying the history into memory.
+        """
+        size = self._size if size is None else size
+        capacity = max(size * self.GROWTH_FACTOR, self.INITIAL_CAPACITY)
+        staging = f"{directory}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        for name, column in self._columns.items():
+            mapped = np.lib.format.open_memmap(
+                self._column_path(staging, name),
+                mode="w+",
+                dtype=column.dtype,
+                shape=(capacity,),
+            )
+            mapped[:size] = column[:size]
+            mapped.flush()
+            del mapped
+
+        node_ids, offsets, index_rows, index_timestamps = [], [0], [], []
+        for node_id, node_index in list(self._node_index.items()):
+            rows, timestamps = node_index.published
+            visible = rows < size
+            node_ids.append(node_id)
+            index_rows.append(rows[visible])
+            index_timestamps.append(timestamps[visible])
+            offsets.append(offsets[-1] + int(np.count_nonzero(visible)))
+        np.save(
+            os.path.join(staging, "index_rows.npy"),
+            np.concatenate(index_rows) if index_rows else np.empty(0, np.int64),
+        )
+        np.save(
+            os.path.join(staging, "index_timestamps.npy"),
+            (
+                np.concatenate(index_timestamps)
+                if index_timestamps
+                else np.empty(0, "datetime64[ns]")
+            ),
+        )
+
+        names_count = len(self._names)
+        with open(os.path.join(staging, "meta.json"), "w") as meta_file:
+            json.dump(
+                {
+                    "size": size,
+                    "latest_id": int(self._columns["id"][size - 1]) if size else 0,
+                    "names": self._names[:names_count],
+                    "name_first_node_id": self._name_first_node_id[:names_count],
+                    "node_ids": node_ids,
+                    "node_offsets": offsets,
+                },
+                meta_file,
+            )
+
+        previous = f"{directory}.old"
+        shutil.rmtree(previous, ignore_errors=True)
+        if os.path.exists(directory):
+            os.rename(directory, previous)
+        os.rename(staging, directory)
+        shutil.rmtree(previous, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str) -> "MeasurementStore":
+        """Memory-map a snapshot written by `save`.
+
+        Columns are mapped copy-on-write: pages are read lazily and appends
+        never modify the files on disk.
+        """
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+
+        store = cls(capacity=0)
+        store._columns = {
+            name: np.load(cls._column_path(directory, name), mmap_mode="c")
+            for name in cls._dtypes
+        }
+        store._size = meta["size"]
+        store._names = meta["names"]
+        store._name_codes = {name: code for code, name in enumerate(store._names)}
+        store._name_first_node_id = meta["name_first_node_id"]
+
+        index_rows = np.load(os.path.join(directory, "index_rows.npy"), mmap_mode="c")
+        index_timestamps = np.load(
+            os.path.join(directory, "index_timestamps.npy"), mmap_mode="c"
+        )
+        offsets = meta["node_offsets"]
+        for position, node_id in enumerate(meta["node_ids"]):
+            node_slice = slice(offsets[position], offsets[position + 1])
+            node_index = _NodeIndex()
+            # Exactly full: the first extend reallocates instead of writing
+            # into the next node's part of the shared arrays
+            node_index.rows = index_rows[node_slice]
+            node_index.timestamps = index_timestamps[node_slice]
+            node_index.size = len(node_index.rows)
+            node_index.published = (node_index.rows, node_index.timestamps)
+            store._node_index[node_id] = node_index
+        return store
+
+    def column(self, name: str) -> np.ndarray:
+        return self._columns[name][: self._size]
+
+    def select_by_node(
+        self, node_ids: Sequence[int], start=None, end=None, size: Optional[int] = None
+    ) -> List[np.ndarray]:
+        """Per-node row numbers within [start, end], each ordered by timestamp.
+
+        `size` hides rows appended after a reader took its snapshot.
+        """
+        slices = [
+            self._node_index[node_id].select(start, end)
+            for node_id in node_ids
+            if node_id in self._node_index
+        ]
+        if size is not None:
+            slices = [rows[rows < size] for rows in slices]
+        return slices
+
+    def tails_since(
+        self,
+        node_ids: Sequence[int],
+        first_row: int,
+        start=None,
+        end=None,
+        size: Optional[int] = None,
+    ) -> Optional[List[np.ndarray]]:
+        """Per-node rows appended since `first_row` that extend each node's
+        series at its end, or None if some arrived out of timestamp order."""
+        tails = []
+        for node_id in node_ids:
+            if node_id not in self._node_index:
+                continue
+            tail = self._node_index[node_id].tail_since(first_row, start, end)
+            if tail is None:
+                return None
+            tails.append(tail[tail < size] if size is not None else tail)
+        return tails
+
+    def merge(self, slices: List[np.ndarray]) -> np.ndarray:
+        """Merge timestamp-sorted row slices into one timestamp-sorted array."""
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate(slices)
+        if len(slices) > 1:
+            # Timsort merges the pre-sorted per-node runs without a full sort
+            timestamps = self._columns["timestamp"][rows]
+            rows = rows[np.argsort(timestamps, kind="stable")]
+        return rows
+
+    def select(self, node_ids: Sequence[int], start=None, end=None) -> np.ndarray:
+        """Row numbers for `node_ids` within [start, end], ordered by timestamp."""
+        return self.merge(self.select_by_node(node_ids, start, end))
+
+    def names(self, codes: np.ndarray) -> np.ndarray:
+        return np.array(self._names, dtype=object)[codes]
+
+    def nodes(self) -> List[Dict]:
+        return [
+            {"node name": name, "node id": node_id}
+            for name, node_id in zip(self._names, self._name_first_node_id)
+        ]
+
+    def node_ids(self) -> List[int]:
+        return list(self._node_index)
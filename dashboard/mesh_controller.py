@@ -1,44 +1,138 @@
+from typing import Callable, Dict, Iterable, NamedTuple, Optional
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+
 from consts import ConnStatuses
+from timer_wheel import TimerWheel
+
+
+class MeshStatus(NamedTuple):
+    mesh_name: str
+    network_name: str
+    conn_status: ConnStatuses
 
 
 class MeshController:
-    MAX_WAIT_TIME: int = 60
+    """Connection status of the bridge and last-seen time of every node.
+
+    Every message from the mesh refreshes the bridge, measurements and
+    topology reports refresh the nodes they come from. Deadlines live in a
+    timer wheel that a background thread advances once a tick, so going
+    silent is noticed whether or not a dashboard is open, and each tick
+    only costs the deadlines that fall in it. Nodes silent for FORGET_AFTER_S
+    (e.g. taken out of the mesh for good) are forgotten.
+    """
+
+    # Silence after which the bridge is considered disconnected and probed
+    BRIDGE_TIMEOUT_S: float = 180
+    # Three missed reports of sensor.cpp, which sends one every 30 s
+    NODE_TIMEOUT_S: float = 90
+    FORGET_AFTER_S: float = 24 * 3600
+    TICK_S: float = TimerWheel.TICK_S
 
     _has_been_updated: bool
-    _network_name: str
-    _mesh_name: str
-    _time_since_last_message: int
-    _conn_status: ConnStatuses
-
-    def __init__(self):
-        self._conn_status = ConnStatuses.DISCONNECTED
-        self._network_name = ''
-        self._mesh_name = ''
-        self._time_since_last_message = self.MAX_WAIT_TIME - 1
+    # Replaced as a whole, so readers never see half of an update
+    _status: MeshStatus
+    _wheel: TimerWheel
+    _last_seen: Dict[str, float]
+    _stale: Dict[str, float]
+    _liveness_version: int
+    _forget_after_s: float
+    _on_bridge_silent: Optional[Callable[[], None]]
+    _thread: Optional[Thread]
+    _lock: Lock
+
+    def __init__(self, forget_after_s: float = FORGET_AFTER_S):
+        self._status = MeshStatus("", "", ConnStatuses.DISCONNECTED)
         self._has_been_updated = False
+        self._wheel = TimerWheel(now=monotonic(), tick_s=self.TICK_S)
+        # The bridge is keyed by None; probe it on the first tick
+        self._wheel.schedule(None, monotonic())
+        self._last_seen = {}
+        self._stale = {}
+        self._liveness_version = 0
+        self._forget_after_s = forget_after_s
+        self._on_bridge_silent = None
+        self._thread = None
+        self._lock = Lock()
+
+    def on_bridge_silent(self, callback: Callable[[], None]):
+        """Call `callback` every BRIDGE_TIMEOUT_S while nothing comes from
+        the mesh (e.g. to send the bridge a hello)."""
+        self._on_bridge_silent = callback
+
+    def start(self):
+        self._thread = Thread(target=self._expire, name="mesh-liveness", daemon=True)
+        self._thread.start()
+
+    def _expire(self):
+        while True:
+            sleep(self.TICK_S)
+            now = monotonic()
+            bridge_silent = False
+            with self._lock:
+                for key in self._wheel.advance(now):
+                    if key is None:
+                        bridge_silent = True
+                        self._status = self._status._replace(
+                            conn_status=ConnStatuses.DISCONNECTED
+                        )
+                        self._wheel.schedule(None, now + self.BRIDGE_TIMEOUT_S)
+                    elif key in self._stale:
+                        del self._stale[key]
+                        del self._last_seen[key]
+                        self._liveness_version += 1
+                    else:
+                        self._stale[key] = self._last_seen[key]
+                        self._liveness_version += 1
+                        # Still stale by then: forget it
+                        self._wheel.schedule(
+                            key, now + self._forget_after_s - self.NODE_TIMEOUT_S
+                        )
+            if bridge_silent:
+                self._has_been_updated = True
+                if self._on_bridge_silent:
+                    self._on_bridge_silent()
 
     def refresh_connection_status(self):
-        self._conn_status = ConnStatuses.CONNECTED
-        self._time_since_last_message = 0
+        with self._lock:
+            self._status = self._status._replace(conn_status=ConnStatuses.CONNECTED)
+            self._wheel.schedule(None, monotonic() + self.BRIDGE_TIMEOUT_S)
+
+    def nodes_seen(self, node_ids: Iterable[str]):
+        """Refresh the last-seen time of nodes just heard from."""
+        now, deadline = time(), monotonic() + self.NODE_TIMEOUT_S
+        with self._lock:
+            for node_id in node_ids:
+                self._last_seen[node_id] = now
+                self._wheel.schedule(node_id, deadline)
+                if self._stale.pop(node_id, None) is not None:
+                    self._liveness_version += 1
 
     def update_mesh_status(self, mesh_name: str, network_name: str):
-        self._mesh_name = mesh_name
-        self._network_name = network_name
+        with self._lock:
+            self._status = self._status._replace(
+                mesh_name=mesh_name, network_name=network_name
+            )
         self._has_been_updated = True
 
-    def get_mesh_status(self):
-        return self._mesh_name, self._network_name, self._conn_status
+    def get_mesh_status(self) -> MeshStatus:
+        return self._status
+
+    def last_seen(self, node_id: str) -> Optional[float]:
+        """Epoch seconds the node was last heard from, None if never."""
+        return self._last_seen.get(node_id)
+
+    def stale_nodes(self) -> Dict[str, float]:
+        """Nodes silent for over NODE_TIMEOUT_S, with their last-seen time."""
+        with self._lock:
+            return dict(self._stale)
+
+    @property
+    def liveness_version(self) -> int:
+        """Changes whenever a node goes stale or is heard from again."""
+        return self._liveness_version
 
     @property
     def has_been_updated(self):
         return self._has_been_updated
-    
-    @property
-    def check_conn(self):
-        if self._time_since_last_message > self.MAX_WAIT_TIME:
-            self._time_since_last_message = 0
-            self._conn_status = ConnStatuses.DISCONNECTED
-            return True
-        self._time_since_last_message += 1
-        return False
-        
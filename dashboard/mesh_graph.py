@@ -1,83 +1,370 @@
+from typing import Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+from bisect import bisect_right, insort
+from collections import OrderedDict, deque
+from hashlib import sha1
+from json import dumps
+from threading import Lock
+from time import time
+
+from dash import Patch, no_update
+from networkx import Graph, bfs_edges
+
+from mesh_health import MeshHealth
+from topology_history import TopologyHistory
+
+
+class ElementDiff(NamedTuple):
+    """Turns one version of the Cytoscape element list into the next.
+
+    Applied in field order: replace elements in place, delete positions
+    (highest first) and append new elements.
+    """
+
+    replaced: List[Tuple[int, Dict]]
+    removed: List[int]
+    added: List[Dict]
 
-from typing import Dict, List
-from networkx import Graph
 
 class MeshGraph:
+    # Versions a client may lag behind and still receive only the changes
+    DIFF_HISTORY: int = 32
+    # Tree layout grid, in Cytoscape model units
+    LEVEL_SPACING: float = 120
+    SIBLING_SPACING: float = 80
+    LAYOUT_CACHE_SIZE: int = 16
+
     _mesh_graph: Graph
     _name_map: Dict
     _cytoscape_elements: List
     _cytoscape_root: str
     _has_been_updated: bool
+    _topology_hash: Optional[str]
+    _version: int
+    _diffs: Deque[Tuple[int, ElementDiff]]
+    _positions: Dict[str, Tuple[float, float]]
+    _layouts: OrderedDict[str, Dict[str, Tuple[float, float]]]
+    _history: Optional[TopologyHistory]
+    _health: MeshHealth
+    _lock: Lock
 
-    def __init__(self):
+    def __init__(self, history: Optional[TopologyHistory] = None):
         self._mesh_graph = Graph()
         self._name_map = None
         self._cytoscape_elements = []
         self._cytoscape_root = ""
         self._has_been_updated = False
+        self._topology_hash = None
+        self._version = 0
+        self._diffs = deque(maxlen=self.DIFF_HISTORY)
+        self._positions = {}
+        self._layouts = OrderedDict()
+        self._history = history
+        self._health = MeshHealth()
+        self._lock = Lock()
 
-    def _recursive_graph_parser(self, node: Dict):
-        node_id = str(node["nodeId"])
-        is_root = bool(node.get("root"))
-        neighbor_nodes = node.get("subs")
+    def _graph_parser(self, root: Dict) -> Tuple[Dict[str, Tuple], Set[Tuple]]:
+        """Nodes (id -> (label, is_root)) and edges of the tree under `root`.
 
-        node_id_padded = node_id.zfill(10)
-        node_name = self._name_map.get(node_id)
-        label = node_name if node_name else node_id_padded
+        Iterative, so a long relay chain cannot hit the recursion limit.
+        """
+        nodes = {}
+        edges = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            node_id = str(node["nodeId"])
+            is_root = bool(node.get("root"))
+            neighbor_nodes = node.get("subs") or []
 
-        self._mesh_graph.add_node(node_id, label=label, is_root=is_root)
+            node_id_padded = node_id.zfill(10)
+            node_name = self._name_map.get(node_id)
+            label = node_name if node_name else node_id_padded
 
-        if neighbor_nodes:
-            self._mesh_graph.add_edges_from(
-                [
-                    (node_id, str(neighbor["nodeId"]))
-                    for neighbor in neighbor_nodes
-                ]
-            )
+            nodes[node_id] = (label, is_root)
             for neighbor in neighbor_nodes:
-                self._recursive_graph_parser(node=neighbor)
-
-    def _update_cytoscape(self):
-        root_id = [
-            node_id
-            for node_id, node_data in self._mesh_graph.nodes(data=True)
-            if node_data["is_root"]
-        ][0]
-
-        cytoscape_nodes = [
-            {
-                "data": {
-                    "id": node_id,
-                    "label": node_data["label"],
-                    "root": node_data["is_root"],
-                },
-                'grabbable': False
-            }
-            for node_id, node_data in self._mesh_graph.nodes(data=True)
-        ]
+                # Sorted, like networkx's undirected edges, the direction of a
+                # link is the same however it was reported
+                edges.add(tuple(sorted((node_id, str(neighbor["nodeId"])))))
+            stack.extend(neighbor_nodes)
+        return nodes, edges
+
+    @staticmethod
+    def _node_element(
+        node_id: str,
+        label: str,
+        is_root: bool,
+        position: Tuple[float, float],
+        stats: Dict,
+    ) -> Dict:
+        return {
+            "data": {
+                "id": node_id,
+                "label": label,
+                "root": is_root,
+                "depth": stats["depth"],
+                "relayed": stats["relayed"],
+                # A number, which is what Cytoscape selectors compare
+                "articulation": int(stats["articulation"]),
+            },
+            "position": {"x": position[0], "y": position[1]},
+            "grabbable": False,
+        }
+
+    @staticmethod
+    def _edge_element(edge: Tuple[str, str]) -> Dict:
+        return {"data": {"source": edge[0], "target": edge[1]}}
+
+    @staticmethod
+    def _element_key(element: Dict) -> Tuple:
+        data = element["data"]
+        return (
+            ("node", data["id"]) if "id" in data else (data["source"], data["target"])
+        )
+
+    def _tree_children(self, root_id: str) -> Dict[str, List[str]]:
+        children = {}
+        for parent, child in bfs_edges(self._mesh_graph, root_id):
+            children.setdefault(parent, []).append(child)
+        for siblings in children.values():
+            siblings.sort()
+        return children
+
+    def _full_layout(self, root_id: str) -> Dict[str, Tuple[float, float]]:
+        """Tree layout: one row per hop from the root, leaves side by side
+        and every parent centered over its children."""
+        children = self._tree_children(root_id)
+        positions = {}
+        next_leaf = 0
+        stack = [(root_id, 0, False)]
+        while stack:
+            node_id, depth, expanded = stack.pop()
+            node_children = children.get(node_id, [])
+            if node_children and not expanded:
+                # Revisited once all its children have been placed
+                stack.append((node_id, depth, True))
+                stack.extend((child, depth + 1, False) for child in node_children[::-1])
+                continue
+            if node_children:
+                first, last = positions[node_children[0]], positions[node_children[-1]]
+                x = (first[0] + last[0]) / 2
+            else:
+                x = next_leaf * self.SIBLING_SPACING
+                next_leaf += 1
+            positions[node_id] = (x, depth * self.LEVEL_SPACING)
+        return positions
+
+    def _place_new_nodes(self, root_id: str) -> Dict[str, Tuple[float, float]]:
+        """Previous positions of the nodes still present, plus a free spot
+        for every new node next to its siblings, one row below its parent."""
+        positions = {
+            node_id: position
+            for node_id, position in self._positions.items()
+            if node_id in self._mesh_graph
+        }
+        if root_id not in positions:
+            return self._full_layout(root_id)
+
+        rows = {}
+        for x, y in positions.values():
+            insort(rows.setdefault(y, []), x)
+        children = self._tree_children(root_id)
+        # Breadth first, so a new node's parent always has a position already
+        for parent, child in bfs_edges(self._mesh_graph, root_id):
+            if child in positions:
+                continue
+            parent_x, parent_y = positions[parent]
+            y = parent_y + self.LEVEL_SPACING
+            siblings = [positions[s][0] for s in children[parent] if s in positions]
+            x = max(siblings) + self.SIBLING_SPACING if siblings else parent_x
+            row = rows.setdefault(y, [])
+            # Slide right past every node closer than SIBLING_SPACING
+            index = bisect_right(row, x - self.SIBLING_SPACING)
+            while index < len(row) and row[index] < x + self.SIBLING_SPACING:
+                x = row[index] + self.SIBLING_SPACING
+                index += 1
+            insort(row, x)
+            positions[child] = (x, y)
+        return positions
+
+    def _layout(self, root_id: str, topology_hash: str) -> Dict:
+        positions = self._layouts.get(topology_hash)
+        if positions is None:
+            positions = self._place_new_nodes(root_id)
+            self._layouts[topology_hash] = positions
+            if len(self._layouts) > self.LAYOUT_CACHE_SIZE:
+                self._layouts.popitem(last=False)
+        self._layouts.move_to_end(topology_hash)
+        return positions
+
+    def _update_cytoscape(
+        self, nodes: Dict[str, Tuple], edges: Set[Tuple], topology_hash: str
+    ):
+        """Bring the graph, layout and element list to `nodes` and `edges`,
+        recording only what changed as a new version."""
+        old_nodes = set(self._mesh_graph.nodes())
+        old_edges = {tuple(sorted(edge)) for edge in self._mesh_graph.edges()}
+        self._mesh_graph.remove_edges_from(old_edges - edges)
+        self._mesh_graph.remove_nodes_from(old_nodes - nodes.keys())
+        for node_id, (label, is_root) in nodes.items():
+            self._mesh_graph.add_node(node_id, label=label, is_root=is_root)
+        self._mesh_graph.add_edges_from(edges - old_edges)
+
+        root_id = [node_id for node_id, (_, is_root) in nodes.items() if is_root][0]
+        parents = {root_id: None}
+        parents.update(
+            (child, parent) for parent, child in bfs_edges(self._mesh_graph, root_id)
+        )
+        self._health.apply(parents)
+        self._positions = self._layout(root_id, topology_hash)
+        node_elements = {
+            node_id: self._node_element(
+                node_id,
+                *attrs,
+                self._positions[node_id],
+                self._health.stats(node_id),
+            )
+            for node_id, attrs in nodes.items()
+        }
 
-        cytoscape_edges = [
-            {"data": {"source": edge[0], "target": edge[1]}}
-            for edge in self._mesh_graph.edges()
-        ]
+        replaced = []
+        removed = []
+        for position, element in enumerate(self._cytoscape_elements):
+            key = self._element_key(element)
+            if key[0] != "node":
+                if key not in edges:
+                    removed.append(position)
+            elif key[1] not in nodes:
+                removed.append(position)
+            elif element != node_elements[key[1]]:
+                replaced.append((position, node_elements[key[1]]))
+        added = [
+            node_elements[node_id] for node_id in sorted(nodes.keys() - old_nodes)
+        ] + [self._edge_element(edge) for edge in sorted(edges - old_edges)]
+        removed.reverse()
+
+        elements = list(self._cytoscape_elements)
+        for position, element in replaced:
+            elements[position] = element
+        for position in removed:
+            del elements[position]
+        elements.extend(added)
+        self._cytoscape_elements = elements
 
-        self._cytoscape_elements = cytoscape_nodes + cytoscape_edges
         self._cytoscape_root = '[id = "' + root_id + '"]'
+        self._version += 1
+        self._diffs.append((self._version, ElementDiff(replaced, removed, added)))
 
     def update_graph(self, mesh_tree_root: Dict, name_map: Dict):
-        self._mesh_graph.clear()
+        """Apply a topology report; a report identical to the last one, up to
+        the order nodes were listed in, changes nothing."""
         self._name_map = name_map
-        self._recursive_graph_parser(node=mesh_tree_root)
-        self._update_cytoscape()
+        nodes, edges = self._graph_parser(root=mesh_tree_root)
+        if not any(is_root for _, is_root in nodes.values()):
+            # A mesh without a root node: the tree is laid out from the node
+            # at its top, the bridge that sent it
+            top_id = str(mesh_tree_root["nodeId"])
+            print(f"Topology report has no root, showing {top_id} as the root")
+            nodes[top_id] = (nodes[top_id][0], True)
+        topology_hash = self._hash(nodes, edges)
+        with self._lock:
+            if topology_hash == self._topology_hash:
+                return
+            self._update_cytoscape(nodes, edges, topology_hash)
+            # Only once applied, so a report that failed is tried again
+            self._topology_hash = topology_hash
+        if self._history is not None:
+            self._history.record(time(), nodes, edges)
         self._has_been_updated = True
 
+    @staticmethod
+    def _hash(nodes: Dict[str, Tuple], edges: Set[Tuple]) -> str:
+        canonical = dumps([sorted(nodes.items()), sorted(edges)])
+        return sha1(canonical.encode()).hexdigest()
+
+    def elements_at(self, timestamp: float) -> List[Dict]:
+        """Cytoscape elements of the topology recorded at `timestamp`, laid
+        out around the current positions. Empty without a history."""
+        topology = self._history.at(timestamp) if self._history else None
+        if topology is None:
+            return []
+        nodes, edges = topology
+        replay = MeshGraph()
+        with self._lock:
+            replay._positions = dict(self._positions)
+        replay._update_cytoscape(nodes, edges, self._hash(nodes, edges))
+        return replay._cytoscape_elements
+
     def get_cytospace_params(self):
         return self._cytoscape_elements, self._cytoscape_root
 
+    def get_cytoscape_update(self, client_version: Optional[int]) -> Tuple[object, int]:
+        """Elements update for a client showing `client_version`, and the
+        version it brings the client to.
+
+        `no_update` when the client is current, a `Patch` with only the
+        changed elements when its version is recent enough, and the whole
+        element list (a `list`) otherwise.
+        """
+        with self._lock:
+            if client_version == self._version:
+                return no_update, self._version
+            # A client that showed nothing yet needs a full layout anyway
+            if not client_version:
+                return list(self._cytoscape_elements), self._version
+            diffs = [diff for version, diff in self._diffs if version > client_version]
+            if len(diffs) != self._version - client_version:
+                return list(self._cytoscape_elements), self._version
+
+            patch = Patch()
+            for diff in diffs:
+                for position, element in diff.replaced:
+                    patch[position] = element
+                for position in diff.removed:
+                    del patch[position]
+                if diff.added:
+                    patch.extend(diff.added)
+            return patch, self._version
+
+    @property
+    def cytoscape_root(self) -> str:
+        return self._cytoscape_root
+
+    def node_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._mesh_graph)
+
+    def node_label(self, node_id: str) -> str:
+        node = self._mesh_graph.nodes.get(node_id)
+        return node["label"] if node else node_id.zfill(10)
+
+    def hop_depth(self, node_id: str) -> Optional[int]:
+        return self._health.hop_depth(node_id)
+
+    def relayed(self, node_id: str) -> Optional[int]:
+        return self._health.relayed(node_id)
+
+    def articulation_points(self) -> Set[str]:
+        return self._health.articulation_points()
+
+    def health(self) -> Dict[str, Dict]:
+        """Hop depth, relayed nodes and articulation flag of every node."""
+        with self._lock:
+            return {
+                node_id: self._health.stats(node_id) for node_id in self._mesh_graph
+            }
+
+    @property
+    def history(self) -> Optional[TopologyHistory]:
+        return self._history
+
+    @property
+    def version(self) -> int:
+        return self._version
+
     @property
     def has_been_updated(self):
         return self._has_been_updated
-    
+
     @has_been_updated.setter
     def has_been_updated(self, state):
-        self._has_been_updated = state
\ No newline at end of file
+        self._has_been_updated = state
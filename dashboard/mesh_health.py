@@ -0,0 +1,127 @@
+from typing import Dict, Optional, Set
+
+
+class MeshHealth:
+    """Hop depth, relay load and single points of failure of the mesh tree.
+
+    painlessMesh reports a spanning tree, so a node relays the traffic of
+    every node below it and any relay (a node with children, or the root
+    with more than one) partitions the mesh when it fails. The stats are
+    updated from the nodes whose parent changed: moving a subtree costs its
+    size plus the depth of its old and new position.
+    """
+
+    _parent: Dict[str, Optional[str]]
+    _children: Dict[str, Set[str]]
+    _depth: Dict[str, int]
+    _relayed: Dict[str, int]
+    _articulation: Set[str]
+
+    def __init__(self):
+        self._parent = {}
+        self._children = {}
+        self._depth = {}
+        self._relayed = {}
+        self._articulation = set()
+
+    def _ancestors(self, node_id: str):
+        parent = self._parent.get(node_id)
+        while parent is not None:
+            yield parent
+            parent = self._parent.get(parent)
+
+    def _detach(self, node_id: str, changed: Set[str]):
+        parent = self._parent.get(node_id)
+        if parent is None:
+            return
+        moved = self._relayed[node_id] + 1
+        for ancestor in self._ancestors(node_id):
+            self._relayed[ancestor] -= moved
+            changed.add(ancestor)
+        self._children[parent].discard(node_id)
+        self._parent[node_id] = None
+
+    def _attach(self, node_id: str, parent: str, changed: Set[str]):
+        self._parent[node_id] = parent
+        self._children.setdefault(parent, set()).add(node_id)
+        moved = self._relayed[node_id] + 1
+        for ancestor in self._ancestors(node_id):
+            self._relayed[ancestor] += moved
+            changed.add(ancestor)
+
+    def _update_depths(self, node_id: str, changed: Set[str]):
+        parent = self._parent[node_id]
+        stack = [(node_id, self._depth[parent] + 1 if parent is not None else 0)]
+        while stack:
+            current, depth = stack.pop()
+            if self._depth.get(current) != depth:
+                self._depth[current] = depth
+                changed.add(current)
+            stack.extend(
+                (child, depth + 1) for child in self._children.get(current, ())
+            )
+
+    def _is_articulation(self, node_id: str) -> bool:
+        children = len(self._children.get(node_id, ()))
+        return children > 1 if self._parent.get(node_id) is None else children > 0
+
+    def apply(self, parents: Dict[str, Optional[str]]) -> Set[str]:
+        """Move to the tree given as node -> parent (None for the root) and
+        return the nodes whose stats changed."""
+        moved = {
+            node_id
+            for node_id in self._parent.keys() | parents.keys()
+            if node_id not in self._parent
+            or node_id not in parents
+            or self._parent[node_id] != parents[node_id]
+        }
+        changed = set()
+        for node_id in moved:
+            if node_id in self._parent:
+                old_parent = self._parent[node_id]
+                self._detach(node_id, changed)
+                if old_parent is not None:
+                    changed.add(old_parent)
+        for node_id in moved - parents.keys():
+            del self._parent[node_id], self._depth[node_id], self._relayed[node_id]
+            self._children.pop(node_id, None)
+            changed.discard(node_id)
+        for node_id in moved & parents.keys():
+            self._parent.setdefault(node_id, None)
+            self._relayed.setdefault(node_id, 0)
+            changed.add(node_id)
+        for node_id in moved & parents.keys():
+            if parents[node_id] is not None:
+                self._attach(node_id, parents[node_id], changed)
+
+        # Depths only change under moved nodes; start from the topmost ones
+        for node_id in moved & parents.keys():
+            if not any(ancestor in moved for ancestor in self._ancestors(node_id)):
+                self._update_depths(node_id, changed)
+
+        for node_id in changed:
+            if self._is_articulation(node_id):
+                self._articulation.add(node_id)
+            else:
+                self._articulation.discard(node_id)
+        self._articulation &= parents.keys()
+        return changed
+
+    def hop_depth(self, node_id: str) -> Optional[int]:
+        """Hops between the node and the root (the bridge)."""
+        return self._depth.get(node_id)
+
+    def relayed(self, node_id: str) -> Optional[int]:
+        """Number of nodes whose traffic goes through this one."""
+        return self._relayed.get(node_id)
+
+    def articulation_points(self) -> Set[str]:
+        """Nodes whose failure would split the mesh."""
+        return set(self._articulation)
+
+    def stats(self, node_id: str) -> Dict:
+        return {
+            "depth": self._depth[node_id],
+            "relayed": self._relayed[node_id],
+            "articulation": node_id in self._articulation,
+        }
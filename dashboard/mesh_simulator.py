@@ -0,0 +1,247 @@
+import heapq
+import json
+import random
+from typing import Dict, List, Optional, Tuple, Union
+from time import perf_counter, sleep
+
+from awscrt import mqtt
+
+import consts
+from chicken_udp import ChickenUDP
+
+# Message kinds, in the order they are emitted when due at the same time
+HELLO, TOPOLOGY, MEASUREMENT = range(3)
+
+
+class MeshSimulator:
+    """Stands in for the bridge and `nodes` sensor nodes of a painlessMesh.
+
+    Publishes what `mesh/src/bridge.cpp` publishes: every node's measurements
+    (a ChickenUDP frame the bridge checks, and packs again with the node's id
+    and name), the topology as a tree of the given fan-out and depth, and
+    hello acks. It also answers the dashboard's hello and topology requests.
+    With `churn`, that fraction of the nodes moves to another parent before
+    each topology report. With `binary`, nodes send binary ChickenUDP frames.
+    """
+
+    # sensor.cpp sends its averaged readings every 30 s
+    MEASUREMENT_INTERVAL_S: float = 30
+    MESH_NAME: str = "iop-simulated"
+    NETWORK_NAME: str = "iop-simulated-ap"
+    BRIDGE_ID: int = 1
+
+    _conn: mqtt.Connection
+    _cudp: ChickenUDP
+    _rng: random.Random
+    _parents: Dict[int, int]
+    _max_depth: Optional[int]
+    _fanout: int
+    _churn: float
+    _binary: bool
+    _intervals: Dict[int, Optional[float]]
+    _schedule: List[Tuple[float, int, int]]
+    _published: int
+
+    def __init__(
+        self,
+        conn: mqtt.Connection,
+        nodes: int,
+        fanout: int = 4,
+        depth: Optional[int] = None,
+        measurement_interval_s: float = MEASUREMENT_INTERVAL_S,
+        topology_interval_s: Optional[float] = 60,
+        hello_interval_s: Optional[float] = 60,
+        churn: float = 0.0,
+        binary: bool = False,
+        seed: int = 0,
+    ):
+        self._conn = conn
+        self._cudp = ChickenUDP()
+        self._rng = random.Random(seed)
+        self._fanout = fanout
+        self._max_depth = depth
+        self._churn = churn
+        self._binary = binary
+        self._parents = self._build_tree(nodes)
+        self._intervals = {
+            HELLO: hello_interval_s,
+            TOPOLOGY: topology_interval_s,
+            MEASUREMENT: measurement_interval_s,
+        }
+        self._published = 0
+
+        self._schedule = [(0.0, HELLO, 0), (0.0, TOPOLOGY, 0)]
+        # Nodes boot at different times, so their reports are spread out
+        self._schedule.extend(
+            (self._rng.uniform(0, measurement_interval_s), MEASUREMENT, node_id)
+            for node_id in self._parents
+        )
+        heapq.heapify(self._schedule)
+
+    def _build_tree(self, nodes: int) -> Dict[int, int]:
+        """Node -> parent, filling each level breadth first."""
+        parents = {}
+        level = [self.BRIDGE_ID]
+        depth = 0
+        next_id = self.BRIDGE_ID + 1
+        while len(parents) < nodes:
+            depth += 1
+            if self._max_depth is not None and depth > self._max_depth:
+                raise ValueError(
+                    f"{nodes} nodes do not fit {self._max_depth} levels"
+                    f" of fan-out {self._fanout}"
+                )
+            next_level = []
+            for parent in level:
+                for _ in range(self._fanout):
+                    if len(parents) == nodes:
+                        break
+                    parents[next_id] = parent
+                    next_level.append(next_id)
+                    next_id += 1
+            level = next_level
+        return parents
+
+    @staticmethod
+    def node_name(node_id: int) -> str:
+        return "bridge" if node_id == MeshSimulator.BRIDGE_ID else f"sensor-{node_id}"
+
+    def connect(self):
+        """Connect and answer the dashboard, as the bridge does on boot."""
+        self._conn.connect().result()
+        subscribe_future, _ = self._conn.subscribe(
+            "internet-of-poultry/dash/#",
+            qos=mqtt.QoS.AT_MOST_ONCE,
+            callback=self._on_request,
+        )
+        subscribe_future.result()
+
+    def _on_request(self, topic: str, payload: bytes, **kwargs):
+        if topic == consts.CHECK_CONN_TOPIC:
+            self.publish_hello()
+        elif topic == consts.TOPOLOGY_REQUEST_TOPIC:
+            self.publish_topology()
+
+    def _publish(self, topic: str, payload: Union[str, bytes]):
+        self._conn.publish(topic=topic, payload=payload, qos=mqtt.QoS.AT_MOST_ONCE)
+        self._published += 1
+
+    def publish_hello(self):
+        self._publish(
+            consts.ACK_CONN_TOPIC,
+            json.dumps(
+                {"mesh_name": self.MESH_NAME, "mesh_network": self.NETWORK_NAME}
+            ),
+        )
+
+    def _move_nodes(self):
+        """Move `churn` of the leaves under other nodes with room for them."""
+        children = {}
+        for node_id, parent in self._parents.items():
+            children[parent] = children.get(parent, 0) + 1
+        depths = {self.BRIDGE_ID: 0}
+        for node_id in self._parents:
+            path = [node_id]
+            while path[-1] not in depths:
+                path.append(self._parents[path[-1]])
+            for depth, step in enumerate(reversed(path[:-1]), depths[path[-1]] + 1):
+                depths[step] = depth
+
+        leaves = sorted(self._parents.keys() - children.keys())
+        for node_id in self._rng.sample(leaves, int(len(leaves) * self._churn)):
+            # Moving a leaf cannot create a cycle
+            candidates = [
+                parent
+                for parent, depth in depths.items()
+                if parent != node_id
+                and children.get(parent, 0) < self._fanout
+                and (self._max_depth is None or depth < self._max_depth)
+            ]
+            if not candidates:
+                continue
+            new_parent = self._rng.choice(candidates)
+            children[self._parents[node_id]] -= 1
+            children[new_parent] = children.get(new_parent, 0) + 1
+            depths[node_id] = depths[new_parent] + 1
+            self._parents[node_id] = new_parent
+
+    def topology(self) -> Dict:
+        """The bridge's topology response: painlessMesh's sub-connection tree
+        and its address to name map."""
+        tree = {self.BRIDGE_ID: {"nodeId": self.BRIDGE_ID, "root": True, "subs": []}}
+        for node_id in sorted(self._parents):
+            tree[node_id] = {"nodeId": node_id, "subs": []}
+        for node_id, parent in self._parents.items():
+            tree[parent]["subs"].append(tree[node_id])
+        return {
+            "mesh_tree": tree[self.BRIDGE_ID],
+            "name_map": {str(node_id): self.node_name(node_id) for node_id in tree},
+        }
+
+    def publish_topology(self):
+        self._publish(consts.TOPOLOGY_RESPONSE_TOPIC, json.dumps(self.topology()))
+
+    def _pack(self, app_data: Dict) -> bytes:
+        if self._binary:
+            return self._cudp.package_binary(app_data)
+        return self._cudp.package_data(app_data)
+
+    def _sensor_packet(self) -> bytes:
+        """What sensor.cpp sends the bridge: its readings, packed."""
+        return self._pack(
+            {
+                "data": {
+                    "temperature": round(self._rng.gauss(27, 3), 2),
+                    "humidity": round(self._rng.uniform(40, 80), 2),
+                    "luminosity": round(self._rng.random(), 3),
+                    "hazardous_gas_warning": float(self._rng.random() < 0.05),
+                },
+                "msg_type": 0,
+            }
+        )
+
+    def publish_measurement(self, node_id: int):
+        app_data = self._cudp.unpack_data(self._sensor_packet())
+        if app_data is None:
+            return
+        del app_data["msg_type"]
+        app_data["node_id"] = node_id
+        app_data["node_name"] = self.node_name(node_id)
+        self._publish(consts.MEASUREMENTS_TOPIC, self._pack(app_data))
+
+    def run(self, duration_s: float, speedup: Optional[float] = 1.0) -> int:
+        """Emit `duration_s` simulated seconds of traffic and return how many
+        messages were published. `speedup` simulated seconds pass per second;
+        None publishes as fast as possible."""
+        published = self._published
+        start = perf_counter()
+        while self._schedule and self._schedule[0][0] < duration_s:
+            due, kind, node_id = heapq.heappop(self._schedule)
+            if speedup:
+                sleep(max(0.0, due / speedup - (perf_counter() - start)))
+            if kind == HELLO:
+                self.publish_hello()
+            elif kind == TOPOLOGY:
+                if self._churn and due > 0:
+                    self._move_nodes()
+                self.publish_topology()
+            else:
+                self.publish_measurement(node_id)
+            if self._intervals[kind]:
+                heapq.heappush(
+                    self._schedule, (due + self._intervals[kind], kind, node_id)
+                )
+        # Simulated time carries on from here on the next run
+        self._schedule = [
+            (due - duration_s, kind, node_id) for due, kind, node_id in self._schedule
+        ]
+        heapq.heapify(self._schedule)
+        return self._published - published
+
+    @property
+    def nodes(self) -> int:
+        return len(self._parents)
+
+    @property
+    def published(self) -> int:
+        return self._published
@@ -1,13 +1,44 @@
 import json
-from functools import partial
+import random
+from typing import Callable, Dict, Optional, Tuple
+from collections import OrderedDict
+from threading import Condition, Event, Thread
+from time import sleep
 from awscrt import io, mqtt
 from awsiot import mqtt_connection_builder
 
+from mqtt_dispatcher import MqttDispatcher
 from mqtt_logger import MqttLogger
 from mesh_controller import MeshController
 from mesh_graph import MeshGraph
 import consts
 
+# Builds the connection from the CRT connection keyword arguments
+# (client_id, clean_session, keep_alive_secs, reconnect timeouts and the
+# interruption callbacks), so MqttClient can run against any broker
+Transport = Callable[..., mqtt.Connection]
+
+
+def _client_bootstrap() -> io.ClientBootstrap:
+    event_loop_group = io.EventLoopGroup(1)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    return io.ClientBootstrap(event_loop_group, host_resolver)
+
+
+def local_broker(host: str = "localhost", port: int = 1883) -> Transport:
+    """Plain TCP connection to a broker without TLS, e.g. a local mosquitto."""
+
+    def connect(**kwargs) -> mqtt.Connection:
+        print(f"Connecting to {host}:{port} with client ID '{kwargs['client_id']}'...")
+        return mqtt.Connection(
+            client=mqtt.Client(_client_bootstrap()),
+            host_name=host,
+            port=port,
+            **kwargs,
+        )
+
+    return connect
+
 
 class MqttClient:
     CLIENT_ID = "iop-dash"
@@ -16,83 +47,161 @@ class MqttClient:
     PATH_TO_CERTIFICATE = "certificates/dash-certificate.pem.crt"
     PATH_TO_PRIVATE_KEY = "certificates/dash-private.pem.key"
     PATH_TO_AMAZON_ROOT_CA_1 = "certificates/rootCA1.pem"
+    MAX_OUTBOX = 100
+    PUBLISH_TIMEOUT_S = 5
+    # Retry delays grow from the min to the max, each drawn at random below
+    # the current bound so reconnecting clients do not retry in lockstep
+    RECONNECT_MIN_S = 1
+    RECONNECT_MAX_S = 60
 
     _conn: mqtt.Connection
+    _transport: Transport
     _logger: MqttLogger
     _controller: MeshController
     _graph: MeshGraph
+    _dispatcher: MqttDispatcher
+    # Pending (topic, payload) pairs, in order; a pair already pending is not
+    # queued again, so repeated control messages coalesce
+    _outbox: OrderedDict[Tuple[str, str], None]
+    _outbox_ready: Condition
+    _connected: Event
+    _publish_thread: Optional[Thread]
+    _dropped_publishes: int
 
     def __init__(
         self,
         logger: MqttLogger,
         controller: MeshController,
         graph: MeshGraph,
+        dispatch_workers: int = 1,
+        transport: Optional[Transport] = None,
     ):
+        self._transport = transport or self._aws_iot
         self._logger = logger
         self._controller = controller
         self._graph = graph
+        self._dispatcher = MqttDispatcher(workers=dispatch_workers)
+        self._dispatcher.register(None, self._log_message)
+        self._dispatcher.register(consts.ACK_CONN_TOPIC, self._on_ack_conn)
+        self._dispatcher.register(consts.TOPOLOGY_RESPONSE_TOPIC, self._on_topology)
+        self._dispatcher.register(consts.MEASUREMENTS_TOPIC, self._on_measurement)
+        self._controller.on_bridge_silent(self._probe_bridge)
+        self._outbox = OrderedDict()
+        self._outbox_ready = Condition()
+        self._connected = Event()
+        self._publish_thread = None
+        self._dropped_publishes = 0
 
-    def connect(self):
-        event_loop_group = io.EventLoopGroup(1)
-        host_resolver = io.DefaultHostResolver(event_loop_group)
-        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-        self._conn = mqtt_connection_builder.mtls_from_path(
+    def _aws_iot(self, **kwargs) -> mqtt.Connection:
+        print(
+            f"Connecting to {self.ENDPOINT} with client ID '{kwargs['client_id']}'..."
+        )
+        return mqtt_connection_builder.mtls_from_path(
             endpoint=self.ENDPOINT,
             cert_filepath=self.PATH_TO_CERTIFICATE,
             pri_key_filepath=self.PATH_TO_PRIVATE_KEY,
-            client_bootstrap=client_bootstrap,
+            client_bootstrap=_client_bootstrap(),
             ca_filepath=self.PATH_TO_AMAZON_ROOT_CA_1,
+            **kwargs,
+        )
+
+    def connect(self):
+        self._conn = self._transport(
             client_id=self.CLIENT_ID,
             clean_session=False,
             keep_alive_secs=6,
+            reconnect_min_timeout_secs=self.RECONNECT_MIN_S,
+            reconnect_max_timeout_secs=self.RECONNECT_MAX_S,
+            on_connection_interrupted=self._on_connection_interrupted,
+            on_connection_resumed=self._on_connection_resumed,
         )
-        print(f"Connecting to {self.ENDPOINT} with client ID '{self.CLIENT_ID}'...")
         # Make the connect() call
         connect_future = self._conn.connect()
         # Future.result() waits until a result is available
         connect_future.result()
+        self._connected.set()
         print("Connected to MQTT!")
 
+        self._dispatcher.start()
         subscribe_future, _ = self._conn.subscribe(
             consts.ROOT_TOPIC,
             qos=mqtt.QoS.AT_MOST_ONCE,
-            callback=partial(
-                self._on_receive,
-                self._logger,
-                self._controller,
-                self._graph,
-            ),
+            callback=self._on_receive,
         )
 
         subscribe_future.result()
         print(f"Subscribed to {consts.ROOT_TOPIC}")
 
+    def publish(self, topic: str, message: str = None) -> bool:
+        """Queue a message for the background publisher and return at once.
 
-    def publish(self, topic: str, message: str = None):
+        False when the outbox is full and the message was dropped.
+        """
         payload = json.dumps(message) if message else ""
-        try:
-            publish_future, _ = self._conn.publish(
-                topic=topic, payload=payload, qos=mqtt.QoS.AT_MOST_ONCE
-            )
-            publish_future.result()
-        except:
-            self._reconnect()
-            publish_future, _ = self._conn.publish(
-                topic=topic, payload=payload, qos=mqtt.QoS.AT_MOST_ONCE
-            )
-            publish_future.result()
-
-    def _reconnect(self):
-        connect_future = self._conn.connect()
-        # Future.result() waits until a result is available
-        connect_future.result()
-        print("Reconnected to MQTT!")
+        with self._outbox_ready:
+            if (topic, payload) in self._outbox:
+                return True
+            if len(self._outbox) >= self.MAX_OUTBOX:
+                self._dropped_publishes += 1
+                return False
+            self._outbox[(topic, payload)] = None
+            self._outbox_ready.notify()
+            if self._publish_thread is None:
+                self._publish_thread = Thread(
+                    target=self._publish_loop, name="mqtt-publish", daemon=True
+                )
+                self._publish_thread.start()
+        return True
+
+    def _publish_loop(self):
+        failures = 0
+        while True:
+            with self._outbox_ready:
+                while not self._outbox:
+                    self._outbox_ready.wait()
+                # Stays queued until sent, so duplicates keep coalescing
+                topic, payload = next(iter(self._outbox))
+            self._connected.wait()
+            try:
+                publish_future, _ = self._conn.publish(
+                    topic=topic, payload=payload, qos=mqtt.QoS.AT_MOST_ONCE
+                )
+                publish_future.result(timeout=self.PUBLISH_TIMEOUT_S)
+            except Exception as e:
+                # A connection that no longer delivers misses its keep-alives
+                # and is interrupted, then the CRT reconnects it on its own
+                failures += 1
+                print(f"Publish to {topic} failed ({e!r}), retrying...")
+                sleep(self._backoff(failures))
+                continue
+            failures = 0
+            with self._outbox_ready:
+                self._outbox.pop((topic, payload), None)
+
+    def _backoff(self, attempt: int) -> float:
+        bound = min(self.RECONNECT_MIN_S * 2 ** (attempt - 1), self.RECONNECT_MAX_S)
+        return random.uniform(0, bound)
+
+    def _on_connection_interrupted(self, connection, error, **kwargs):
+        self._connected.clear()
+        print(f"MQTT connection interrupted ({error})")
+
+    def _on_connection_resumed(
+        self, connection, return_code, session_present, **kwargs
+    ):
+        self._connected.set()
+        print("MQTT connection resumed")
+
+    @property
+    def publish_metrics(self) -> Dict:
+        return {"outbox": len(self._outbox), "dropped": self._dropped_publishes}
+
+    @property
+    def dispatch_metrics(self) -> Dict:
+        return self._dispatcher.metrics()
 
-    @staticmethod
     def _on_receive(
-        logger: MqttLogger,
-        controller: MeshController,
-        graph: MeshGraph,
+        self,
         topic: str,
         payload: bytes,
         dup: bool,
@@ -100,21 +209,28 @@ class MqttClient:
         retain: bool,
         **kwargs,
     ):
-        json_payload = json.loads(payload.decode("utf-8")) if payload else None
-        logger.log_message(msg=json_payload, topic=topic)
-
-        match topic:
-            case consts.ACK_CONN_TOPIC:
-                controller.refresh_connection_status()
-                mesh_name = json_payload["mesh_name"]
-                mesh_network = json_payload["mesh_network"]
-                controller.update_mesh_status(mesh_name=mesh_name, network_name=mesh_network)
-
-            case consts.TOPOLOGY_RESPONSE_TOPIC:
-                controller.refresh_connection_status()
-                mesh_tree_root = json_payload["mesh_tree"]
-                name_map = json_payload["name_map"]
-                graph.update_graph(mesh_tree_root=mesh_tree_root, name_map=name_map)
-
-            case consts.MEASUREMENTS_TOPIC:
-                controller.refresh_connection_status()
+        # Runs on the CRT event-loop thread: hand off and return right away
+        self._dispatcher.submit(topic, payload)
+
+    def _probe_bridge(self):
+        self.publish(consts.CHECK_CONN_TOPIC)
+
+    def _log_message(self, topic: str, msg: Optional[Dict]):
+        self._logger.log_message(msg=msg, topic=topic)
+
+    def _on_ack_conn(self, topic: str, msg: Optional[Dict]):
+        self._controller.refresh_connection_status()
+        self._controller.update_mesh_status(
+            mesh_name=msg["mesh_name"], network_name=msg["mesh_network"]
+        )
+
+    def _on_topology(self, topic: str, msg: Optional[Dict]):
+        self._controller.refresh_connection_status()
+        self._graph.update_graph(
+            mesh_tree_root=msg["mesh_tree"], name_map=msg["name_map"]
+        )
+        self._controller.nodes_seen(self._graph.node_ids())
+
+    def _on_measurement(self, topic: str, msg: Optional[Dict]):
+        self._controller.refresh_connection_status()
+        self._controller.nodes_seen([str(msg["node_id"])])
@@ -0,0 +1,147 @@
+import json
+from typing import Callable, Dict, List, Optional
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from zlib import crc32
+
+from chicken_udp import ChickenUDP, is_framed
+
+Handler = Callable[[str, Optional[Dict]], None]
+
+
+class _HandlerStats:
+    __slots__ = ("count", "total_s", "max_s", "errors")
+
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.errors = 0
+
+
+class MqttDispatcher:
+    """Runs MQTT message handlers on worker threads instead of the CRT
+    event-loop thread that receives them.
+
+    `submit` never blocks: when a worker's queue is full the message is
+    dropped and counted. Messages are sharded by topic, so each topic is
+    handled in order by a single worker.
+    """
+
+    MAX_QUEUED: int = 1000
+
+    _queues: List[Queue]
+    _workers: List[Thread]
+    _handlers: Dict[Optional[str], List[Handler]]
+    _stats: Dict[str, _HandlerStats]
+    _stats_lock: Lock
+    _dropped: int
+    _invalid: int
+    _cudp: ChickenUDP
+
+    def __init__(self, workers: int = 1, max_queued: int = MAX_QUEUED):
+        self._queues = [Queue(maxsize=max_queued) for _ in range(workers)]
+        self._workers = []
+        self._handlers = {}
+        self._stats = {}
+        self._stats_lock = Lock()
+        self._dropped = 0
+        self._invalid = 0
+        self._cudp = ChickenUDP()
+
+    def register(self, topic: Optional[str], handler: Handler):
+        """Call `handler(topic, message)` for messages on `topic`, or on any
+        topic when it is None. Handlers for every topic run first."""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def start(self):
+        for index, queue in enumerate(self._queues):
+            worker = Thread(
+                target=self._work,
+                args=(queue,),
+                name=f"mqtt-dispatch-{index}",
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, topic: str, payload: bytes):
+        queue = self._queues[crc32(topic.encode()) % len(self._queues)]
+        try:
+            queue.put_nowait((topic, payload))
+        except Full:
+            self._dropped += 1
+
+    def _work(self, queue: Queue):
+        while True:
+            topic, payload = queue.get()
+            try:
+                self._dispatch(topic, payload)
+            except Exception as e:
+                # A message nothing could handle must not stop the worker
+                self._invalid += 1
+                print(f"Ignoring message on {topic} that failed to dispatch ({e!r})")
+            finally:
+                queue.task_done()
+
+    def _dispatch(self, topic: str, payload: bytes):
+        # Measurements come as ChickenUDP frames, everything else as JSON
+        if is_framed(payload):
+            message = self._cudp.unpack_data(payload)
+            if message is None:
+                self._invalid += 1
+                print(f"Ignoring invalid ChickenUDP frame on {topic}")
+                return
+        else:
+            try:
+                message = json.loads(payload.decode("utf-8")) if payload else None
+            except (ValueError, RecursionError) as e:
+                self._invalid += 1
+                print(f"Ignoring invalid message on {topic} ({e})")
+                return
+        for handler in self._handlers.get(None, []) + self._handlers.get(topic, []):
+            self._run(handler, topic, message)
+
+    def _run(self, handler: Handler, topic: str, message: Optional[Dict]):
+        start = perf_counter()
+        failed = False
+        try:
+            handler(topic, message)
+        except Exception as e:
+            failed = True
+            print(f"Handler {handler.__name__} failed on {topic} ({e!r})")
+        elapsed = perf_counter() - start
+
+        with self._stats_lock:
+            stats = self._stats.setdefault(handler.__name__, _HandlerStats())
+            stats.count += 1
+            stats.total_s += elapsed
+            stats.max_s = max(stats.max_s, elapsed)
+            stats.errors += failed
+
+    def join(self):
+        """Wait until every submitted message has been handled."""
+        for queue in self._queues:
+            queue.join()
+
+    def metrics(self) -> Dict:
+        """Queue depth, dropped and invalid messages, invalid frames per node
+        and latency per handler."""
+        with self._stats_lock:
+            latency = {
+                name: {
+                    "count": stats.count,
+                    "mean_ms": stats.total_s / stats.count * 1000,
+                    "max_ms": stats.max_s * 1000,
+                    "errors": stats.errors,
+                }
+                for name, stats in self._stats.items()
+            }
+        return {
+            "queue_depth": sum(queue.qsize() for queue in self._queues),
+            "dropped": self._dropped,
+            "invalid": self._invalid,
+            "invalid_frames": self._cudp.invalid_frames,
+            "handler_latency": latency,
+        }
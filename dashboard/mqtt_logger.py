@@ -1,41 +1,230 @@
-from typing import Dict, List
+from typing import Deque, Dict, Hashable, List, NamedTuple, Optional
+from bisect import bisect_left
+from collections import deque
 from datetime import datetime
+from threading import Lock
+from time import time
 
 from dash import html
 
 
+class _LogRecord:
+    """Raw message as received; rendered to HTML only when displayed."""
+
+    __slots__ = ("timestamp", "origin", "endpoint", "node_id", "msg", "_text")
+
+    timestamp: float
+    origin: str
+    endpoint: str
+    node_id: Optional[int]
+    msg: Optional[Dict]
+
+    def __init__(self, timestamp: float, topic: str, msg: Optional[Dict]):
+        self.timestamp = timestamp
+        self.origin, _, self.endpoint = topic.partition("/")
+        node_id = msg.get("node_id") if isinstance(msg, dict) else None
+        self.node_id = node_id if isinstance(node_id, int) else None
+        self.msg = msg
+        self._text = None
+
+    @property
+    def topic(self) -> str:
+        return f"{self.origin}/{self.endpoint}"
+
+    @property
+    def text(self) -> str:
+        """Lowercase topic and payload, what substring search looks at."""
+        if self._text is None:
+            self._text = f"{self.topic} {self.msg}".lower()
+        return self._text
+
+
+class LogPage(NamedTuple):
+    logs: List[html.Pre]
+    # Matching messages in the buffer, not only on this page
+    total: int
+    # Sequence number to pass as `after` to get only newer messages
+    cursor: int
+    # Whether `logs` are only the messages after the given `after`
+    incremental: bool
+
+
 class MqttLogger:
-    _logs: List[html.P]
+    """Keeps the last `capacity` MQTT messages in a ring buffer.
+
+    Every message gets a sequence number and is indexed by origin, endpoint,
+    node id and time bucket as it arrives. Each index maps a key to the
+    increasing sequence numbers having it, so evicting the oldest message only
+    pops the left end of its entries and a query costs as much as its most
+    selective filter, however full the buffer is.
+    """
+
+    CAPACITY: int = 1000
+    PAGE_SIZE: int = 50
+    TIME_BUCKET_S: int = 60
+
+    _records: List[Optional[_LogRecord]]
+    _capacity: int
+    _next_seq: int
+    _indexes: Dict[str, Dict[Hashable, Deque[int]]]
+    _lock: Lock
     _has_been_updated: bool
 
-    def __init__(self):
-        self._logs = []
+    def __init__(self, capacity: int = CAPACITY):
+        self._records = [None] * capacity
+        self._capacity = capacity
+        self._next_seq = 0
+        self._indexes = {"origin": {}, "endpoint": {}, "node_id": {}, "bucket": {}}
+        self._lock = Lock()
         self._has_been_updated = False
 
+    def _index_keys(self, record: _LogRecord) -> Dict[str, Hashable]:
+        return {
+            "origin": record.origin,
+            "endpoint": record.endpoint,
+            "node_id": record.node_id,
+            "bucket": int(record.timestamp // self.TIME_BUCKET_S),
+        }
+
     def log_message(self, msg: Dict, topic: str):
-        topic_str = topic.split('/', 1)[1]
-        origin, endpoint = topic_str.split('/', 1)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record = _LogRecord(time(), topic.split("/", 1)[1], msg)
+        with self._lock:
+            seq = self._next_seq
+            slot = seq % self._capacity
+            evicted = self._records[slot]
+            if evicted is not None:
+                for name, key in self._index_keys(evicted).items():
+                    entries = self._indexes[name][key]
+                    entries.popleft()
+                    if not entries:
+                        del self._indexes[name][key]
+            self._records[slot] = record
+            for name, key in self._index_keys(record).items():
+                self._indexes[name].setdefault(key, deque()).append(seq)
+            self._next_seq += 1
+        self._has_been_updated = True
 
-        header_str = topic_str + (':' if msg is not None else '')
-        msg_str =  str(msg) if msg is not None else ''
-        sep_str = html.Br() if msg is not None else None
+    @staticmethod
+    def _render(record: _LogRecord) -> html.Pre:
+        timestamp = datetime.fromtimestamp(record.timestamp).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
 
-        style = {'border': "1px solid", "border-color": "rgba(87, 87, 87, 0.2)"}
+        header_str = record.topic + (":" if record.msg is not None else "")
+        msg_str = str(record.msg) if record.msg is not None else ""
+        sep_str = html.Br() if record.msg is not None else None
+
+        style = {"border": "1px solid", "border-color": "rgba(87, 87, 87, 0.2)"}
         className = "m-0 p-2 fs-5 text-wrap"
-        match origin:
+        match record.origin:
             case "dash":
                 style["background-color"] = "rgba(101, 168, 209, 0.8)"
             case "mesh":
                 style["background-color"] = "rgba(90, 204, 139, 0.8)"
 
         text_content = [html.B(timestamp), "    ", header_str, sep_str, msg_str]
-        self._logs.append(html.Pre(text_content, className=className, style=style))
-        self._has_been_updated = True
+        return html.Pre(text_content, className=className, style=style)
+
+    def _time_candidates(self, start: Optional[float], end: Optional[float]) -> List:
+        first = int(start // self.TIME_BUCKET_S) if start is not None else None
+        last = int(end // self.TIME_BUCKET_S) if end is not None else None
+        # Buckets are created in increasing order, so concatenating them keeps
+        # the sequence numbers sorted
+        return [
+            seq
+            for bucket, entries in self._indexes["bucket"].items()
+            if (first is None or bucket >= first) and (last is None or bucket <= last)
+            for seq in entries
+        ]
+
+    def _record(self, seq: int) -> _LogRecord:
+        return self._records[seq % self._capacity]
+
+    def _matches(
+        self,
+        origin: Optional[str],
+        endpoint: Optional[str],
+        node_id: Optional[int],
+        start: Optional[float],
+        end: Optional[float],
+        text: Optional[str],
+    ) -> List[int]:
+        """Sorted sequence numbers of the matching messages.
 
-    def get_logs(self) -> List[html.P]:
+        Only the most selective index is walked, the other filters are
+        checked on each of its messages.
+        """
+        keys = dict(origin=origin, endpoint=endpoint, node_id=node_id)
+        keys = {name: key for name, key in keys.items() if key is not None}
+        candidates = [self._indexes[name].get(key, ()) for name, key in keys.items()]
+        if not candidates:
+            oldest = max(self._next_seq - self._capacity, 0)
+            candidates.append(range(oldest, self._next_seq))
+        candidates = min(candidates, key=len)
+        if (start is not None or end is not None) and len(candidates) > 1:
+            in_time = self._time_candidates(start, end)
+            candidates = min(candidates, in_time, key=len)
+
+        text = text.lower() if text else None
+        matches = []
+        for seq in candidates:
+            record = self._record(seq)
+            if (
+                all(getattr(record, name) == key for name, key in keys.items())
+                and (start is None or record.timestamp >= start)
+                and (end is None or record.timestamp <= end)
+                and (text is None or text in record.text)
+            ):
+                matches.append(seq)
+        return matches
+
+    def query(
+        self,
+        origin: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        node_id: Optional[int] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        text: Optional[str] = None,
+        page: int = 1,
+        page_size: int = PAGE_SIZE,
+        after: Optional[int] = None,
+    ) -> LogPage:
+        """Rendered messages matching every given filter, oldest first.
+
+        `start` and `end` are epoch seconds and `text` is searched for, case
+        insensitively, in the topic and payload. Page 1 holds the newest
+        `page_size` matches. With `after` (a previous `LogPage.cursor`) only
+        the newer matches on page 1 are returned, unless messages since it
+        were already overwritten or it is unknown: then `incremental` is False
+        and the whole page is returned.
+        """
+        with self._lock:
+            matches = self._matches(origin, endpoint, node_id, start, end, text)
+            total = len(matches)
+            last = max(total - (page - 1) * page_size, 0)
+            page_matches = matches[max(last - page_size, 0) : last]
+            oldest = max(self._next_seq - self._capacity, 0)
+            # A cursor ahead of the buffer comes from before a restart
+            incremental = after is not None and oldest <= after <= self._next_seq
+            if incremental:
+                page_matches = matches[
+                    max(bisect_left(matches, after), total - page_size) :
+                ]
+            records = [self._record(seq) for seq in page_matches]
+            cursor = self._next_seq
         self._has_been_updated = False
-        return self._logs
+        return LogPage(
+            [self._render(record) for record in records], total, cursor, incremental
+        )
+
+    def endpoints(self) -> List[str]:
+        with self._lock:
+            return sorted(self._indexes["endpoint"])
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
 
     @property
     def has_been_updated(self):
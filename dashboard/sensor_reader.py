@@ -1,28 +1,95 @@
-from typing import List, Dict
+import os
+from typing import List, Dict, NamedTuple, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock, Thread
+from time import monotonic, sleep
 
+from dateutil import tz
 from dotenv import dotenv_values
+import numpy as np
 import pandas as pd
 import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool
 import plotly.express as px
 import plotly.graph_objs as go
+from dash import Patch, no_update
+
+from measurement_store import MeasurementStore
+from binary_copy import copy_measurements
+from downsampling import downsample_indices
+
+
+class Snapshot(NamedTuple):
+    """What readers may see: the first `size` store rows, at `version`."""
+
+    size: int
+    version: int
 
 
 class SensorReader:
-    _conn: psycopg.Connection
-    _latest_id_read: int
+    POINTS_PER_PIXEL: int = 2
+    DOWNSAMPLING_METHOD: str = "minmax"
+    FIGURE_CACHE_MAX_BYTES: int = 64 * 2**20
+    NOTIFY_CHANNEL: str = "measurements_inserted"
+    # Fallback poll when no notification arrives (e.g. trigger not installed)
+    POLL_INTERVAL: float = 60
+    SNAPSHOT_INTERVAL: float = 3600
+    # Bulk reads through COPY ... (FORMAT BINARY) instead of fetchall()
+    BINARY_COPY: bool = True
+    # `measurements_rollup` resolutions, finest first, as `date_trunc` fields
+    # and their numpy units; ingest keeps them up to date
+    ROLLUP_RESOLUTIONS: Dict[str, str] = {"minute": "m", "hour": "h", "day": "D"}
+    # Raw rows over this many times the point budget are read from rollups
+    ROLLUP_MIN_RAW_FACTOR: int = 4
+    # The bucket `start` falls into is included, its mean covers `start` too
+    ROLLUP_QUERY = sql.SQL("""
+        SELECT
+            node_name,
+            bucket,
+            {min},
+            {max},
+            {sum} / count,
+            count
+        FROM measurements_rollup
+        WHERE resolution = %(resolution)s
+            AND node_id = ANY(%(node_ids)s)
+            AND bucket >= date_trunc(
+                %(resolution)s, coalesce(%(start)s::timestamp, '-infinity')
+            )
+            AND bucket <= coalesce(%(end)s::timestamp, 'infinity')
+        ORDER BY bucket
+    """)
+    NOTIFY_TRIGGER_SQL: str = f"""
+        CREATE OR REPLACE FUNCTION notify_measurements_inserted() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{NOTIFY_CHANNEL}', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS measurements_inserted ON measurements;
+        CREATE TRIGGER measurements_inserted
+            AFTER INSERT ON measurements
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_measurements_inserted();
+    """
+
+    _pool: ConnectionPool
+    _db_params: Dict
     _has_been_updated: bool
+    _snapshot: Snapshot
+    _figure_cache: OrderedDict[str, Tuple[go.Figure, int]]
+    _figure_cache_bytes: int
+    _cache_lock: Lock
+    _refresh_lock: Lock
+    _refresh_thread: Optional[Thread]
+    _snapshot_dir: Optional[str]
+    _snapshot_size: int
+    _refresh_stats: Dict
+    _rollups_available: bool
 
-    _readings_df: pd.DataFrame
-    _df_cols_names = [
-        "id",
-        "node id",
-        "node name",
-        "temperature",
-        "humidity",
-        "luminosity",
-        "hazardous gas warning",
-        "timestamp",
-    ]
+    _store: MeasurementStore
     _measurements = [
         "temperature",
         "humidity",
@@ -30,9 +97,10 @@ class SensorReader:
         "hazardous gas warning",
     ]
 
-    def __init__(self):
+    def __init__(self, pool_size: int = 4, snapshot_dir: Optional[str] = "snapshot"):
+        startup = monotonic()
         db_credentials = dotenv_values("credentials.env")
-        self._conn = psycopg.connect(
+        self._db_params = dict(
             host=db_credentials["DB_HOST"],
             port=db_credentials["DB_PORT"],
             user=db_credentials["DB_USER"],
@@ -40,47 +108,481 @@ class SensorReader:
             dbname=db_credentials["DB_NAME"],
             sslmode="require",
         )
+        self._pool = ConnectionPool(
+            kwargs=self._db_params,
+            min_size=1,
+            max_size=pool_size,
+            # Hand out only connections that still answer
+            check=ConnectionPool.check_connection,
+            open=True,
+        )
+        self._pool.wait()
         print("Connected to database!")
 
-        self._readings_df = pd.DataFrame(columns=self._df_cols_names)
-        self._latest_id_read = 0
+        self._snapshot_dir = snapshot_dir
+        self._store = self._load_snapshot()
+        self._snapshot_size = len(self._store)
+        self._snapshot = Snapshot(size=len(self._store), version=0)
+        self._figure_cache = OrderedDict()
+        self._figure_cache_bytes = 0
+        self._cache_lock = Lock()
+        self._refresh_lock = Lock()
+        self._refresh_thread = None
+        self._rollups_available = True
+        self._refresh_stats = {
+            "notifications": 0,
+            "polls": 0,
+            "last_refresh_ms": None,
+            "last_lag_s": None,
+        }
         self.update_measurements()
+        print(
+            f"Measurements ready: {len(self._store)} rows "
+            f"({len(self._store) - self._snapshot_size} from database) "
+            f"in {monotonic() - startup:.2f} s"
+        )
+
+    def _load_snapshot(self) -> MeasurementStore:
+        if not (self._snapshot_dir and os.path.isdir(self._snapshot_dir)):
+            return MeasurementStore()
+        start = monotonic()
+        try:
+            store = MeasurementStore.load(self._snapshot_dir)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable snapshot ({e})")
+            return MeasurementStore()
+        print(f"Mapped {len(store)} rows from snapshot in {monotonic() - start:.2f} s")
+        return store
+
+    def save_snapshot(self):
+        """Write everything read so far to `snapshot_dir`, replacing the old one."""
+        snapshot = self._snapshot
+        if not self._snapshot_dir or snapshot.size == self._snapshot_size:
+            return
+        start = monotonic()
+        self._store.save(self._snapshot_dir, size=snapshot.size)
+        self._snapshot_size = snapshot.size
+        print(f"Saved {snapshot.size} rows to snapshot in {monotonic() - start:.2f} s")
+
+    def start_background_compaction(self):
+        """Fold newly read rows into the on-disk snapshot every SNAPSHOT_INTERVAL."""
+        Thread(
+            target=self._compaction_loop, name="sensor-snapshot", daemon=True
+        ).start()
+
+    def _compaction_loop(self):
+        while True:
+            sleep(self.SNAPSHOT_INTERVAL)
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                print(f"Snapshot failed ({e})")
 
     def update_measurements(self):
-        with self._conn.cursor() as cur:
-            cur.execute(
-                "SELECT * FROM measurements WHERE id > %s", (self._latest_id_read,)
-            )
-            records = cur.fetchall()
-        self._conn.commit()
+        # Coalesce concurrent refreshes: callers arriving while one is in
+        # flight wait for it to finish instead of running their own query
+        if not self._refresh_lock.acquire(blocking=False):
+            with self._refresh_lock:
+                return
+        try:
+            self._refresh()
+        finally:
+            self._refresh_lock.release()
 
-        new_records_df = pd.DataFrame(records, columns=self._df_cols_names)
-        self._readings_df = pd.concat(
-            [self._readings_df, new_records_df], ignore_index=True
-        )
-        self._latest_id_read = records[-1][0] if records else self._latest_id_read
+    def _fetch(self, conn: psycopg.Connection) -> int:
+        # From what the store holds rather than what the last refresh read:
+        # a COPY that failed midway leaves the chunks it had appended
+        if self.BINARY_COPY:
+            return copy_measurements(conn, self._store, self._store.latest_id)
+        records = conn.execute(
+            "SELECT * FROM measurements WHERE id > %s"
+            " AND node_id IS NOT NULL AND timestamp IS NOT NULL",
+            (self._store.latest_id,),
+        ).fetchall()
+        self._store.append_records(records)
+        return len(records)
+
+    def _refresh(self):
+        start = monotonic()
+        with self._pool.connection() as conn:
+            new_rows = self._fetch(conn)
+
+        if new_rows:
+            self._publish_snapshot()
+            # Ingest stamps readings with naive America/Sao_Paulo local time
+            now = datetime.now(tz=tz.gettz("America/Sao_Paulo")).replace(tzinfo=None)
+            newest = self._store.column("timestamp")[-1]
+            lag = now - pd.Timestamp(newest).to_pydatetime()
+            self._refresh_stats["last_lag_s"] = lag.total_seconds()
+        self._refresh_stats["last_refresh_ms"] = (monotonic() - start) * 1000
         print("Read database measurements!")
 
-    def get_figure(self, node_ids: List[int], meas: str) -> go.Figure:
-        filtered_df = self._readings_df[
-            self._readings_df["node id"].isin(node_ids)
-        ].sort_values(by="timestamp")
+    def _publish_snapshot(self):
+        # A single attribute swap: readers see either the old or the new snapshot
+        self._snapshot = Snapshot(len(self._store), self._snapshot.version + 1)
+        with self._cache_lock:
+            # Entries of older versions can never be hit again
+            self._figure_cache.clear()
+            self._figure_cache_bytes = 0
+
+    def _cache_figure(self, key: str, figure: go.Figure, nbytes: int):
+        with self._cache_lock:
+            self._figure_cache[key] = (figure, nbytes)
+            self._figure_cache_bytes += nbytes
+            while self._figure_cache_bytes > self.FIGURE_CACHE_MAX_BYTES:
+                _, (_, evicted_bytes) = self._figure_cache.popitem(last=False)
+                self._figure_cache_bytes -= evicted_bytes
+
+    def _cached_figure(self, key: str) -> Optional[go.Figure]:
+        with self._cache_lock:
+            cached = self._figure_cache.get(key)
+            if cached:
+                self._figure_cache.move_to_end(key)
+                return cached[0]
+        return None
+
+    def install_notify_trigger(self):
+        """Create the trigger that NOTIFYs the refresh thread on inserts."""
+        with self._pool.connection() as conn:
+            conn.execute(self.NOTIFY_TRIGGER_SQL)
+
+    def start_background_refresh(self):
+        """Keep the store up to date from a background thread.
+
+        The thread LISTENs on NOTIFY_CHANNEL and fetches the delta as soon as
+        a notification arrives, polling every POLL_INTERVAL seconds otherwise.
+        """
+        self._refresh_thread = Thread(
+            target=self._refresh_loop, name="sensor-refresh", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                with psycopg.connect(**self._db_params, autocommit=True) as listener:
+                    listener.execute(f"LISTEN {self.NOTIFY_CHANNEL}")
+                    while True:
+                        notifications = listener.notifies(
+                            timeout=self.POLL_INTERVAL, stop_after=1
+                        )
+                        if any(True for _ in notifications):
+                            self._refresh_stats["notifications"] += 1
+                        else:
+                            self._refresh_stats["polls"] += 1
+                        self.update_measurements()
+            except psycopg.OperationalError as e:
+                print(f"Database refresh failed ({e}), retrying...")
+                sleep(self.POLL_INTERVAL / 10)
+
+    @property
+    def background_refresh_running(self) -> bool:
+        return self._refresh_thread is not None and self._refresh_thread.is_alive()
+
+    @property
+    def refresh_stats(self) -> Dict:
+        """Notification/poll counts, duration of the last refresh and how old
+        the newest reading was when it was read."""
+        return dict(self._refresh_stats)
+
+    @staticmethod
+    def _selection_key(
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        plot_width: Optional[int],
+    ) -> str:
+        node_ids = sorted(frozenset(node_ids))
+        return f"{meas}|{node_ids}|{start}|{end}|{plot_width}"
 
+    def figure_key(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        plot_width: Optional[int] = None,
+        snapshot: Optional[Snapshot] = None,
+    ) -> str:
+        """Identifies the figure `get_figure` would build for the current data."""
+        selection = self._selection_key(node_ids, meas, start, end, plot_width)
+        return f"{selection}|{(snapshot or self._snapshot).version}"
+
+    def _values(self, meas: str, rows: np.ndarray) -> np.ndarray:
+        values = self._store.column(meas)[rows]
         # Scale adjustment: better to fix in mesh
         if meas == "hazardous gas warning":
-            filtered_df[meas] = 1 - filtered_df[meas]
+            values = 1 - values
+        return values
+
+    def _patch_since(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        max_points: Optional[int],
+        client_state: Dict,
+        snapshot: Snapshot,
+    ) -> Optional[Tuple[object, int]]:
+        """Patch extending the client's traces with rows it has not seen yet.
+
+        Returns None when only a full redraw is correct: a reading arrived out
+        of order, a new trace is needed or the client went over its budget.
+        """
+        tails = self._store.tails_since(
+            node_ids,
+            client_state["size"],
+            start=np.datetime64(start, "ns") if start else None,
+            end=np.datetime64(end, "ns") if end else None,
+            size=snapshot.size,
+        )
+        if tails is None:
+            return None
+        rows = self._store.merge(tails)
+        if not len(rows):
+            return no_update, client_state["appended"]
+        appended = client_state["appended"] + len(rows)
+        if max_points and appended > max_points:
+            return None
+
+        patch = Patch()
+        names = self._store.names(self._store.column("name code")[rows]).astype(str)
+        timestamps = np.datetime_as_string(
+            self._store.column("timestamp")[rows], unit="ms"
+        )
+        values = self._values(meas, rows)
+        for name in pd.unique(names):
+            if name not in client_state["traces"]:
+                return None
+            trace = client_state["traces"].index(name)
+            in_trace = names == name
+            patch["data"][trace]["x"].extend(timestamps[in_trace].tolist())
+            patch["data"][trace]["y"].extend(values[in_trace].tolist())
+        return patch, appended
+
+    def get_figure_update(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        plot_width: Optional[int] = None,
+        client_state: Optional[Dict] = None,
+    ) -> Tuple[object, Dict]:
+        """Smallest update that brings a client's figure up to date.
+
+        `client_state` is whatever the previous call returned for that client.
+        Returns `no_update` when it is current, a `Patch` with only the new
+        points while the selection is unchanged, and a full figure otherwise.
+        """
+        snapshot = self._snapshot
+        selection = self._selection_key(node_ids, meas, start, end, plot_width)
+        key = f"{selection}|{snapshot.version}"
+        state = client_state or {}
+        if state.get("key") == key:
+            return no_update, no_update
+
+        if state.get("selection") == selection:
+            max_points = plot_width * self.POINTS_PER_PIXEL if plot_width else None
+            update = self._patch_since(
+                node_ids, meas, start, end, max_points, state, snapshot
+            )
+            if update is not None:
+                patch, appended = update
+                state = {**state, "key": key, "size": snapshot.size}
+                state["appended"] = appended
+                return patch, state
+
+        figure = self._build_figure(node_ids, meas, start, end, plot_width, snapshot)
+        state = {
+            "key": key,
+            "selection": selection,
+            "size": snapshot.size,
+            # Raw rows cannot extend bucket means, so rollup figures are
+            # always redrawn: with no known traces every patch is refused
+            "traces": (
+                [] if figure.layout.meta else [str(trace.name) for trace in figure.data]
+            ),
+            "appended": 0,
+        }
+        return figure, state
+
+    def _select(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        max_points: Optional[int] = None,
+        snapshot: Optional[Snapshot] = None,
+    ) -> pd.DataFrame:
+        slices = self._store.select_by_node(
+            node_ids,
+            start=np.datetime64(start, "ns") if start else None,
+            end=np.datetime64(end, "ns") if end else None,
+            size=(snapshot or self._snapshot).size,
+        )
+        if max_points:
+            # Series already within budget (e.g. a zoomed-in range) stay raw
+            timestamps = self._store.column("timestamp")
+            values = self._store.column(meas)
+            slices = [
+                rows[
+                    downsample_indices(
+                        timestamps[rows].view(np.int64),
+                        values[rows],
+                        max_points,
+                        self.DOWNSAMPLING_METHOD,
+                    )
+                ]
+                for rows in slices
+            ]
+        rows = self._store.merge(slices)
+
+        return pd.DataFrame(
+            {
+                "timestamp": self._store.column("timestamp")[rows],
+                meas: self._values(meas, rows),
+                "node name": self._store.names(self._store.column("name code")[rows]),
+            }
+        )
+
+    def _rollup_resolution(
+        self,
+        node_ids: List[int],
+        start: Optional[datetime],
+        end: Optional[datetime],
+        max_points: Optional[int],
+        snapshot: Snapshot,
+    ) -> Optional[Tuple[str, np.datetime64]]:
+        """Finest rollup resolution whose buckets over the selected range fit
+        in `max_points` and the first raw timestamp in that range, or None
+        when the raw rows should be plotted."""
+        if not (max_points and self._rollups_available):
+            return None
+        slices = self._store.select_by_node(
+            node_ids,
+            start=np.datetime64(start, "ns") if start else None,
+            end=np.datetime64(end, "ns") if end else None,
+            size=snapshot.size,
+        )
+        slices = [rows for rows in slices if len(rows)]
+        if max(map(len, slices), default=0) <= self.ROLLUP_MIN_RAW_FACTOR * max_points:
+            return None
+
+        timestamps = self._store.column("timestamp")
+        first = min(timestamps[rows[0]] for rows in slices)
+        span = max(timestamps[rows[-1]] for rows in slices) - first
+        for resolution, unit in self.ROLLUP_RESOLUTIONS.items():
+            if span // np.timedelta64(1, unit) + 1 <= max_points:
+                break
+        return resolution, first
+
+    def _select_rollup(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        resolution: str,
+        first: np.datetime64,
+    ) -> Optional[pd.DataFrame]:
+        """Rollup buckets over the range, or None when the rollups are
+        missing or start later than the raw rows (e.g. history from before
+        the table was created and not backfilled)."""
+        column = meas.replace(" ", "_")
+        query = self.ROLLUP_QUERY.format(
+            **{
+                stat: sql.Identifier(f"{column}_{stat}")
+                for stat in ("min", "max", "sum")
+            }
+        )
+        params = dict(
+            resolution=resolution,
+            node_ids=[int(node_id) for node_id in node_ids],
+            start=str(start) if start else None,
+            end=str(end) if end else None,
+        )
+        try:
+            with self._pool.connection() as conn:
+                records = conn.execute(query, params).fetchall()
+        except psycopg.errors.UndefinedTable:
+            print("No measurements_rollup table, plotting raw measurements only")
+            self._rollups_available = False
+            return None
+        unit = self.ROLLUP_RESOLUTIONS[resolution]
+        if not records or np.datetime64(records[0][1], unit) > first.astype(
+            f"datetime64[{unit}]"
+        ):
+            print(f"measurements_rollup misses older {resolution}s, plotting raw")
+            return None
+
+        df = pd.DataFrame(
+            records, columns=["node name", "timestamp", "min", "max", meas, "count"]
+        )
+        if meas == "hazardous gas warning":
+            df[meas] = 1 - df[meas]
+            df["min"], df["max"] = 1 - df["max"], 1 - df["min"]
+        return df
+
+    def get_figure(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        plot_width: Optional[int] = None,
+    ) -> go.Figure:
+        return self._build_figure(
+            node_ids, meas, start, end, plot_width, self._snapshot
+        )
+
+    def _build_figure(
+        self,
+        node_ids: List[int],
+        meas: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        plot_width: Optional[int],
+        snapshot: Snapshot,
+    ) -> go.Figure:
+        key = self.figure_key(node_ids, meas, start, end, plot_width, snapshot)
+        cached = self._cached_figure(key)
+        if cached:
+            return cached
+
+        max_points = plot_width * self.POINTS_PER_PIXEL if plot_width else None
+        rollup = self._rollup_resolution(node_ids, start, end, max_points, snapshot)
+        resolution, filtered_df = None, None
+        if rollup:
+            resolution, first = rollup
+            filtered_df = self._select_rollup(
+                node_ids, meas, start, end, resolution, first
+            )
+        if filtered_df is None:
+            resolution = None
+            filtered_df = self._select(node_ids, meas, start, end, max_points, snapshot)
 
         figure = px.line(
-            filtered_df, x="timestamp", y=meas, color="node name", markers=True
+            filtered_df,
+            x="timestamp",
+            y=meas,
+            color="node name",
+            markers=True,
+            hover_data=["min", "max", "count"] if resolution else None,
+        )
+        figure.update_layout(
+            margin=dict(l=20, r=20, t=20, b=20),
+            uirevision=True,
+            meta={"resolution": resolution} if resolution else None,
         )
-        figure.update_layout(margin=dict(l=20, r=20, t=20, b=20), uirevision=True)
+        self._cache_figure(key, figure, int(filtered_df.memory_usage(deep=True).sum()))
         return figure
 
     def get_nodes(self) -> List[Dict]:
-        nodes = self._readings_df[["node name", "node id"]].drop_duplicates(
-            subset=["node name"]
-        )
-        return nodes.to_dict(orient="records")
+        return self._store.nodes()
 
     def get_node_ids(self) -> List[int]:
-        return self._readings_df["node id"].unique()
+        return self._store.node_ids()
@@ -15,6 +15,24 @@ stylesheet = {
     },
     "cytoscape_params": [
         {"selector": "node", "style": {"content": "data(label)"}},
+        # Relays grow with the number of nodes they forward for
+        {
+            "selector": "[relayed > 0]",
+            "style": {
+                "width": "mapData(relayed, 0, 50, 30, 70)",
+                "height": "mapData(relayed, 0, 50, 30, 70)",
+            },
+        },
+        {"selector": "[relayed >= 20]", "style": {"background-color": "orange"}},
+        # Single points of failure
+        {
+            "selector": "[articulation > 0]",
+            "style": {
+                "border-width": 4,
+                "border-style": "double",
+                "border-color": "darkred",
+            },
+        },
         {
             "selector": "[root > 0]",
             "style": {
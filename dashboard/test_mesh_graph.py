@@ -0,0 +1,31 @@
+import pytest
+
+from mesh_graph import MeshGraph
+
+TREE = {
+    "nodeId": 1,
+    "subs": [{"nodeId": 2, "subs": []}, {"nodeId": 3, "subs": [{"nodeId": 4}]}],
+}
+
+
+def test_report_without_a_root_is_shown_from_its_top():
+    graph = MeshGraph()
+    graph.update_graph(TREE, {})
+    assert graph.cytoscape_root == '[id = "1"]'
+    elements, _ = graph.get_cytospace_params()
+    assert len(elements) == 7
+
+
+def test_failed_report_is_applied_again(monkeypatch):
+    graph = MeshGraph()
+
+    def fail(*args):
+        raise RuntimeError("layout failed")
+
+    monkeypatch.setattr(graph, "_update_cytoscape", fail)
+    with pytest.raises(RuntimeError):
+        graph.update_graph(TREE, {})
+    monkeypatch.undo()
+    graph.update_graph(TREE, {})
+    assert graph.node_ids()
+    assert graph.cytoscape_root == '[id = "1"]'
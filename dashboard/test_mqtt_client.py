@@ -0,0 +1,38 @@
+from threading import Event
+
+import consts
+from fake_broker import FakeBroker
+from mesh_controller import MeshController
+from mesh_graph import MeshGraph
+from mqtt_client import MqttClient
+from mqtt_logger import MqttLogger
+
+
+def test_outbox_waits_for_the_crt_to_reconnect():
+    broker = FakeBroker()
+    received = Event()
+    listener = broker.transport(client_id="bridge")
+    listener.connect()
+    listener.subscribe(
+        consts.CHECK_CONN_TOPIC, qos=None, callback=lambda **kwargs: received.set()
+    )
+    client = MqttClient(
+        logger=MqttLogger(),
+        controller=MeshController(),
+        graph=MeshGraph(),
+        transport=broker.transport,
+    )
+    client.RECONNECT_MIN_S = 0.01
+    client.connect()
+
+    # Up as far as the client knows, but not delivering
+    client._conn.connected = False
+    client.publish(consts.CHECK_CONN_TOPIC)
+    assert not received.wait(0.2)
+    # Failed publishes are retried, without reconnecting behind the CRT's back
+    assert not client._conn.connected
+    assert client.publish_metrics["outbox"] == 1
+
+    client._conn.interrupt()
+    client._conn.resume()
+    assert received.wait(5)
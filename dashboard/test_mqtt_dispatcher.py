@@ -0,0 +1,46 @@
+from chicken_udp import ChickenUDP
+from mqtt_dispatcher import MqttDispatcher
+
+
+def test_worker_survives_a_poisoned_message():
+    received = []
+    dispatcher = MqttDispatcher()
+    dispatcher.register("topic", lambda topic, message: received.append(message))
+    dispatcher.start()
+    # Not UTF-8, nested past the recursion limit, and a bad frame
+    dispatcher.submit("topic", b"\xff\xfe")
+    dispatcher.submit("topic", b"[" * 100000)
+    dispatcher.submit("topic", bytes([1, 0]) + b"\x91" * 5000 + b"\x00" * 4)
+    dispatcher.submit("topic", b'{"node_id": 1}')
+    dispatcher.join()
+    assert received == [{"node_id": 1}]
+    assert dispatcher.metrics()["invalid"] == 3
+
+
+def test_worker_survives_a_failing_decoder(monkeypatch):
+    received = []
+    dispatcher = MqttDispatcher()
+    dispatcher.register("topic", lambda topic, message: received.append(message))
+
+    def unpack_data(payload):
+        raise RuntimeError("decoder bug")
+
+    monkeypatch.setattr(dispatcher._cudp, "unpack_data", unpack_data)
+    dispatcher.start()
+    dispatcher.submit("topic", ChickenUDP.package_data({"node_id": 1}))
+    dispatcher.submit("topic", b'{"node_id": 2}')
+    dispatcher.join()
+    assert received == [{"node_id": 2}]
+    assert dispatcher.metrics()["invalid"] == 1
+
+
+def test_messages_reach_their_handlers():
+    received = []
+    dispatcher = MqttDispatcher(workers=2)
+    dispatcher.register(None, lambda topic, message: received.append(topic))
+    dispatcher.register("b", lambda topic, message: received.append(message))
+    dispatcher.start()
+    dispatcher.submit("a", b"")
+    dispatcher.submit("b", ChickenUDP.package_data({"node_id": 2}))
+    dispatcher.join()
+    assert sorted(received, key=str) == ["a", "b", {"node_id": 2}]
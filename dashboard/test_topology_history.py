@@ -0,0 +1,41 @@
+import os
+
+from topology_history import TopologyHistory
+
+
+def topology(step: int):
+    nodes = {str(node): (f"node-{node}", node == 0) for node in range(step % 5 + 2)}
+    edges = {("0", node_id) for node_id in nodes if node_id != "0"}
+    return nodes, edges
+
+
+def record(history: TopologyHistory, steps: range):
+    for step in steps:
+        history.record(float(step), *topology(step))
+
+
+def test_history_survives_a_restart(tmp_path):
+    history = TopologyHistory(spill_dir=str(tmp_path))
+    history.SNAPSHOT_EVERY = history.MAX_CHUNKS_IN_MEMORY = 4
+    record(history, range(40))
+    history.close()
+
+    restarted = TopologyHistory(spill_dir=str(tmp_path))
+    assert len(restarted) == 40
+    assert restarted.first_time == 0.0
+    record(restarted, range(40, 45))
+    for step in (0, 17, 39, 44):
+        assert restarted.at(step + 0.5) == topology(step)
+
+
+def test_oldest_spilled_chunks_are_deleted(tmp_path):
+    history = TopologyHistory(spill_dir=str(tmp_path))
+    history.SNAPSHOT_EVERY = 4
+    record(history, range(40))
+    history.close()
+
+    restarted = TopologyHistory(spill_dir=str(tmp_path), max_chunks=3)
+    assert len(os.listdir(tmp_path)) == 3
+    assert restarted.first_time == 28.0
+    assert restarted.at(1) is None
+    assert restarted.at(30) == topology(30)
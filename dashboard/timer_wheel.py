@@ -0,0 +1,81 @@
+from math import ceil
+from typing import Dict, Hashable, List, Set
+
+
+class TimerWheel:
+    """Hashed timer wheel of one deadline per key.
+
+    Deadlines are filed in the slot of their tick, modulo the wheel size.
+    Moving a deadline later (the usual case, a node that was heard from
+    again) only updates it: the key stays filed where it was and is moved
+    to the slot of its new deadline when that slot comes round. Scheduling
+    is O(1) and each tick only visits the keys filed in its slot.
+    """
+
+    TICK_S: float = 1.0
+    SLOTS: int = 256
+
+    _tick_s: float
+    _slots: List[Set[Hashable]]
+    _deadlines: Dict[Hashable, float]
+    # Tick each key is filed under; a key found in a slot for another tick
+    # was moved or cancelled since
+    _filed: Dict[Hashable, int]
+    _tick: int
+
+    def __init__(self, now: float, tick_s: float = TICK_S, slots: int = SLOTS):
+        self._tick_s = tick_s
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}
+        self._filed = {}
+        self._tick = int(now // tick_s)
+
+    def _file(self, key: Hashable, deadline: float):
+        tick = max(ceil(deadline / self._tick_s), self._tick + 1)
+        self._filed[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """Expire `key` at `deadline`, replacing any deadline it had."""
+        filed = self._filed.get(key)
+        self._deadlines[key] = deadline
+        # Filed at or before the new deadline: re-filed when reached
+        if filed is None or filed > ceil(deadline / self._tick_s):
+            self._file(key, deadline)
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+        self._filed.pop(key, None)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Move the wheel to `now` and return the keys that expired, which
+        are no longer scheduled."""
+        expired = []
+        target = int(now // self._tick_s)
+        while self._tick < target:
+            self._tick += 1
+            index = self._tick % len(self._slots)
+            slot = self._slots[index]
+            for key in list(slot):
+                tick = self._filed.get(key)
+                if tick is not None and tick > self._tick:
+                    if tick % len(self._slots) == index:
+                        # Filed for a later turn of the wheel
+                        continue
+                slot.discard(key)
+                if tick != self._tick:
+                    continue
+                del self._filed[key]
+                deadline = self._deadlines[key]
+                if ceil(deadline / self._tick_s) > self._tick:
+                    self._file(key, deadline)
+                else:
+                    del self._deadlines[key]
+                    expired.append(key)
+        return expired
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
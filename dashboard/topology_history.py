@@ -0,0 +1,215 @@
+import glob
+import json
+import os
+from typing import Dict, List, Optional, Set, Tuple
+from bisect import bisect_right
+from threading import Lock
+
+Nodes = Dict[str, Tuple[str, bool]]
+Edges = Set[Tuple[str, str]]
+
+
+class _Chunk:
+    """A full snapshot followed by the deltas recorded after it.
+
+    Entries are `[nodes, edges]` for the snapshot and `[added nodes, removed
+    node ids, added edges, removed edges]` for each delta, in JSON-friendly
+    lists. Once spilled, `times` and `entries` are None and both live in
+    `path`; only their count stays in memory.
+    """
+
+    __slots__ = ("times", "entries", "path", "size")
+
+    times: Optional[List[float]]
+    entries: Optional[List[List]]
+    path: Optional[str]
+    size: int
+
+    def __init__(self, time: float, nodes: Nodes, edges: Edges):
+        self.times = [time]
+        self.entries = [
+            [
+                [[node_id, *attrs] for node_id, attrs in sorted(nodes.items())],
+                sorted(edges),
+            ]
+        ]
+        self.path = None
+        self.size = 1
+
+    @classmethod
+    def spilled(cls, path: str, size: int) -> "_Chunk":
+        chunk = cls.__new__(cls)
+        chunk.times = chunk.entries = None
+        chunk.path = path
+        chunk.size = size
+        return chunk
+
+
+class TopologyHistory:
+    """Every topology the mesh reported, for replay and flap counting.
+
+    A full snapshot is stored every SNAPSHOT_EVERY changes and node/edge
+    deltas in between. Looking up the topology at a time is a binary search
+    over snapshots, one over the deltas after it and replaying at most
+    SNAPSHOT_EVERY of them. Only the newest MAX_CHUNKS_IN_MEMORY snapshots
+    (and their deltas) are kept in memory, older ones are spilled to
+    `spill_dir` and read back when looked up. Past MAX_CHUNKS the oldest
+    chunk is forgotten and its spill file deleted.
+
+    `close` spills the chunks still in memory too, and a history created on
+    the same `spill_dir` picks them up, so the history survives a restart.
+    """
+
+    SNAPSHOT_EVERY: int = 64
+    MAX_CHUNKS_IN_MEMORY: int = 64
+    # About 11 days of reports once a minute
+    MAX_CHUNKS: int = 256
+
+    _chunks: List[_Chunk]
+    _chunk_starts: List[float]
+    _max_chunks: int
+    _spill_dir: Optional[str]
+    _loaded: Optional[Tuple[str, List]]
+    _last: Optional[Tuple[Nodes, Edges]]
+    _flaps: Dict[str, int]
+    _lock: Lock
+
+    def __init__(self, spill_dir: Optional[str] = None, max_chunks: int = MAX_CHUNKS):
+        self._chunks = []
+        self._chunk_starts = []
+        self._max_chunks = max_chunks
+        self._spill_dir = spill_dir
+        self._load_spilled()
+        self._loaded = None
+        self._last = None
+        self._flaps = {}
+        self._lock = Lock()
+
+    def record(self, time: float, nodes: Nodes, edges: Edges):
+        """Add the topology reported at `time`, newer than any recorded."""
+        with self._lock:
+            last = self._last
+            self._last = (dict(nodes), set(edges))
+            if last is None or self._chunks[-1].size >= self.SNAPSHOT_EVERY:
+                self._chunks.append(_Chunk(time, nodes, edges))
+                self._chunk_starts.append(time)
+                self._evict()
+                self._spill()
+            else:
+                last_nodes, last_edges = last
+                chunk = self._chunks[-1]
+                chunk.times.append(time)
+                chunk.size += 1
+                chunk.entries.append(
+                    [
+                        [
+                            [node_id, *attrs]
+                            for node_id, attrs in sorted(nodes.items())
+                            if last_nodes.get(node_id) != attrs
+                        ],
+                        sorted(last_nodes.keys() - nodes.keys()),
+                        sorted(edges - last_edges),
+                        sorted(last_edges - edges),
+                    ]
+                )
+            if last is not None:
+                # A flap is a node dropping out of the mesh
+                for node_id in last[0].keys() - nodes.keys():
+                    self._flaps[node_id] = self._flaps.get(node_id, 0) + 1
+
+    def _evict(self):
+        while len(self._chunks) > self._max_chunks:
+            chunk = self._chunks.pop(0)
+            self._chunk_starts.pop(0)
+            if chunk.path:
+                if self._loaded is not None and self._loaded[0] == chunk.path:
+                    self._loaded = None
+                os.remove(chunk.path)
+
+    def _spill(self, keep: Optional[int] = None):
+        if not self._spill_dir:
+            return
+        if keep is None:
+            keep = self.MAX_CHUNKS_IN_MEMORY
+        in_memory = [chunk for chunk in self._chunks if chunk.entries is not None]
+        for chunk in in_memory[: len(in_memory) - keep]:
+            os.makedirs(self._spill_dir, exist_ok=True)
+            # The name has what is kept in memory, so a later session can list
+            # the chunks without reading them
+            path = os.path.join(
+                self._spill_dir, f"topology-{chunk.times[0]:.3f}-{chunk.size}.json"
+            )
+            with open(path, "w") as f:
+                json.dump([chunk.times, chunk.entries], f, separators=(",", ":"))
+            chunk.path = path
+            chunk.times = chunk.entries = None
+
+    def _load_spilled(self):
+        """Pick up the newest `max_chunks` chunks spilled by an earlier
+        session and delete the older ones."""
+        if not self._spill_dir:
+            return
+        spilled = []
+        for path in glob.glob(os.path.join(self._spill_dir, "topology-*-*.json")):
+            try:
+                start, size = os.path.basename(path)[9:-5].rsplit("-", 1)
+                spilled.append((float(start), int(size), path))
+            except ValueError:
+                continue
+        spilled.sort()
+        for _, _, path in spilled[: max(len(spilled) - self._max_chunks, 0)]:
+            os.remove(path)
+        for start, size, path in spilled[-self._max_chunks :]:
+            self._chunks.append(_Chunk.spilled(path, size))
+            self._chunk_starts.append(start)
+
+    def close(self):
+        """Spill the chunks still in memory, for the next session to pick up.
+        The next topology recorded starts a new chunk."""
+        with self._lock:
+            self._spill(keep=0)
+            self._last = None
+
+    def _times_and_entries(self, chunk: _Chunk) -> Tuple[List[float], List[List]]:
+        if chunk.entries is not None:
+            return chunk.times, chunk.entries
+        # Replaying back and forth usually stays within one spilled chunk
+        if self._loaded is None or self._loaded[0] != chunk.path:
+            with open(chunk.path) as f:
+                self._loaded = (chunk.path, json.load(f))
+        return self._loaded[1]
+
+    def at(self, time: float) -> Optional[Tuple[Nodes, Edges]]:
+        """Nodes and edges the mesh had at `time`, None before the first report."""
+        with self._lock:
+            chunk_index = bisect_right(self._chunk_starts, time) - 1
+            if chunk_index < 0:
+                return None
+            times, entries = self._times_and_entries(self._chunks[chunk_index])
+            last = bisect_right(times, time)
+
+        snapshot_nodes, snapshot_edges = entries[0]
+        nodes = {
+            node_id: (label, is_root) for node_id, label, is_root in snapshot_nodes
+        }
+        edges = {tuple(edge) for edge in snapshot_edges}
+        for added_nodes, removed_nodes, added_edges, removed_edges in entries[1:last]:
+            for node_id, label, is_root in added_nodes:
+                nodes[node_id] = (label, is_root)
+            for node_id in removed_nodes:
+                del nodes[node_id]
+            edges.difference_update(tuple(edge) for edge in removed_edges)
+            edges.update(tuple(edge) for edge in added_edges)
+        return nodes, edges
+
+    def flap_counts(self) -> Dict[str, int]:
+        """How many times each node dropped out of the mesh."""
+        with self._lock:
+            return dict(self._flaps)
+
+    @property
+    def first_time(self) -> Optional[float]:
+        return self._chunk_starts[0] if self._chunk_starts else None
+
+    def __len__(self) -> int:
+        return sum(chunk.size for chunk in self._chunks)
@@ -0,0 +1,296 @@
+"""ChickenUDP framing, as in mesh/lib/ChickenUDP/ChickenUDP.h.
+
+A JSON frame is the compact JSON of the application data followed by the
+CRC32 (zlib's, the same the Arduino CRC32 library computes) of that JSON as
+8 hex digits. The bridge checks the frames the nodes send it and packs what
+it forwards to MQTT the same way, so they can be checked again on this side.
+
+A binary frame starts with a version byte (BINARY_V1), which a JSON frame,
+starting with `{`, never does. It is followed by the message type, the
+MessagePack array of the values in the order of MEASUREMENT_FIELDS (plus
+the node id and name once the bridge forwards it) and the CRC32 of all of
+that as 4 little-endian bytes. Nodes send it base64-encoded over the mesh
+and the bridge publishes it raw.
+
+lambda/ and dashboard/ each keep a copy of this module, as they are
+deployed separately.
+"""
+
+import json
+import re
+import struct
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from zlib import crc32
+
+Frame = Union[bytes, bytearray, memoryview]
+
+CHECKSUM_LENGTH = 8
+_HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+_CLOSING_BRACE = ord("}")
+# Enough to tell which node sent a frame that fails to check or parse
+_NODE_ID = re.compile(rb'"node_id":(\d{1,10})[,}]')
+
+BINARY_V1 = 0x01
+BINARY_CHECKSUM_LENGTH = 4
+# Header byte and message type
+BINARY_HEADER_LENGTH = 2
+# msg_types in mesh/include/const.h
+MEASUREMENTS = 0
+MEASUREMENT_FIELDS = ("temperature", "humidity", "luminosity", "hazardous_gas_warning")
+
+
+def is_framed(payload: Frame) -> bool:
+    """Whether `payload` is a binary frame or ends like a JSON frame (a JSON
+    object then 8 hex digits), rather than being plain JSON."""
+    if len(payload) and payload[0] == BINARY_V1:
+        return True
+    return (
+        len(payload) > CHECKSUM_LENGTH
+        and payload[-CHECKSUM_LENGTH - 1] == _CLOSING_BRACE
+        and all(byte in _HEX_DIGITS for byte in payload[-CHECKSUM_LENGTH:])
+    )
+
+
+def _pack_msgpack(value, out: bytearray):
+    """MessagePack of the types ArduinoJson writes, each integer in its
+    smallest encoding. Floats are written as float32 when that loses
+    nothing and float64 otherwise; the firmware's readings are floats, so
+    its frames always carry float32. Either decodes the same."""
+    if value is None:
+        out.append(0xC0)
+    elif value is True or value is False:
+        out.append(0xC3 if value else 0xC2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xFF)
+        elif value >= 0:
+            for code, fmt in ((0xCC, ">B"), (0xCD, ">H"), (0xCE, ">I"), (0xCF, ">Q")):
+                if value < 1 << (8 * struct.calcsize(fmt)):
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        else:
+            for code, fmt in ((0xD0, ">b"), (0xD1, ">h"), (0xD2, ">i"), (0xD3, ">q")):
+                if value >= -(1 << (8 * struct.calcsize(fmt) - 1)):
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+    elif isinstance(value, float):
+        as_float32 = struct.pack(">f", value)
+        if struct.unpack(">f", as_float32)[0] == value:
+            out.append(0xCA)
+            out += as_float32
+        else:
+            out.append(0xCB)
+            out += struct.pack(">d", value)
+    elif isinstance(value, str):
+        encoded = value.encode()
+        if len(encoded) < 32:
+            out.append(0xA0 | len(encoded))
+        elif len(encoded) < 1 << 8:
+            out += struct.pack(">BB", 0xD9, len(encoded))
+        else:
+            out += struct.pack(">BH", 0xDA, len(encoded))
+        out += encoded
+    elif isinstance(value, (list, tuple)):
+        if len(value) < 16:
+            out.append(0x90 | len(value))
+        else:
+            out += struct.pack(">BH", 0xDC, len(value))
+        for item in value:
+            _pack_msgpack(item, out)
+    else:
+        raise TypeError(f"cannot pack {type(value).__name__}")
+
+
+_FIXED = {
+    0xCA: ">f",
+    0xCB: ">d",
+    0xCC: ">B",
+    0xCD: ">H",
+    0xCE: ">I",
+    0xCF: ">Q",
+    0xD0: ">b",
+    0xD1: ">h",
+    0xD2: ">i",
+    0xD3: ">q",
+}
+
+
+def _unpack_msgpack(view: memoryview, position: int = 0) -> Tuple[object, int]:
+    """The scalar at `position` and the position after it, for the types
+    ArduinoJson writes (no arrays, maps, binaries or extensions inside the
+    values of a frame)."""
+    code = view[position]
+    position += 1
+    if code < 0x80:
+        return code, position
+    if code >= 0xE0:
+        return code - 0x100, position
+    if code in _FIXED:
+        fmt = _FIXED[code]
+        return struct.unpack_from(fmt, view, position)[0], position + struct.calcsize(
+            fmt
+        )
+    if 0xA0 <= code <= 0xBF or code in (0xD9, 0xDA):
+        if code == 0xD9:
+            length, position = view[position], position + 1
+        elif code == 0xDA:
+            length, position = struct.unpack_from(">H", view, position)[0], position + 2
+        else:
+            length = code & 0x1F
+        end = position + length
+        if end > len(view):
+            raise ValueError("string past the end of the frame")
+        return str(view[position:end], "utf-8"), end
+    if code in (0xC0, 0xC2, 0xC3):
+        return {0xC0: None, 0xC2: False, 0xC3: True}[code], position
+    raise ValueError(f"unsupported MessagePack type 0x{code:02x}")
+
+
+def _unpack_values(view: memoryview) -> List[object]:
+    """The flat array of scalars that makes up the values of a binary frame."""
+    code = view[0]
+    if 0x90 <= code <= 0x9F:
+        length, position = code & 0x0F, 1
+    elif code == 0xDC:
+        length, position = struct.unpack_from(">H", view, 1)[0], 3
+    else:
+        raise ValueError("values are not an array")
+    values = []
+    for _ in range(length):
+        value, position = _unpack_msgpack(view, position)
+        values.append(value)
+    if position != len(view):
+        raise ValueError("bytes past the values")
+    return values
+
+
+class ChickenUDP:
+    """Packs and unpacks frames and counts the invalid ones per node."""
+
+    _invalid_frames: Dict[Optional[int], int]
+    _lock: Lock
+
+    def __init__(self):
+        self._invalid_frames = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def package_data(app_data: Dict) -> bytes:
+        # Compact and not ASCII-escaped, as ArduinoJson's serializeJson writes
+        body = json.dumps(app_data, separators=(",", ":"), ensure_ascii=False)
+        body = body.encode()
+        return body + b"%08x" % crc32(body)
+
+    @staticmethod
+    def package_binary(app_data: Dict, msg_type: int = MEASUREMENTS) -> bytes:
+        """Binary frame of a measurement laid out as the JSON ones are:
+        `data` with MEASUREMENT_FIELDS, and `node_id` and `node_name` when
+        the bridge adds them."""
+        values = [app_data["data"][field] for field in MEASUREMENT_FIELDS]
+        if "node_id" in app_data:
+            values += [app_data["node_id"], app_data["node_name"]]
+        frame = bytearray((BINARY_V1, msg_type))
+        _pack_msgpack(values, frame)
+        frame += struct.pack("<I", crc32(frame))
+        return bytes(frame)
+
+    def unpack_data(self, frame: Frame) -> Optional[Dict]:
+        """The application data of `frame`, or None when it is invalid."""
+        return self.unpack_batch([frame])[0]
+
+    def unpack_batch(self, frames: Sequence[Frame]) -> List[Optional[Dict]]:
+        """The application data of each frame, None for the invalid ones.
+
+        Checksums are computed over memoryviews of the frames, so the JSON
+        is never copied before the CRCs of the whole batch are known, and
+        only the valid frames are decoded.
+        """
+        views = [memoryview(frame) for frame in frames]
+        valid = []
+        for view in views:
+            if len(view) and view[0] == BINARY_V1:
+                valid.append(
+                    len(view) > BINARY_HEADER_LENGTH + BINARY_CHECKSUM_LENGTH
+                    and crc32(view[:-BINARY_CHECKSUM_LENGTH])
+                    == int.from_bytes(view[-BINARY_CHECKSUM_LENGTH:], "little")
+                )
+                continue
+            try:
+                checksum = int(bytes(view[-CHECKSUM_LENGTH:]), 16)
+            except ValueError:
+                valid.append(False)
+                continue
+            valid.append(
+                len(view) > CHECKSUM_LENGTH
+                and crc32(view[:-CHECKSUM_LENGTH]) == checksum
+            )
+
+        app_data = []
+        for view, is_valid in zip(views, valid):
+            data = self._decode(view) if is_valid else None
+            if not isinstance(data, dict):
+                self._count_invalid(view)
+                data = None
+            app_data.append(data)
+        return app_data
+
+    @staticmethod
+    def _decode(view: memoryview) -> Optional[object]:
+        if view[0] == BINARY_V1:
+            return ChickenUDP._decode_binary(view)
+        try:
+            return json.loads(str(view[:-CHECKSUM_LENGTH], "utf-8"))
+        except (ValueError, RecursionError):
+            return None
+
+    @staticmethod
+    def _decode_binary(view: memoryview) -> Optional[Dict]:
+        """The same dict the equivalent JSON frame unpacks to."""
+        payload = view[BINARY_HEADER_LENGTH:-BINARY_CHECKSUM_LENGTH]
+        try:
+            values = _unpack_values(payload)
+        except (ValueError, IndexError, struct.error):
+            return None
+        fields = len(MEASUREMENT_FIELDS)
+        if len(values) not in (fields, fields + 2):
+            return None
+        app_data = {"data": dict(zip(MEASUREMENT_FIELDS, values))}
+        if len(values) == fields:
+            # Straight from a node, the bridge drops the type when forwarding
+            app_data["msg_type"] = view[1]
+        else:
+            app_data["node_id"], app_data["node_name"] = values[fields:]
+        return app_data
+
+    def _count_invalid(self, view: memoryview):
+        node_id = self._node_id(view)
+        with self._lock:
+            self._invalid_frames[node_id] = self._invalid_frames.get(node_id, 0) + 1
+
+    @staticmethod
+    def _node_id(view: memoryview) -> Optional[int]:
+        """The node a damaged frame names, if that part of it still reads.
+        Frames are not decoded again, only searched, as they may be hostile."""
+        if len(view) and view[0] == BINARY_V1:
+            fields = len(MEASUREMENT_FIELDS)
+            try:
+                values = _unpack_values(
+                    view[BINARY_HEADER_LENGTH:-BINARY_CHECKSUM_LENGTH]
+                )
+            except (ValueError, IndexError, struct.error):
+                return None
+            node_id = values[fields] if len(values) == fields + 2 else None
+            return node_id if type(node_id) is int else None
+        match = _NODE_ID.search(view)
+        return int(match[1]) if match else None
+
+    @property
+    def invalid_frames(self) -> Dict[Optional[int], int]:
+        """Invalid frames per node id, None for those that named no node."""
+        with self._lock:
+            return dict(self._invalid_frames)
@@ -0,0 +1,106 @@
+"""Throughput/latency benchmark for the ingest daemon.
+
+A publisher thread stands in for the MQTT broker, delivering measurement
+payloads to `IngestDaemon.submit` the same way the CRT callback thread does.
+Rows go to a fake writer with a configurable per-batch latency, or to a real
+Postgres when `--conninfo` is given.
+
+    python ingest_benchmark.py --messages 100000 --batch-size 500 --write-latency-ms 20
+"""
+
+import argparse
+import asyncio
+import threading
+from json import dumps
+from statistics import quantiles
+from time import monotonic, sleep
+from typing import List, Tuple
+
+from ingest_daemon import IngestDaemon, PostgresWriter
+
+
+class FakeWriter:
+    def __init__(self, sent_at: List[float], write_latency: float):
+        self._sent_at = sent_at
+        self._write_latency = write_latency
+        self.latencies = []
+
+    async def write(self, rows: List[Tuple]):
+        await asyncio.sleep(self._write_latency)
+        now = monotonic()
+        self.latencies.extend(now - self._sent_at[row[0]] for row in rows)
+
+
+def publish(daemon: IngestDaemon, sent_at: List[float], messages: int, rate: float):
+    interval = 1 / rate if rate else 0
+    for seq in range(messages):
+        payload = dumps(
+            {
+                "data": {
+                    "temperature": 23.2,
+                    "humidity": 61.0,
+                    "luminosity": 0.7,
+                    "hazardous_gas_warning": 0.0,
+                },
+                "node_id": seq,
+                "node_name": f"node-{seq % 100}",
+            }
+        ).encode()
+        sent_at[seq] = monotonic()
+        daemon.submit(payload)
+        interval and sleep(interval)
+
+
+async def run(args):
+    sent_at = [0.0] * args.messages
+    if args.conninfo:
+        writer = PostgresWriter(args.conninfo)
+        await writer.open()
+    else:
+        writer = FakeWriter(sent_at, args.write_latency_ms / 1000)
+
+    daemon = IngestDaemon(
+        writer,
+        batch_size=args.batch_size,
+        flush_interval_ms=args.flush_interval_ms,
+        max_queued_rows=args.max_queued_rows,
+    )
+    runner = asyncio.create_task(daemon.run())
+    await asyncio.sleep(0)
+
+    start = monotonic()
+    publisher = threading.Thread(
+        target=publish, args=(daemon, sent_at, args.messages, args.rate)
+    )
+    publisher.start()
+    await asyncio.to_thread(publisher.join)
+    await daemon.drain()
+    elapsed = monotonic() - start
+    runner.cancel()
+
+    print(f"rows written:     {daemon.rows_written}")
+    print(f"elapsed:          {elapsed:.3f} s")
+    print(f"throughput:       {daemon.rows_written / elapsed:,.0f} rows/s")
+    print(f"flushes:          {daemon.flushes}")
+    print(f"rows dropped:     {daemon.rows_dropped}")
+    if isinstance(writer, FakeWriter):
+        p50, p90, p99 = [quantiles(writer.latencies, n=100)[i] for i in (49, 89, 98)]
+        print(
+            f"row latency (ms): p50={p50 * 1000:.1f} p90={p90 * 1000:.1f} p99={p99 * 1000:.1f}"
+        )
+    else:
+        await writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="messages/s, 0 = unthrottled"
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--flush-interval-ms", type=int, default=1000)
+    parser.add_argument("--max-queued-rows", type=int, default=10000)
+    parser.add_argument("--write-latency-ms", type=float, default=20)
+    parser.add_argument("--conninfo", help="benchmark against a real Postgres instead")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,293 @@
+"""MQTT to Postgres ingest daemon, an alternative to the Lambda.
+
+Needs requirements-daemon.txt, which adds the MQTT client to the Lambda's
+requirements.
+"""
+
+import asyncio
+import os
+import random
+from collections import deque
+from json import loads
+from time import monotonic
+from typing import Deque, List, Optional, Tuple
+
+from aws_lambda_powertools import Logger
+from awscrt import io, mqtt
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+from chicken_udp import ChickenUDP, is_framed
+from main import (
+    MEASUREMENT_COLUMNS,
+    ROLLUP_UPSERT_SQL,
+    create_rollup_table,
+    flatten_measurement,
+    measurement_row,
+    rollup_rows,
+)
+
+logger = Logger(service="ingest-daemon")
+
+MEASUREMENTS_TOPIC = "internet-of-poultry/mesh/measurements"
+
+
+class PostgresWriter:
+    """Writes batches of rows through a single pooled async connection."""
+
+    _conninfo: str
+    _pool: AsyncConnectionPool
+
+    def __init__(self, conninfo: str):
+        self._conninfo = conninfo
+        self._pool = AsyncConnectionPool(
+            conninfo,
+            min_size=1,
+            max_size=1,
+            open=False,
+            check=AsyncConnectionPool.check_connection,
+        )
+
+    async def open(self):
+        await asyncio.to_thread(self._create_rollup_table)
+        await self._pool.open(wait=True)
+
+    def _create_rollup_table(self):
+        with psycopg.connect(self._conninfo) as conn:
+            create_rollup_table(conn)
+
+    async def close(self):
+        await self._pool.close()
+
+    async def write(self, rows: List[Tuple]):
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(
+                    f"COPY measurements ({', '.join(MEASUREMENT_COLUMNS)}) FROM STDIN"
+                ) as copy:
+                    for row in rows:
+                        await copy.write_row(row)
+                await cur.executemany(ROLLUP_UPSERT_SQL, rollup_rows(rows))
+
+
+class IngestDaemon:
+    """Buffers measurements and flushes them every `batch_size` rows or
+    `flush_interval_ms` milliseconds, whichever comes first.
+
+    Incoming rows go through a bounded queue: when the writer falls behind the
+    queue fills up and `submit` waits up to `submit_timeout_ms` for room
+    instead of buffering without limit. Past that the row is dropped, and
+    so are the next ones until the queue has room again, so that a database
+    outage never holds the MQTT thread for long and the connection keeps
+    its keep-alives. A batch that fails to be written is retried until it
+    is; when the database rejects it instead, it is split in halves until
+    the rows at fault are found and discarded.
+    """
+
+    # Retry delays grow from the min to the max, each drawn at random below
+    # the current bound
+    RETRY_MIN_S: float = 0.5
+    RETRY_MAX_S: float = 30
+    # Latencies of the most recent flushes that are kept
+    FLUSH_LATENCIES_KEPT: int = 10000
+
+    _writer: PostgresWriter
+    _batch_size: int
+    _flush_interval: float
+    _submit_timeout: float
+    _queue: asyncio.Queue
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _shedding: bool
+
+    rows_written: int
+    rows_invalid: int
+    rows_dropped: int
+    flushes: int
+    cudp: ChickenUDP
+    flush_latencies: Deque[float]
+
+    def __init__(
+        self,
+        writer: PostgresWriter,
+        batch_size: int = 500,
+        flush_interval_ms: int = 1000,
+        max_queued_rows: int = 10000,
+        submit_timeout_ms: int = 1000,
+    ):
+        self._writer = writer
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval_ms / 1000
+        self._submit_timeout = submit_timeout_ms / 1000
+        self._queue = asyncio.Queue(maxsize=max_queued_rows)
+        self._loop = None
+        self._shedding = False
+        self.rows_written = 0
+        self.rows_invalid = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self.cudp = ChickenUDP()
+        self.flush_latencies = deque(maxlen=self.FLUSH_LATENCIES_KEPT)
+
+    def _parse(self, payload: bytes) -> Optional[Tuple]:
+        try:
+            if is_framed(payload):
+                measurement = self.cudp.unpack_data(payload)
+                if measurement is None:
+                    raise ValueError("invalid ChickenUDP frame")
+            else:
+                measurement = loads(payload)
+            return measurement_row(flatten_measurement(measurement))
+        except (KeyError, TypeError, ValueError, RecursionError) as e:
+            self.rows_invalid += 1
+            logger.warning("Discarded invalid measurement", extra={"error": repr(e)})
+            return None
+
+    async def put(self, payload: bytes):
+        row = self._parse(payload)
+        if row is None:
+            return
+        if self._shedding and self._queue.full():
+            self.rows_dropped += 1
+            return
+        try:
+            await asyncio.wait_for(self._queue.put(row), self._submit_timeout)
+        except asyncio.TimeoutError:
+            self.rows_dropped += 1
+            if not self._shedding:
+                logger.warning(
+                    "Queue full, dropping measurements",
+                    extra={"rows_dropped": self.rows_dropped},
+                )
+            self._shedding = True
+        else:
+            if self._shedding:
+                logger.info(
+                    "Queue has room again",
+                    extra={"rows_dropped": self.rows_dropped},
+                )
+            self._shedding = False
+
+    def submit(self, payload: bytes):
+        """Thread-safe entry point for the MQTT callback; blocks for at most
+        `submit_timeout_ms` while the queue is full."""
+        asyncio.run_coroutine_threadsafe(self.put(payload), self._loop).result()
+
+    def on_message(self, topic: str, payload: bytes, **kwargs):
+        self.submit(payload)
+
+    async def _next_batch(self) -> List[Tuple]:
+        batch = [await self._queue.get()]
+        deadline = monotonic() + self._flush_interval
+        while len(batch) < self._batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch: List[Tuple]):
+        start = monotonic()
+        written = await self._write(batch)
+        self._done(batch)
+        self.rows_written += written
+        self.flushes += 1
+        self.flush_latencies.append(monotonic() - start)
+
+    async def _write(self, rows: List[Tuple]) -> int:
+        """Write `rows` and return how many were written."""
+        attempt = 0
+        while True:
+            try:
+                await self._writer.write(rows)
+                return len(rows)
+            except (psycopg.DataError, psycopg.IntegrityError):
+                # Rejected by the database, not by an outage: retrying would
+                # stall ingest for good, so only the rows at fault are dropped
+                if len(rows) == 1:
+                    self.rows_invalid += 1
+                    logger.exception("Discarded row", extra={"row": rows[0]})
+                    return 0
+                half = len(rows) // 2
+                return await self._write(rows[:half]) + await self._write(rows[half:])
+            except Exception:
+                attempt += 1
+                delay = self._backoff(attempt)
+                logger.exception(
+                    "Failed to write batch, retrying",
+                    extra={"rows": len(rows), "attempt": attempt, "delay_s": delay},
+                )
+                await asyncio.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        bound = min(self.RETRY_MIN_S * 2 ** (attempt - 1), self.RETRY_MAX_S)
+        return random.uniform(0, bound)
+
+    def _done(self, batch: List[Tuple]):
+        for _ in batch:
+            self._queue.task_done()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        while True:
+            await self._flush(await self._next_batch())
+
+    async def drain(self):
+        await self._queue.join()
+
+
+def connect_mqtt(daemon: IngestDaemon, host: str, port: int) -> mqtt.Connection:
+    event_loop_group = io.EventLoopGroup(1)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+    conn = mqtt.Connection(
+        client=mqtt.Client(client_bootstrap),
+        host_name=host,
+        port=port,
+        client_id="iop-ingest-daemon",
+        clean_session=False,
+        keep_alive_secs=30,
+    )
+    conn.connect().result()
+    subscribe_future, _ = conn.subscribe(
+        MEASUREMENTS_TOPIC, qos=mqtt.QoS.AT_LEAST_ONCE, callback=daemon.on_message
+    )
+    subscribe_future.result()
+    logger.info(f"Subscribed to {MEASUREMENTS_TOPIC} on {host}:{port}")
+    return conn
+
+
+async def main():
+    writer = PostgresWriter(
+        f"host={os.environ['DB_HOST']} port={os.environ['DB_PORT']} "
+        f"user={os.environ['DB_USER']} password={os.environ['DB_PASSWORD']} "
+        f"dbname={os.environ['DB_NAME']} sslmode={os.environ.get('DB_SSLMODE', 'require')}"
+    )
+    daemon = IngestDaemon(
+        writer,
+        batch_size=int(os.environ.get("BATCH_SIZE", 500)),
+        flush_interval_ms=int(os.environ.get("FLUSH_INTERVAL_MS", 1000)),
+        max_queued_rows=int(os.environ.get("MAX_QUEUED_ROWS", 10000)),
+        submit_timeout_ms=int(os.environ.get("SUBMIT_TIMEOUT_MS", 1000)),
+    )
+    await writer.open()
+    runner = asyncio.create_task(daemon.run())
+    await asyncio.sleep(0)
+
+    conn = await asyncio.to_thread(
+        connect_mqtt,
+        daemon,
+        os.environ.get("MQTT_HOST", "localhost"),
+        int(os.environ.get("MQTT_PORT", 1883)),
+    )
+    try:
+        await runner
+    finally:
+        conn.disconnect().result()
+        await writer.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
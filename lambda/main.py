@@ -1,5 +1,7 @@
-from typing import Dict
+from base64 import b64decode
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
 from datetime import datetime
+from time import monotonic, perf_counter
 from dateutil import tz
 from json import loads
 
@@ -9,18 +11,24 @@ from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
 import psycopg
 
+from chicken_udp import ChickenUDP, is_framed
+
 logger = Logger()
+cudp = ChickenUDP()
+
+SECRET_NAME = "lambda_iot_credentials"
+REGION_NAME = "sa-east-1"
 
+T = TypeVar("T")
 
-def get_credentials() -> Dict:
-    secret_name = "lambda_iot_credentials"
-    region_name = "sa-east-1"
 
-    session = Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
+def get_credentials(client=None) -> Dict:
+    if client is None:
+        session = Session()
+        client = session.client(service_name="secretsmanager", region_name=REGION_NAME)
 
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+        get_secret_value_response = client.get_secret_value(SecretId=SECRET_NAME)
     except ClientError as e:
         raise e
 
@@ -28,47 +36,462 @@ def get_credentials() -> Dict:
     return loads(secret)
 
 
-def lambda_handler(event: Dict, context: LambdaContext):
-    db_credentials = get_credentials()
+class ConnectionManager:
+    """Keeps the database secret and connection alive across warm invocations.
+
+    The secret is cached for SECRET_TTL seconds and refreshed earlier if the
+    database rejects the cached credentials (e.g. after a rotation). The
+    connection is reopened whenever psycopg reports it as closed or broken,
+    or fails a `SELECT 1` after sitting idle for over IDLE_CHECK_S, as it
+    may have been dropped by the server while the Lambda was frozen.
+    """
+
+    SECRET_TTL: int = 300
+    IDLE_CHECK_S: float = 60
+
+    _secrets_client: object
+    _secret_ttl: int
+    _credentials: Optional[Dict]
+    _credentials_fetched_at: float
+    _conn: Optional[psycopg.Connection]
+    _last_used: float
+    _idle_check_s: float
+    _cold_start: bool
+
+    def __init__(
+        self,
+        secrets_client=None,
+        secret_ttl: int = SECRET_TTL,
+        idle_check_s: float = IDLE_CHECK_S,
+    ):
+        self._secrets_client = secrets_client
+        self._secret_ttl = secret_ttl
+        self._credentials = None
+        self._credentials_fetched_at = 0.0
+        self._conn = None
+        self._last_used = 0.0
+        self._idle_check_s = idle_check_s
+        self._cold_start = True
+
+    def _get_credentials(self, force_refresh: bool = False) -> Dict:
+        expired = monotonic() - self._credentials_fetched_at > self._secret_ttl
+        if force_refresh or expired or self._credentials is None:
+            if self._secrets_client is None:
+                session = Session()
+                self._secrets_client = session.client(
+                    service_name="secretsmanager", region_name=REGION_NAME
+                )
+            self._credentials = get_credentials(self._secrets_client)
+            self._credentials_fetched_at = monotonic()
+        return self._credentials
+
+    def _connect(self, db_credentials: Dict) -> psycopg.Connection:
+        return psycopg.connect(
+            host=db_credentials["host"],
+            port=db_credentials["port"],
+            user=db_credentials["username"],
+            password=db_credentials["password"],
+            dbname=db_credentials["dbname"],
+            sslmode="require",
+        )
+
+    def _open(self) -> psycopg.Connection:
+        db_credentials = self._get_credentials()
+        try:
+            return self._connect(db_credentials)
+        except psycopg.OperationalError:
+            # Cached secret may be stale after a rotation: refetch and retry once
+            logger.warning("Connection failed, refreshing database credentials")
+            return self._connect(self._get_credentials(force_refresh=True))
+
+    def _is_alive(self) -> bool:
+        if self._conn is None or self._conn.closed or self._conn.broken:
+            return False
+        if monotonic() - self._last_used < self._idle_check_s:
+            return True
+        # The flags only change once a query fails, so ask the server
+        try:
+            self._conn.execute("SELECT 1")
+            self._conn.rollback()
+        except psycopg.Error:
+            logger.warning("Idle database connection is gone, reconnecting")
+            return False
+        return True
+
+    def get_connection(self) -> psycopg.Connection:
+        start = perf_counter()
+        reused = self._is_alive()
+        if not reused:
+            self.close()
+            self._conn = self._open()
+
+        logger.info(
+            "Database connection ready",
+            extra={
+                "cold_start": self._cold_start,
+                "connection_reused": reused,
+                "connection_ms": round((perf_counter() - start) * 1000, 3),
+            },
+        )
+        self._cold_start = False
+        self._last_used = monotonic()
+        return self._conn
+
+    def run(self, operation: Callable[[psycopg.Connection], T]) -> T:
+        """Run `operation` in a transaction and commit it.
 
-    conn = psycopg.connect(
-        host=db_credentials["host"],
-        port=db_credentials["port"],
-        user=db_credentials["username"],
-        password=db_credentials["password"],
-        dbname=db_credentials["dbname"],
-        sslmode="require",
+        The operation must not commit: if the connection breaks before the
+        commit is sent nothing was written, so it is retried once on a new
+        connection, but a commit that fails may still have been applied and
+        is never retried.
+        """
+        for attempt in range(2):
+            conn = self.get_connection()
+            try:
+                result = operation(conn)
+            except psycopg.OperationalError:
+                if conn.broken and not attempt:
+                    # Server dropped a warm connection: reconnect and retry once
+                    logger.warning("Database connection broken, reconnecting")
+                    self.close()
+                    continue
+                if not conn.broken:
+                    conn.rollback()
+                raise
+            except Exception:
+                # Leave the warm connection usable for the next invocation
+                conn.rollback()
+                raise
+            conn.commit()
+            return result
+
+    def close(self):
+        if self._conn is not None and not self._conn.closed:
+            self._conn.close()
+        self._conn = None
+
+
+connection_manager = ConnectionManager()
+
+
+MEASUREMENT_COLUMNS = (
+    "node_id",
+    "node_name",
+    "temperature",
+    "humidity",
+    "luminosity",
+    "hazardous_gas_warning",
+    "timestamp",
+)
+NUMERIC_FIELDS = ("temperature", "humidity", "luminosity", "hazardous_gas_warning")
+
+# Rollup resolutions, named after their `date_trunc` field, and how to
+# truncate a timestamp to the start of its bucket
+ROLLUP_RESOLUTIONS = {
+    "minute": dict(second=0, microsecond=0),
+    "hour": dict(minute=0, second=0, microsecond=0),
+    "day": dict(hour=0, minute=0, second=0, microsecond=0),
+}
+ROLLUP_COLUMNS = (
+    "resolution",
+    "node_id",
+    "node_name",
+    "bucket",
+    "count",
+    *(f"{field}_{stat}" for field in NUMERIC_FIELDS for stat in ("min", "max", "sum")),
+)
+ROLLUP_TABLE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS measurements_rollup (
+        resolution text NOT NULL,
+        node_id bigint NOT NULL,
+        node_name text,
+        bucket timestamp NOT NULL,
+        count bigint NOT NULL,
+        {", ".join(f"{column} double precision" for column in ROLLUP_COLUMNS[5:])},
+        PRIMARY KEY (resolution, node_id, bucket)
+    )
+"""
+# Folds a batch's partial aggregates into the stored ones; mean is sum / count
+ROLLUP_UPSERT_SQL = f"""
+    INSERT INTO measurements_rollup AS r ({", ".join(ROLLUP_COLUMNS)})
+    VALUES ({", ".join(["%s"] * len(ROLLUP_COLUMNS))})
+    ON CONFLICT (resolution, node_id, bucket) DO UPDATE SET
+        node_name = coalesce(EXCLUDED.node_name, r.node_name),
+        count = r.count + EXCLUDED.count,
+        {", ".join(
+            f"{field}_min = least(r.{field}_min, EXCLUDED.{field}_min), "
+            f"{field}_max = greatest(r.{field}_max, EXCLUDED.{field}_max), "
+            f"{field}_sum = r.{field}_sum + EXCLUDED.{field}_sum"
+            for field in NUMERIC_FIELDS
+        )}
+"""
+
+# Recomputes whole buckets from `measurements` and overwrites them, so it can
+# run again without counting a reading twice
+ROLLUP_BACKFILL_SQL = f"""
+    INSERT INTO measurements_rollup AS r ({", ".join(ROLLUP_COLUMNS)})
+    SELECT
+        %(resolution)s::text,
+        node_id,
+        max(node_name),
+        date_trunc(%(resolution)s, timestamp),
+        count(*),
+        {", ".join(
+            f"min({field}), max({field}), sum({field})" for field in NUMERIC_FIELDS
+        )}
+    FROM measurements
+    WHERE node_id IS NOT NULL AND timestamp IS NOT NULL
+    GROUP BY 2, 4
+    ON CONFLICT (resolution, node_id, bucket) DO UPDATE SET
+        node_name = coalesce(EXCLUDED.node_name, r.node_name),
+        {", ".join(
+            f"{column} = EXCLUDED.{column}" for column in ROLLUP_COLUMNS[4:]
+        )}
+"""
+# Whether the rollups miss the oldest measurements, i.e. the table was
+# created after them and never backfilled
+ROLLUP_MISSES_HISTORY_SQL = """
+    SELECT coalesce(
+        (SELECT min(bucket) FROM measurements_rollup WHERE resolution = 'day')
+        > (SELECT date_trunc('day', timestamp) FROM measurements ORDER BY id LIMIT 1),
+        true
     )
-    logger.info("Connected! Event is: " + str(event))
+"""
+# Advisory lock serializing the creation and backfill across writers
+ROLLUP_LOCK_ID = 2011
+
+
+def flatten_measurement(payload: Dict) -> Dict:
+    """Map the bridge message layout to a flat measurement event.
+
+    The bridge publishes `{"data": {...}, "node_id": ..., "node_name": ...}`
+    as a ChickenUDP frame. Events that are already flat are returned as is.
+    """
+    data = payload.get("data")
+    if isinstance(data, dict):
+        return {
+            **data,
+            "node_id": payload.get("node_id"),
+            "node_name": payload.get("node_name"),
+        }
+    return payload
+
+
+def measurement_row(event: Dict) -> Tuple:
+    """Validate a measurement event and map it to a `measurements` row."""
+    if not isinstance(event, dict):
+        raise ValueError(f"measurement must be an object, got {type(event).__name__}")
 
     node_id = event["node_id"]
-    node_name = event["node_name"] if event["node_name"] else None
-    temperature = event["temperature"]
-    humidity = event["humidity"]
-    luminosity = event["luminosity"]
-    hazardous_gas_warning = event["hazardous_gas_warning"]
+    if isinstance(node_id, bool) or not isinstance(node_id, int):
+        raise ValueError(f"invalid node_id: {node_id!r}")
+    node_name = event.get("node_name") or None
+    values = []
+    for field in NUMERIC_FIELDS:
+        value = event[field]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"invalid {field}: {value!r}")
+        values.append(value)
     timestamp = datetime.now(tz=tz.gettz("America/Sao_Paulo")).replace(tzinfo=None)
 
+    return (node_id, node_name, *values, timestamp)
+
+
+def _frame(payload) -> Optional[bytes]:
+    """`payload` as a ChickenUDP frame, or None if it is not one.
+
+    Frames come as published by the bridge, or base64-encoded: an IoT rule
+    can only forward a payload that is not JSON (a JSON frame with its CRC
+    or a binary frame) as `encode(*, 'base64')`, and SQS bodies are text.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if not isinstance(payload, bytes):
+        return None
+    if is_framed(payload):
+        return payload
+    try:
+        decoded = b64decode(payload, validate=True)
+    except ValueError:
+        return None
+    return decoded if is_framed(decoded) else None
+
+
+def _measurement(item) -> object:
+    """A measurement of an event, or the frame to unpack it from."""
+    if isinstance(item, dict) and "frame" in item:
+        # {"frame": ...} is what `SELECT encode(*, 'base64') AS frame` sends
+        frame = _frame(item["frame"])
+        if frame is None:
+            raise ValueError("invalid ChickenUDP frame")
+        return frame
+    frame = _frame(item)
+    if frame is not None:
+        return frame
+    return flatten_measurement(item) if isinstance(item, dict) else item
+
+
+def _measurements(body) -> List[object]:
+    """The measurements of an SQS body: a frame or JSON of one or a list."""
+    frame = _frame(body)
+    if frame is not None:
+        return [frame]
+    if isinstance(body, (str, bytes)):
+        body = loads(body)
+    return [_measurement(item) for item in (body if isinstance(body, list) else [body])]
+
+
+def unpack_event(event) -> List[Tuple[str, object]]:
+    """Flatten a single, list or `Records` event into (item id, measurement) pairs.
+
+    Item ids are the SQS message ids when available so failures can be
+    reported back as `batchItemFailures`; otherwise the position in the batch.
+    Measurements may be ChickenUDP frames, as the bridge publishes them, in
+    the bridge's JSON layout or already flat; an item that cannot be read
+    is paired with the error instead.
+    """
+    if isinstance(event, dict) and "Records" in event:
+        bodies = []
+        for index, record in enumerate(event["Records"]):
+            if isinstance(record, dict):
+                item_id = record.get("messageId", str(index))
+                bodies.append((item_id, record.get("body", record)))
+            else:
+                bodies.append((str(index), ValueError(f"invalid record: {record!r}")))
+    elif isinstance(event, list):
+        bodies = [(str(index), [item]) for index, item in enumerate(event)]
+    else:
+        bodies = [("0", [event])]
+
+    items = []
+    for item_id, body in bodies:
+        if isinstance(body, Exception):
+            items.append((item_id, body))
+            continue
+        try:
+            items.extend((item_id, measurement) for measurement in _measurements(body))
+        except (TypeError, ValueError) as e:
+            items.append((item_id, e))
+
+    # The frames of the whole event are checked in one pass
+    unpacked = iter(cudp.unpack_batch([m for _, m in items if isinstance(m, bytes)]))
+    for position, (item_id, measurement) in enumerate(items):
+        if isinstance(measurement, bytes):
+            measurement = next(unpacked)
+            items[position] = (
+                item_id,
+                (
+                    ValueError("invalid ChickenUDP frame")
+                    if measurement is None
+                    else flatten_measurement(measurement)
+                ),
+            )
+    return items
+
+
+def rollup_rows(rows: List[Tuple]) -> List[Tuple]:
+    """Aggregate `measurements` rows into one partial rollup row per
+    resolution, node and bucket, laid out as ROLLUP_COLUMNS."""
+    aggregates: Dict[Tuple, List] = {}
+    for node_id, node_name, *values, timestamp in rows:
+        for resolution, truncate in ROLLUP_RESOLUTIONS.items():
+            key = (resolution, node_id, timestamp.replace(**truncate))
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregates[key] = [node_name, 1, *(v for v in values for _ in range(3))]
+                continue
+            aggregate[0] = node_name or aggregate[0]
+            aggregate[1] += 1
+            for position, value in enumerate(values):
+                stats = 2 + 3 * position
+                aggregate[stats] = min(aggregate[stats], value)
+                aggregate[stats + 1] = max(aggregate[stats + 1], value)
+                aggregate[stats + 2] += value
+
+    # Upserting in key order makes concurrent writers lock rows in the same
+    # order, so overlapping batches wait on each other instead of deadlocking
+    return [
+        (resolution, node_id, aggregate[0], bucket, *aggregate[1:])
+        for (resolution, node_id, bucket), aggregate in sorted(aggregates.items())
+    ]
+
+
+def create_rollup_table(conn: psycopg.Connection):
+    """Create `measurements_rollup` if needed and backfill it from
+    `measurements` when it misses their history.
+
+    Both happen in one transaction, which the caller commits, so readers
+    see either no table or one covering the whole history, and the backfill
+    can safely run again.
+    """
+    conn.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+    conn.execute(ROLLUP_TABLE_SQL)
+    if conn.execute(ROLLUP_MISSES_HISTORY_SQL).fetchone()[0]:
+        logger.info("Backfilling measurements_rollup")
+        for resolution in ROLLUP_RESOLUTIONS:
+            conn.execute(ROLLUP_BACKFILL_SQL, {"resolution": resolution})
+
+
+def insert_measurements(conn: psycopg.Connection, rows: List[Tuple]):
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO measurements
-                (node_id, node_name, temperature, humidity, luminosity, hazardous_gas_warning, timestamp)
-            VALUES
-                (%s, %s, %s, %s, %s, %s, %s);
-            """,
-            (
-                node_id,
-                node_name,
-                temperature,
-                humidity,
-                luminosity,
-                hazardous_gas_warning,
-                timestamp,
-            ),
+        with cur.copy(
+            f"COPY measurements ({', '.join(MEASUREMENT_COLUMNS)}) FROM STDIN"
+        ) as copy:
+            for row in rows:
+                copy.write_row(row)
+        # Same transaction as the rows, so rollups never count a reading twice
+        # or miss one that was committed
+        cur.executemany(ROLLUP_UPSERT_SQL, rollup_rows(rows))
+
+
+rollup_table_ready = False
+
+
+def lambda_handler(event, context: LambdaContext):
+    global rollup_table_ready
+    logger.info("Event is: " + str(event))
+
+    rows_by_item: Dict[str, List[Tuple]] = {}
+    failed_items: Dict[str, str] = {}
+    for item_id, measurement in unpack_event(event):
+        try:
+            if isinstance(measurement, Exception):
+                raise measurement
+            rows_by_item.setdefault(item_id, []).append(measurement_row(measurement))
+        except (KeyError, TypeError, ValueError) as e:
+            failed_items.setdefault(item_id, repr(e))
+
+    # A failed item is reported (and possibly redelivered) as a whole, so none
+    # of its measurements are written to avoid duplicates on retry
+    rows = [
+        row
+        for item_id, item_rows in rows_by_item.items()
+        if item_id not in failed_items
+        for row in item_rows
+    ]
+
+    if failed_items:
+        logger.warning(
+            "Discarded invalid measurements",
+            extra={
+                "failures": failed_items,
+                # Per node since the container started
+                "invalid_frames": {
+                    str(node_id): count
+                    for node_id, count in cudp.invalid_frames.items()
+                },
+            },
         )
+    if rows:
+        if not rollup_table_ready:
+            connection_manager.run(create_rollup_table)
+            rollup_table_ready = True
+        connection_manager.run(lambda conn: insert_measurements(conn, rows))
 
-    conn.commit()
+    return {
+        "inserted": len(rows),
+        "batchItemFailures": [{"itemIdentifier": item_id} for item_id in failed_items],
+    }
 
 
 if __name__ == "__main__":
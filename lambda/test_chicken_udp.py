@@ -0,0 +1,174 @@
+"""ChickenUDP frames against the ones the firmware writes.
+
+The same frames are checked on the firmware side by
+mesh/test/test_chicken_udp, so a change to either implementation that
+breaks the format fails one of the two.
+"""
+
+from zlib import crc32
+
+import pytest
+
+from chicken_udp import ChickenUDP, is_framed
+
+# Frames as ChickenUDP::packageData writes them, with what they unpack to
+VECTORS = [
+    (
+        b'{"data":{"temperature":27.5,"humidity":61.25,"luminosity":0.5,'
+        b'"hazardous_gas_warning":0},"msg_type":0}ce6a5631',
+        {
+            "data": {
+                "temperature": 27.5,
+                "humidity": 61.25,
+                "luminosity": 0.5,
+                "hazardous_gas_warning": 0,
+            },
+            "msg_type": 0,
+        },
+    ),
+    (
+        b'{"data":{"temperature":23.1,"humidity":70,"luminosity":0.12,'
+        b'"hazardous_gas_warning":1},"node_id":2137568581,'
+        b'"node_name":"galinheiro-2"}bc6b245e',
+        {
+            "data": {
+                "temperature": 23.1,
+                "humidity": 70,
+                "luminosity": 0.12,
+                "hazardous_gas_warning": 1,
+            },
+            "node_id": 2137568581,
+            "node_name": "galinheiro-2",
+        },
+    ),
+    (b'{"node_name":"pintinho-\xc3\xa7"}bb730218', {"node_name": "pintinho-ç"}),
+]
+
+# Binary frames of a node and of the bridge forwarding it, as packageBinary
+# and appendOrigin write them
+BINARY_VECTORS = [
+    (
+        bytes.fromhex("010094ca41dc0000ca42750000ca3f000000ca00000000e9b1f8ee"),
+        {
+            "data": {
+                "temperature": 27.5,
+                "humidity": 61.25,
+                "luminosity": 0.5,
+                "hazardous_gas_warning": 0.0,
+            },
+            "msg_type": 0,
+        },
+    ),
+    (
+        bytes.fromhex(
+            "010096ca41b90000ca428c0000ca3e000000ca3f800000"
+            "ce7f68b545ac67616c696e686569726f2d3260d39fcc"
+        ),
+        {
+            "data": {
+                "temperature": 23.125,
+                "humidity": 70.0,
+                "luminosity": 0.125,
+                "hazardous_gas_warning": 1.0,
+            },
+            "node_id": 2137568581,
+            "node_name": "galinheiro-2",
+        },
+    ),
+]
+
+
+def test_crc_matches_the_arduino_library():
+    # The CRC-32 check value, which CRC32.h computes for the same input
+    assert crc32(b"123456789") == 0xCBF43926
+
+
+@pytest.mark.parametrize("frame, app_data", VECTORS)
+def test_json_frames(frame, app_data):
+    cudp = ChickenUDP()
+    assert is_framed(frame)
+    assert cudp.package_data(app_data) == frame
+    assert cudp.unpack_data(frame) == app_data
+    # strtoimax on the firmware side takes either case
+    assert cudp.unpack_data(frame[:-8] + frame[-8:].upper()) == app_data
+
+
+@pytest.mark.parametrize("frame, app_data", VECTORS)
+def test_corrupted_json_frames(frame, app_data):
+    cudp = ChickenUDP()
+    assert cudp.unpack_data(frame[:2] + b"X" + frame[3:]) is None
+    assert sum(cudp.invalid_frames.values()) == 1
+
+
+def test_batch_keeps_frame_order():
+    cudp = ChickenUDP()
+    frames = [frame for frame, _ in VECTORS]
+    frames.insert(1, b'{"node_id":1}00000000')
+    unpacked = cudp.unpack_batch(frames)
+    assert unpacked == [VECTORS[0][1], None, VECTORS[1][1], VECTORS[2][1]]
+    assert cudp.invalid_frames == {1: 1}
+
+
+def test_plain_json_is_not_framed():
+    assert not is_framed(b'{"node_id":1,"temperature":20}')
+
+
+@pytest.mark.parametrize("frame, app_data", BINARY_VECTORS)
+def test_binary_frames(frame, app_data):
+    cudp = ChickenUDP()
+    assert is_framed(frame)
+    assert cudp.package_binary(app_data, app_data.get("msg_type", 0)) == frame
+    assert cudp.unpack_data(frame) == app_data
+
+
+@pytest.mark.parametrize("frame, app_data", BINARY_VECTORS)
+def test_corrupted_binary_frames(frame, app_data):
+    cudp = ChickenUDP()
+    assert cudp.unpack_data(frame[:-1] + bytes([frame[-1] ^ 1])) is None
+    # A value cut short, with the checksum recomputed, still fails to decode
+    truncated = frame[:-5]
+    assert cudp.unpack_data(truncated + crc32(truncated).to_bytes(4, "little")) is None
+    assert sum(cudp.invalid_frames.values()) == 2
+
+
+def test_floats_that_need_float64():
+    cudp = ChickenUDP()
+    app_data = {
+        "data": {
+            "temperature": 23.1,
+            "humidity": 70.0,
+            "luminosity": 0.12,
+            "hazardous_gas_warning": 0.0,
+        },
+        "msg_type": 0,
+    }
+    assert cudp.unpack_data(cudp.package_binary(app_data)) == app_data
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        # Arrays or objects nested deeper than the decoders can recurse
+        bytes([1, 0]) + b"\x91" * 5000 + b"\x00" * 4,
+        b"[" * 5000 + b"}" + b"0" * 8,
+        # The same with valid checksums
+        bytes([1, 0])
+        + b"\x91" * 5000
+        + crc32(bytes([1, 0]) + b"\x91" * 5000).to_bytes(4, "little"),
+        b"[" * 5000 + b"}" + b"%08x" % crc32(b"[" * 5000 + b"}"),
+    ],
+)
+def test_deeply_nested_frames(frame):
+    cudp = ChickenUDP()
+    assert cudp.unpack_data(frame) is None
+    assert cudp.unpack_batch([frame, VECTORS[0][0]]) == [None, VECTORS[0][1]]
+    assert cudp.invalid_frames == {None: 2}
+
+
+def test_invalid_frames_name_their_node():
+    cudp = ChickenUDP()
+    binary = BINARY_VECTORS[1][0]
+    cudp.unpack_batch(
+        [VECTORS[1][0][:-1] + b"0", binary[:-1] + bytes([binary[-1] ^ 1])]
+    )
+    assert cudp.invalid_frames == {2137568581: 2}
@@ -0,0 +1,133 @@
+import asyncio
+from json import dumps
+from time import monotonic
+from typing import List, Tuple
+
+import psycopg
+
+from ingest_daemon import IngestDaemon
+
+
+def payload(node_id: int) -> bytes:
+    return dumps(
+        {
+            "data": {
+                "temperature": 23.2,
+                "humidity": 61.0,
+                "luminosity": 0.7,
+                "hazardous_gas_warning": 0.0,
+            },
+            "node_id": node_id,
+            "node_name": f"node-{node_id}",
+        }
+    ).encode()
+
+
+class FakeWriter:
+    """Records the batches it is given, failing the first `failures` writes
+    and rejecting any batch holding a node in `rejected`."""
+
+    def __init__(self, failures: int = 0, rejected: Tuple[int, ...] = ()):
+        self.failures = failures
+        self.rejected = rejected
+        self.attempts = 0
+        self.batches = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def write(self, rows: List[Tuple]):
+        self.attempts += 1
+        await self.release.wait()
+        if self.failures:
+            self.failures -= 1
+            raise psycopg.OperationalError("connection lost")
+        if any(row[0] in self.rejected for row in rows):
+            raise psycopg.DataError("value out of range")
+        self.batches.append([row[0] for row in rows])
+
+
+async def ingest(daemon: IngestDaemon, node_ids) -> float:
+    """Put a payload for each node, wait until they are flushed and return
+    how long that took."""
+    runner = asyncio.create_task(daemon.run())
+    start = monotonic()
+    for node_id in node_ids:
+        await daemon.put(payload(node_id))
+    await daemon.drain()
+    runner.cancel()
+    return monotonic() - start
+
+
+def test_batches_by_size():
+    writer = FakeWriter()
+    daemon = IngestDaemon(writer, batch_size=3, flush_interval_ms=10000)
+    asyncio.run(ingest(daemon, range(6)))
+    assert writer.batches == [[0, 1, 2], [3, 4, 5]]
+    assert daemon.rows_written == 6
+    assert daemon.flushes == len(daemon.flush_latencies) == 2
+
+
+def test_batches_by_time():
+    writer = FakeWriter()
+    daemon = IngestDaemon(writer, batch_size=100, flush_interval_ms=50)
+    elapsed = asyncio.run(ingest(daemon, range(3)))
+    assert writer.batches == [[0, 1, 2]]
+    assert elapsed >= 0.05
+
+
+def test_retries_with_backoff():
+    writer = FakeWriter(failures=2)
+    daemon = IngestDaemon(writer, batch_size=2, flush_interval_ms=10)
+    daemon.RETRY_MIN_S = 0.001
+    asyncio.run(ingest(daemon, range(2)))
+    assert writer.attempts == 3
+    assert writer.batches == [[0, 1]]
+    assert daemon.rows_written == 2
+
+
+def test_discards_only_rejected_rows():
+    writer = FakeWriter(rejected=(2, 5))
+    daemon = IngestDaemon(writer, batch_size=8, flush_interval_ms=10)
+    asyncio.run(ingest(daemon, range(8)))
+    assert sorted(sum(writer.batches, [])) == [0, 1, 3, 4, 6, 7]
+    assert daemon.rows_written == 6
+    assert daemon.rows_invalid == 2
+
+
+def test_invalid_payloads_are_counted():
+    daemon = IngestDaemon(FakeWriter())
+    asyncio.run(daemon.put(b"[" * 100000))
+    asyncio.run(daemon.put(b'{"node_id": 1}'))
+    assert daemon.rows_invalid == 2
+
+
+def test_full_queue_drops_instead_of_blocking():
+    async def fill():
+        writer = FakeWriter()
+        writer.release.clear()
+        daemon = IngestDaemon(
+            writer, batch_size=1, max_queued_rows=2, submit_timeout_ms=50
+        )
+        runner = asyncio.create_task(daemon.run())
+        await asyncio.sleep(0)
+
+        def publish():
+            # One row is being written, two are queued, the rest find no room
+            start = monotonic()
+            for node_id in range(6):
+                daemon.submit(payload(node_id))
+            return monotonic() - start
+
+        elapsed = await asyncio.to_thread(publish)
+        # Only the first row that found no room waited for it
+        assert elapsed < 0.5
+        assert daemon.rows_dropped == 3
+
+        writer.release.set()
+        await daemon.drain()
+        await daemon.put(payload(6))
+        await daemon.drain()
+        runner.cancel()
+        return writer.batches
+
+    assert asyncio.run(fill()) == [[0], [1], [2], [6]]
@@ -0,0 +1,234 @@
+import json
+from base64 import b64encode
+
+import psycopg
+import pytest
+
+import main
+from chicken_udp import ChickenUDP
+
+BRIDGE_MESSAGE = {
+    "data": {
+        "temperature": 27.5,
+        "humidity": 61.25,
+        "luminosity": 0.5,
+        "hazardous_gas_warning": 0.0,
+    },
+    "node_id": 2137568581,
+    "node_name": "galinheiro-2",
+}
+MEASUREMENT = main.flatten_measurement(BRIDGE_MESSAGE)
+FRAME = ChickenUDP.package_data(BRIDGE_MESSAGE)
+
+
+def base64(frame: bytes) -> str:
+    return b64encode(frame).decode()
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        MEASUREMENT,
+        BRIDGE_MESSAGE,
+        # What an IoT rule `SELECT encode(*, 'base64') AS frame` sends
+        {"frame": base64(FRAME)},
+        {"frame": base64(ChickenUDP.package_binary(BRIDGE_MESSAGE))},
+    ],
+)
+def test_single_event(event):
+    assert main.unpack_event(event) == [("0", MEASUREMENT)]
+
+
+def test_list_event():
+    event = [MEASUREMENT, BRIDGE_MESSAGE, {"frame": base64(FRAME)}]
+    assert main.unpack_event(event) == [
+        ("0", MEASUREMENT),
+        ("1", MEASUREMENT),
+        ("2", MEASUREMENT),
+    ]
+
+
+def test_records_event():
+    binary_frame = ChickenUDP.package_binary(BRIDGE_MESSAGE)
+    bodies = {
+        "json-frame": FRAME.decode(),
+        "bridge-json": json.dumps(BRIDGE_MESSAGE),
+        "flat-json": json.dumps(MEASUREMENT),
+        "binary-frame": base64(binary_frame),
+        "rule-output": json.dumps({"frame": base64(binary_frame)}),
+    }
+    event = {
+        "Records": [
+            {"messageId": item_id, "body": body} for item_id, body in bodies.items()
+        ]
+    }
+    assert main.unpack_event(event) == [(item_id, MEASUREMENT) for item_id in bodies]
+
+
+def test_invalid_records_are_reported():
+    event = {
+        "Records": [
+            {"messageId": "a", "body": FRAME[:-1].decode() + "0"},
+            {"messageId": "b", "body": "not json"},
+            "not a record",
+            {"messageId": "c", "body": json.dumps(BRIDGE_MESSAGE)},
+        ]
+    }
+    items = main.unpack_event(event)
+    assert [item_id for item_id, _ in items] == ["a", "b", "2", "c"]
+    assert all(isinstance(measurement, ValueError) for _, measurement in items[:3])
+    assert items[3] == ("c", MEASUREMENT)
+
+
+def test_handler_reports_failed_items(monkeypatch):
+    written = []
+    monkeypatch.setattr(main, "rollup_table_ready", True)
+    monkeypatch.setattr(
+        main.connection_manager, "run", lambda operation: written.append(operation)
+    )
+    event = {
+        "Records": [
+            {"messageId": "a", "body": FRAME.decode()},
+            ["not", "a", "record"],
+            {"messageId": "b", "body": json.dumps({"node_id": 1})},
+        ]
+    }
+    response = main.lambda_handler(event, None)
+    assert response == {
+        "inserted": 1,
+        "batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "b"}],
+    }
+    assert len(written) == 1
+
+
+class StubSecrets:
+    """Secrets Manager returning each of `passwords` in turn."""
+
+    def __init__(self, *passwords):
+        self.passwords = list(passwords)
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        password = self.passwords[min(self.calls, len(self.passwords) - 1)]
+        self.calls += 1
+        secret = {"host": "db", "port": 5432, "username": "iop", "dbname": "iop"}
+        return {"SecretString": json.dumps({**secret, "password": password})}
+
+
+class StubConnection:
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.queries = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail_commit = False
+
+    def _drop(self):
+        self.broken = True
+        raise psycopg.OperationalError("server closed the connection")
+
+    def execute(self, query):
+        self.queries.append(query)
+        if self.broken:
+            self._drop()
+
+    def commit(self):
+        if self.fail_commit:
+            self._drop()
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """The connections opened to a database that only accepts the password
+    "current", and a clock standing in for `monotonic`."""
+    connections = []
+    clock = [1000.0]
+
+    def connect(password, **kwargs):
+        if password != "current":
+            raise psycopg.OperationalError("password authentication failed")
+        connections.append(StubConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(main.psycopg, "connect", connect)
+    monkeypatch.setattr(main, "monotonic", lambda: clock[0])
+    return connections, clock
+
+
+def test_secret_is_cached_for_its_ttl(database):
+    connections, clock = database
+    secrets = StubSecrets("current")
+    manager = main.ConnectionManager(secrets, secret_ttl=300)
+    manager.get_connection()
+    manager.close()
+    manager.get_connection()
+    assert secrets.calls == 1
+    clock[0] += 301
+    manager.close()
+    manager.get_connection()
+    assert secrets.calls == 2
+    assert len(connections) == 3
+
+
+def test_rotated_secret_is_refetched(database):
+    connections, _ = database
+    secrets = StubSecrets("rotated-away", "current")
+    manager = main.ConnectionManager(secrets)
+    assert manager.get_connection() is connections[0]
+    assert secrets.calls == 2
+
+
+def test_idle_connection_is_checked(database):
+    connections, clock = database
+    manager = main.ConnectionManager(StubSecrets("current"), idle_check_s=60)
+    first = manager.get_connection()
+    clock[0] += 30
+    assert manager.get_connection() is first
+    assert first.queries == []
+    # Dropped by the server while the Lambda was frozen
+    first.execute = lambda query: first._drop()
+    clock[0] += 61
+    assert manager.get_connection() is connections[1]
+    assert first.closed
+
+
+def test_run_commits_or_rolls_back(database):
+    connections, _ = database
+    manager = main.ConnectionManager(StubSecrets("current"))
+    assert manager.run(lambda conn: "done") == "done"
+    with pytest.raises(ValueError):
+        manager.run(lambda conn: int("not a number"))
+    assert len(connections) == 1
+    assert (connections[0].commits, connections[0].rollbacks) == (1, 1)
+
+
+def test_run_retries_when_broken_before_commit(database):
+    connections, _ = database
+    manager = main.ConnectionManager(StubSecrets("current"))
+    manager.get_connection()
+    connections[0].broken = True
+    calls = []
+    assert manager.run(lambda conn: calls.append(conn.execute("COPY"))) is None
+    assert len(calls) == 1
+    assert len(connections) == 2
+    assert connections[1].commits == 1
+
+
+def test_run_does_not_retry_a_failed_commit(database):
+    connections, _ = database
+    manager = main.ConnectionManager(StubSecrets("current"))
+    manager.get_connection().fail_commit = True
+    calls = []
+    with pytest.raises(psycopg.OperationalError):
+        manager.run(calls.append)
+    assert len(calls) == 1
+    # The next invocation gets a new connection
+    assert manager.get_connection() is connections[1]
@@ -1,11 +1,35 @@
 #include <ArduinoJson.h>
 #include <CRC32.h>
+#include <libb64/cdecode.h>
+#include <libb64/cencode.h>
 #include "const.h"
 
+// Binary frames: this version byte, the message type, a MessagePack array
+// of the values and the CRC32 of all of that, 4 bytes little-endian. They go
+// base64-encoded over the mesh, which never starts with the '{' of a JSON
+// frame, and raw over MQTT.
+#define CUDP_BINARY_V1 0x01
+#define CUDP_BINARY_HEADER_LENGTH 2
+#define CUDP_BINARY_CRC_LENGTH 4
+#define CUDP_MAX_BINARY_FRAME 128
+
 class ChickenUDP {
  protected:
   CRC32 crc;
 
+  uint32_t checksum(const uint8_t *data, size_t length) {
+    crc.add(data, length);
+    uint32_t checksum = crc.calc();
+    crc.restart();
+    return checksum;
+  };
+
+  size_t appendChecksum(uint8_t *frame, size_t length) {
+    uint32_t frame_crc = checksum(frame, length);
+    for (int i = 0; i < CUDP_BINARY_CRC_LENGTH; i++) frame[length + i] = frame_crc >> (8 * i);
+    return length + CUDP_BINARY_CRC_LENGTH;
+  };
+
  public:
   String packageData(DataJson *app_data) {
     String app_data_str;
@@ -38,4 +62,75 @@ class ChickenUDP {
     *app_data = app_data_doc.as<JsonObject>();
     return true;
   };
-};
\ No newline at end of file
+
+  static bool isBinary(const String &cudp_packet) {
+    return cudp_packet.length() > 0 && cudp_packet[0] != '{';
+  };
+
+  // Base64 of the binary frame of `values`, an array in the order the
+  // Python side expects for `msg_type`
+  String packageBinary(uint8_t msg_type, JsonDocument *values) {
+    uint8_t frame[CUDP_MAX_BINARY_FRAME];
+    frame[0] = CUDP_BINARY_V1;
+    frame[1] = msg_type;
+    size_t length = CUDP_BINARY_HEADER_LENGTH +
+                    serializeMsgPack(*values, frame + CUDP_BINARY_HEADER_LENGTH,
+                                     sizeof(frame) - CUDP_BINARY_HEADER_LENGTH -
+                                         CUDP_BINARY_CRC_LENGTH);
+    length = appendChecksum(frame, length);
+
+    char encoded[4 * ((CUDP_MAX_BINARY_FRAME + 2) / 3) + 1];
+    base64_encodestate state;
+    base64_init_encodestate(&state);
+    int encoded_length = base64_encode_block((const char *)frame, length, encoded, &state);
+    encoded_length += base64_encode_blockend(encoded + encoded_length, &state);
+    encoded[encoded_length] = '\0';
+    // Some libb64 builds end the block with a newline
+    String cudp_packet = String(encoded);
+    cudp_packet.trim();
+    return cudp_packet;
+  };
+
+  // Decodes a base64 binary frame into `frame` and returns its length, or 0
+  // when it is not a valid version 1 frame
+  size_t unpackBinary(const String &cudp_packet, uint8_t *frame, size_t capacity) {
+    if (cudp_packet.length() > 4 * (capacity / 3)) return 0;
+    base64_decodestate state;
+    base64_init_decodestate(&state);
+    int length = base64_decode_block(cudp_packet.c_str(), cudp_packet.length(), (char *)frame,
+                                     &state);
+    if (length <= CUDP_BINARY_HEADER_LENGTH + CUDP_BINARY_CRC_LENGTH) return 0;
+    if (frame[0] != CUDP_BINARY_V1) return 0;
+
+    size_t payload_length = length - CUDP_BINARY_CRC_LENGTH;
+    uint32_t checksum_in_packet = 0;
+    for (int i = 0; i < CUDP_BINARY_CRC_LENGTH; i++)
+      checksum_in_packet |= (uint32_t)frame[payload_length + i] << (8 * i);
+    if (checksum_in_packet != checksum(frame, payload_length)) return 0;
+    return length;
+  };
+
+  // Adds the sender's id and name at the end of the values of a binary
+  // frame without decoding them: only the array header is rewritten and
+  // the checksum computed again. Returns the new length, 0 if it does not fit
+  size_t appendOrigin(uint8_t *frame, size_t length, size_t capacity, uint32_t node_id,
+                      const String &node_name) {
+    uint8_t &array_header = frame[CUDP_BINARY_HEADER_LENGTH];
+    // A fixarray with room for two more values
+    if ((array_header & 0xf0) != 0x90 || (array_header & 0x0f) > 13) return 0;
+
+    StaticJsonDocument<96> origin;
+    origin.add(node_id);
+    origin.add(node_name);
+    uint8_t origin_packed[80];
+    size_t origin_length = serializeMsgPack(origin, origin_packed, sizeof(origin_packed));
+    if (origin_length == 0) return 0;
+
+    // Values only, without the header of their own array
+    size_t payload_length = length - CUDP_BINARY_CRC_LENGTH;
+    if (payload_length + origin_length - 1 + CUDP_BINARY_CRC_LENGTH > capacity) return 0;
+    memcpy(frame + payload_length, origin_packed + 1, origin_length - 1);
+    array_header += 2;
+    return appendChecksum(frame, payload_length + origin_length - 1);
+  };
+};
@@ -80,6 +80,20 @@ void meshReceiveCallback(const uint32_t &from, const String &msg) {
   String from_node_name = mesh.getNameById(from);
   Log(DEBUG, "Received message from %s, msg: %s \n", from_node_name.c_str(), msg.c_str());
 
+  if (ChickenUDP::isBinary(msg)) {
+    // Checked and forwarded as is, with the sender appended
+    uint8_t frame[CUDP_MAX_BINARY_FRAME];
+    size_t frame_length = cudp.unpackBinary(msg, frame, sizeof(frame));
+    if (frame_length)
+      frame_length = cudp.appendOrigin(frame, frame_length, sizeof(frame), from, from_node_name);
+    if (!frame_length) {
+      Log(ERROR, "Binary package discarded due to CUDP check\n");
+      return;
+    }
+    if (frame[1] == MEASUREMENTS) mqttClient.publish(MEASUREMENTS_TOPIC, frame, frame_length);
+    return;
+  }
+
   bool unpack_successful = cudp.unpackData(msg, &app_data);
   if (!unpack_successful) {
     Log(ERROR, "Package discarded due to CUDP CRC check\n");
@@ -87,15 +101,17 @@ void meshReceiveCallback(const uint32_t &from, const String &msg) {
   }
 
   short message_type = app_data["msg_type"];
-  app_data.remove("msg_type");
-  app_data["node_id"] = from;
-  app_data["node_name"] = from_node_name;
+  DataJson forward_data;
+  forward_data.set(app_data);
+  forward_data.remove("msg_type");
+  forward_data["node_id"] = from;
+  forward_data["node_name"] = from_node_name;
 
-  String app_data_str;
-  serializeJson(app_data, app_data_str);
+  // Packed again, so the CRC covers the message up to the database
+  String cudp_packet = cudp.packageData(&forward_data);
 
   if (message_type == MEASUREMENTS)
-    mqttClient.publish(MEASUREMENTS_TOPIC, app_data_str.c_str());
+    mqttClient.publish(MEASUREMENTS_TOPIC, cudp_packet.c_str());
 }
 
 void mqttReceiveCallback(char *topic, uint8_t *payload, unsigned int length) {
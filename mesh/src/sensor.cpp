@@ -77,9 +77,20 @@ void meshReceiveNamedCallback(const String &from, const String &msg) {
 void meshChangeConnCallback() { Log(DEBUG, "Changed connections!\n"); }
 
 void sendMeasurementsToBridge() {
+#ifdef CUDP_BINARY_FRAMES
+  StaticJsonDocument<128> values;
+  float num_of_reads = latest_average_measures.number_of_readings;
+  // In the order of MEASUREMENT_FIELDS on the Python side
+  values.add(latest_average_measures.temperature / num_of_reads);
+  values.add(latest_average_measures.humidity / num_of_reads);
+  values.add(latest_average_measures.luminosity / num_of_reads);
+  values.add(latest_average_measures.hazardous_gas_warning / num_of_reads);
+  mesh.sendSingle(bridge_name, cudp.packageBinary(MEASUREMENTS, &values));
+#else
   DataJson app_data;
   serializeMeasurements(&app_data);
   sendAppData(&app_data, BRIDGE_NAME);
+#endif
   resetMeasurements();
 };
 
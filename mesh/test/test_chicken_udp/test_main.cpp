@@ -0,0 +1,107 @@
+// Frames ChickenUDP writes, byte for byte. lambda/test_chicken_udp.py checks
+// the Python side against the same frames.
+//
+// Runs on a board, as the library needs the Arduino core:
+//   pio test -e sensor_r1 -f test_chicken_udp
+#include <Arduino.h>
+#include <base64.h>
+#include "ChickenUDP.h"
+#include <unity.h>
+
+ChickenUDP cudp;
+
+void assertRoundTrip(DataJson *app_data, const char *expected_frame) {
+  String frame = cudp.packageData(app_data);
+  TEST_ASSERT_EQUAL_STRING(expected_frame, frame.c_str());
+
+  JsonObject unpacked;
+  TEST_ASSERT_TRUE(cudp.unpackData(frame, &unpacked));
+  frame.setCharAt(2, 'X');
+  TEST_ASSERT_FALSE(cudp.unpackData(frame, &unpacked));
+}
+
+void test_node_frame() {
+  DataJson app_data;
+  app_data["data"]["temperature"] = 27.5;
+  app_data["data"]["humidity"] = 61.25;
+  app_data["data"]["luminosity"] = 0.5;
+  app_data["data"]["hazardous_gas_warning"] = 0;
+  app_data["msg_type"] = MEASUREMENTS;
+  assertRoundTrip(&app_data,
+                  "{\"data\":{\"temperature\":27.5,\"humidity\":61.25,\"luminosity\":0.5,"
+                  "\"hazardous_gas_warning\":0},\"msg_type\":0}ce6a5631");
+}
+
+void test_forwarded_frame() {
+  DataJson app_data;
+  app_data["data"]["temperature"] = 23.1;
+  app_data["data"]["humidity"] = 70;
+  app_data["data"]["luminosity"] = 0.12;
+  app_data["data"]["hazardous_gas_warning"] = 1;
+  app_data["node_id"] = (uint32_t)2137568581;
+  app_data["node_name"] = "galinheiro-2";
+  assertRoundTrip(&app_data,
+                  "{\"data\":{\"temperature\":23.1,\"humidity\":70,\"luminosity\":0.12,"
+                  "\"hazardous_gas_warning\":1},\"node_id\":2137568581,"
+                  "\"node_name\":\"galinheiro-2\"}bc6b245e");
+}
+
+void test_utf8_frame() {
+  DataJson app_data;
+  app_data["node_name"] = "pintinho-\xc3\xa7";
+  assertRoundTrip(&app_data, "{\"node_name\":\"pintinho-\xc3\xa7\"}bb730218");
+}
+
+// packageBinary sends the frame base64-encoded: decode it to compare bytes
+size_t packBinary(float temperature, float humidity, float luminosity,
+                  float hazardous_gas_warning, uint8_t *frame) {
+  StaticJsonDocument<128> values;
+  values.add(temperature);
+  values.add(humidity);
+  values.add(luminosity);
+  values.add(hazardous_gas_warning);
+  String packet = cudp.packageBinary(MEASUREMENTS, &values);
+  TEST_ASSERT_TRUE(ChickenUDP::isBinary(packet));
+  return cudp.unpackBinary(packet, frame, CUDP_MAX_BINARY_FRAME);
+}
+
+void test_binary_node_frame() {
+  const uint8_t expected[] = {0x01, 0x00, 0x94, 0xca, 0x41, 0xdc, 0x00, 0x00, 0xca,
+                              0x42, 0x75, 0x00, 0x00, 0xca, 0x3f, 0x00, 0x00, 0x00,
+                              0xca, 0x00, 0x00, 0x00, 0x00, 0xe9, 0xb1, 0xf8, 0xee};
+  uint8_t frame[CUDP_MAX_BINARY_FRAME];
+  size_t length = packBinary(27.5, 61.25, 0.5, 0, frame);
+  TEST_ASSERT_EQUAL(sizeof(expected), length);
+  TEST_ASSERT_EQUAL_HEX8_ARRAY(expected, frame, length);
+
+  frame[length - 1] ^= 1;
+  String corrupted = base64::encode(frame, length);
+  TEST_ASSERT_EQUAL(0, cudp.unpackBinary(corrupted, frame, sizeof(frame)));
+}
+
+void test_binary_forwarded_frame() {
+  const uint8_t expected[] = {0x01, 0x00, 0x96, 0xca, 0x41, 0xb9, 0x00, 0x00, 0xca, 0x42,
+                              0x8c, 0x00, 0x00, 0xca, 0x3e, 0x00, 0x00, 0x00, 0xca, 0x3f,
+                              0x80, 0x00, 0x00, 0xce, 0x7f, 0x68, 0xb5, 0x45, 0xac, 0x67,
+                              0x61, 0x6c, 0x69, 0x6e, 0x68, 0x65, 0x69, 0x72, 0x6f, 0x2d,
+                              0x32, 0x60, 0xd3, 0x9f, 0xcc};
+  uint8_t frame[CUDP_MAX_BINARY_FRAME];
+  size_t length = packBinary(23.125, 70, 0.125, 1, frame);
+  length = cudp.appendOrigin(frame, length, sizeof(frame), 2137568581, "galinheiro-2");
+  TEST_ASSERT_EQUAL(sizeof(expected), length);
+  TEST_ASSERT_EQUAL_HEX8_ARRAY(expected, frame, length);
+}
+
+void setup() {
+  // Some boards reset when the serial port opens
+  delay(2000);
+  UNITY_BEGIN();
+  RUN_TEST(test_node_frame);
+  RUN_TEST(test_forwarded_frame);
+  RUN_TEST(test_utf8_frame);
+  RUN_TEST(test_binary_node_frame);
+  RUN_TEST(test_binary_forwarded_frame);
+  UNITY_END();
+}
+
+void loop() {}